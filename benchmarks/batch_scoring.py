@@ -0,0 +1,59 @@
+'''
+Scoring throughput of the memory bank search as a function of --test_batch_size, on a synthetic bank.
+Runs the scoring path of compute_s_s_map_batch without the diffusion model: one exact search over the patches of
+B test images, top-k image scores, then upsampling and blurring of the B score maps.
+
+    python benchmarks/batch_scoring.py --bank_images 50 --batch_sizes 1 2 4 8 16
+'''
+import os
+import sys
+import time
+import argparse
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.knn_util import ExactIndex
+from utils.utils import GaussianBlur
+
+parser = argparse.ArgumentParser(description='batch scoring benchmark')
+parser.add_argument('--bank_images', default=50, type=int, help="training images in the bank")
+parser.add_argument('--test_images', default=16, type=int)
+parser.add_argument('--channels', default=640, type=int)
+parser.add_argument('--feature_size', default=32, type=int)
+parser.add_argument('--image_size', default=256, type=int)
+parser.add_argument('--topk', default=3, type=int)
+parser.add_argument('--knn_tile_size', default=8192, type=int, help="bounds the distance matrix of large batches")
+parser.add_argument('--batch_sizes', default=[1, 2, 4, 8, 16], type=int, nargs="+")
+
+
+def score_batch(index, blur, patch, args):
+    # patch (B, H * W, C) -> (B,) image scores and (B, 1, image_size, image_size) score maps on the CPU
+    B = patch.shape[0]
+    dist, _ = index.search(patch.flatten(0, 1), k=1)
+    smap = dist[:, 0].view(B, -1)
+    s_star = torch.topk(smap, k=args.topk, dim=1)[0].mean(dim=1)
+    smap = smap.view(B, 1, args.feature_size, args.feature_size)
+    smap = torch.nn.functional.interpolate(smap, size=(args.image_size, args.image_size), mode='bilinear')
+    return s_star.to('cpu'), blur(smap).to('cpu')
+
+
+def main(args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    generator = torch.Generator().manual_seed(0)
+    HW = args.feature_size ** 2
+    lib = torch.randn(args.bank_images * HW, args.channels, generator=generator).to(device)
+    test = torch.randn(args.test_images, HW, args.channels, generator=generator).to(device)
+    index = ExactIndex(lib, tile_size=args.knn_tile_size)
+    blur = GaussianBlur(4)
+    print(f"device {device}, bank {len(lib)} x {args.channels}, {args.test_images} test images")
+    for B in args.batch_sizes:
+        score_batch(index, blur, test[:B], args)  # warm up
+        start = time.perf_counter()
+        for i in range(0, args.test_images, B):
+            score_batch(index, blur, test[i:i + B], args)
+        elapsed = time.perf_counter() - start
+        print(f"test_batch_size {B:3d}: {args.test_images / elapsed:8.2f} images/s, {elapsed / args.test_images * 1000:8.2f} ms per image")
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
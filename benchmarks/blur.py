@@ -0,0 +1,56 @@
+'''
+Score map blur: the batched torch GaussianBlur against the per-map PIL KNNGaussianBlur (--pil_blur), on score maps
+like upsample_smap produces (feature_size x feature_size patch scores bilinearly upsampled to image_size).
+Prints the largest difference relative to the map maximum and the maps/s of both for every batch size.
+
+    python benchmarks/blur.py --batch_sizes 1 16 64
+'''
+import os
+import sys
+import time
+import argparse
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.utils import KNNGaussianBlur, GaussianBlur
+
+parser = argparse.ArgumentParser(description='score map blur benchmark')
+parser.add_argument('--n_maps', default=64, type=int)
+parser.add_argument('--feature_size', default=32, type=int)
+parser.add_argument('--image_size', default=256, type=int)
+parser.add_argument('--repeats', default=5, type=int)
+parser.add_argument('--batch_sizes', default=[1, 16, 64], type=int, nargs="+")
+
+
+def pil_blur(blur, maps):
+    # KNNGaussianBlur takes one (1, H, W) map at a time, as upsample_smap calls it with --pil_blur
+    return torch.stack([blur(maps[b]) for b in range(len(maps))])
+
+
+def timed(fn, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def main(args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    generator = torch.Generator().manual_seed(0)
+    maps = torch.rand(args.n_maps, 1, args.feature_size, args.feature_size, generator=generator) * 5
+    maps = torch.nn.functional.interpolate(maps, size=(args.image_size, args.image_size), mode='bilinear')
+    old, new = KNNGaussianBlur(4), GaussianBlur(4)
+
+    diff = (new(maps) - pil_blur(old, maps)).abs().amax(dim=(1, 2, 3)) / maps.amax(dim=(1, 2, 3))
+    print(f"device {device}, {args.n_maps} maps of {args.image_size} x {args.image_size}")
+    print(f"max |torch - PIL| / map max: {diff.max():.4f}, 8-bit step {1 / 255:.4f}")
+    for B in args.batch_sizes:
+        # the PIL blur runs on the host, the torch blur where the maps are
+        x, x_device = maps[:B], maps[:B].to(device)
+        t_old = timed(lambda: pil_blur(old, x), args.repeats)
+        t_new = timed(lambda: new(x_device).to('cpu'), args.repeats)
+        print(f"batch {B:3d}: PIL {B / t_old:8.0f} maps/s, torch {B / t_new:8.0f} maps/s")
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,99 @@
+'''
+Image AUROC against the coreset ratio (--f_coreset) on a synthetic bank. Normal patches are drawn around modes of
+uneven frequency, so a small bank has to keep the rare modes, and the anomalous test images replace a block of
+patches with ones from modes the bank never saw. For every ratio the bank is subsampled like run_coreset (sparse
+random projection, then greedy k-center) and, as a baseline, uniformly at random, and the test images are scored
+like compute_s_s_map (top-k mean of the nearest bank distances of their patches).
+Prints the bank size, the coreset time and the image AUROC of both subsamplings for every ratio.
+
+    python benchmarks/coreset.py --bank_images 20 --ratios 0.01 0.05 0.1 0.25 1
+'''
+import os
+import sys
+import time
+import argparse
+import torch
+from sklearn.metrics import roc_auc_score
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.knn_util import ExactIndex
+from utils.bank_util import sparse_projection, greedy_coreset
+
+parser = argparse.ArgumentParser(description='coreset ratio benchmark')
+parser.add_argument('--bank_images', default=20, type=int, help="training images in the bank")
+parser.add_argument('--test_images', default=32, type=int, help="normal and as many anomalous test images")
+parser.add_argument('--channels', default=640, type=int)
+parser.add_argument('--feature_size', default=16, type=int)
+parser.add_argument('--modes', default=256, type=int, help="modes of the normal patches, of zipf frequencies")
+parser.add_argument('--anomaly_size', default=3, type=int, help="side of the anomalous block of patches")
+parser.add_argument('--noise', default=1.5, type=float, help="spread of the patches around their mode")
+parser.add_argument('--topk', default=3, type=int)
+parser.add_argument('--coreset_eps', default=0.9, type=float)
+parser.add_argument('--knn_tile_size', default=8192, type=int)
+parser.add_argument('--ratios', default=[0.01, 0.05, 0.1, 0.25, 1], type=float, nargs="+")
+
+
+def patches(n, centers, weights, args, generator):
+    # n patches around centers drawn with weights, correlated channels of uneven scale like quantized_bank.py
+    mixing = torch.randn(args.channels, args.channels, generator=torch.Generator().manual_seed(1)) / args.channels ** 0.5
+    scale = torch.linspace(0.2, 2, args.channels)
+    modes = torch.multinomial(weights, n, replacement=True, generator=generator)
+    noise = args.noise * torch.randn(n, args.channels, generator=generator)
+    return ((centers[modes] + noise) @ mixing) * scale
+
+
+def test_set(centers, weights, args, generator):
+    # (2 * test_images, H * W, C) normal then anomalous test images and their labels
+    HW = args.feature_size ** 2
+    test = patches(2 * args.test_images * HW, centers, weights, args, generator).view(2 * args.test_images, HW, -1)
+    unseen = torch.randn(args.modes, args.channels, generator=generator) * centers.std()
+    side = args.anomaly_size
+    for image in range(args.test_images, 2 * args.test_images):
+        top, left = torch.randint(0, args.feature_size - side + 1, (2,), generator=generator).tolist()
+        rows, cols = torch.meshgrid(torch.arange(top, top + side), torch.arange(left, left + side), indexing="ij")
+        block = (rows * args.feature_size + cols).reshape(-1)
+        test[image, block] = patches(len(block), unseen, torch.ones(args.modes), args, generator)
+    labels = torch.cat([torch.zeros(args.test_images), torch.ones(args.test_images)])
+    return test, labels
+
+
+def image_auroc(lib, test, labels, args):
+    index = ExactIndex(lib, tile_size=args.knn_tile_size)
+    scores = []
+    for image in test:
+        dist, _ = index.search(image, k=1)
+        scores.append(torch.topk(dist[:, 0], k=args.topk)[0].mean())
+    return roc_auc_score(labels.numpy(), torch.stack(scores).cpu().numpy())
+
+
+def main(args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    generator = torch.Generator().manual_seed(0)
+    centers = torch.randn(args.modes, args.channels, generator=generator)
+    weights = 1 / torch.arange(1, args.modes + 1, dtype=torch.float)
+    lib = patches(args.bank_images * args.feature_size ** 2, centers, weights, args, generator)
+    test, labels = test_set(centers, weights, args, generator)
+    lib, test = lib.to(device), test.to(device)
+    N = len(lib)
+    print(f"device {device}, bank {N} x {args.channels}, {args.test_images} normal and {args.test_images} anomalous "
+          f"test images")
+
+    (z_lib,), n_components = sparse_projection([lib], eps=args.coreset_eps)
+    print(f"coreset projection: {args.channels} -> {n_components or args.channels} dimensions")
+    for ratio in args.ratios:
+        n = max(1, min(N, int(ratio * N)))
+        if n == N:
+            print(f"f_coreset {ratio:5.3f}: {n:7d} patches, full bank AUROC {image_auroc(lib, test, labels, args):.4f}")
+            continue
+        start = time.perf_counter()
+        coreset_idx = greedy_coreset(z_lib, n=n, device=device)
+        t_coreset = time.perf_counter() - start
+        random_idx = torch.randperm(N, generator=torch.Generator().manual_seed(0))[:n]
+        coreset_auroc = image_auroc(lib[coreset_idx.to(device)], test, labels, args)
+        random_auroc = image_auroc(lib[random_idx.to(device)], test, labels, args)
+        print(f"f_coreset {ratio:5.3f}: {n:7d} patches, coreset {t_coreset:6.1f} s, AUROC coreset {coreset_auroc:.4f}, "
+              f"random {random_auroc:.4f}")
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
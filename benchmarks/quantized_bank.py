@@ -0,0 +1,96 @@
+'''
+Reduced precision memory banks (--bank_precision fp16, int8, pq) against the fp32 bank, on a synthetic bank shaped
+like those of ddiminvunified_memory and controlnet_ddiminv_memory: both search an rgb and an nmap bank of
+(timesteps, bank_images * H * W, C) UNet features of the default --feature_layers 2 (640 channels on 32 x 32) with
+the same index classes, so one bank stands for either method and the memory is reported for the two banks.
+Prints the bank memory, the search time of the test images and the drift of the image scores (top-k mean of the
+patch distances) and of the patch distances against the exact fp32 search, and for fp16 / int8 the share of the
+search spent casting the code tiles to the matmul dtype (float32 on the CPU).
+
+    python benchmarks/quantized_bank.py --bank_images 50 --precisions fp16 int8 pq
+'''
+import os
+import sys
+import time
+import argparse
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.knn_util import ExactIndex, QuantizedIndex, PQIndex
+from utils.bank_util import QuantizedBank, PQBank
+
+parser = argparse.ArgumentParser(description='quantized memory bank benchmark')
+parser.add_argument('--bank_images', default=50, type=int, help="training images in the bank")
+parser.add_argument('--test_images', default=8, type=int)
+parser.add_argument('--channels', default=640, type=int)
+parser.add_argument('--feature_size', default=32, type=int)
+parser.add_argument('--topk', default=3, type=int)
+parser.add_argument('--knn_tile_size', default=8192, type=int)
+parser.add_argument('--rerank_k', default=8, type=int)
+parser.add_argument('--pq_m', default=16, type=int)
+parser.add_argument('--repeats', default=3, type=int)
+parser.add_argument('--precisions', default=["fp16", "int8", "pq"], type=str, nargs="+")
+
+
+def features(n, args, generator):
+    # correlated channels of uneven scale, closer to UNet features than white noise
+    mixing = torch.randn(args.channels, args.channels, generator=torch.Generator().manual_seed(1)) / args.channels ** 0.5
+    scale = torch.linspace(0.2, 2, args.channels)
+    return (torch.randn(n, args.channels, generator=generator) @ mixing) * scale
+
+
+def timed(fn, repeats):
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = fn()
+    return out, (time.perf_counter() - start) / repeats
+
+
+def search_images(index, test, args):
+    # test (n_images, H * W, C) -> nearest distances and indices of every patch, one image per search like
+    # compute_s_s_map
+    dist, idx = zip(*[index.search(image, k=1) for image in test])
+    return torch.stack(dist)[..., 0], torch.stack(idx)[..., 0]
+
+
+def main(args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    generator = torch.Generator().manual_seed(0)
+    HW = args.feature_size ** 2
+    lib = features(args.bank_images * HW, args, generator).to(device)
+    test = features(args.test_images * HW, args, generator).view(args.test_images, HW, -1).to(device)
+    patch_lib = lib.unsqueeze(0)  # (timesteps, N, C), the target slice only
+    print(f"device {device}, bank {len(lib)} x {args.channels} (x 2 modalities), {args.test_images} test images")
+
+    exact = ExactIndex(lib, tile_size=args.knn_tile_size)
+    (ref_dist, ref_idx), t_ref = timed(lambda: search_images(exact, test, args), args.repeats)
+    ref_score = torch.topk(ref_dist, k=args.topk, dim=1)[0].mean(dim=1)
+    fp32_mib = 2 * lib.numel() * 4 / 2 ** 20
+    print(f"fp32: {fp32_mib:8.1f} MiB, {t_ref / args.test_images * 1000:8.1f} ms per image")
+
+    for precision in args.precisions:
+        # rows are re-ranked from the float32 copy, as with a bank saved to --bank_dir
+        if precision == "pq":
+            bank = PQBank(patch_lib, args.pq_m, device, fp32_copy=patch_lib.cpu())
+            index = PQIndex(bank, rerank_k=args.rerank_k, tile_size=args.knn_tile_size)
+        else:
+            bank = QuantizedBank(patch_lib, precision, device, fp32_copy=patch_lib.cpu())
+            index = QuantizedIndex(bank, rerank_k=args.rerank_k, tile_size=args.knn_tile_size)
+        (dist, idx), t = timed(lambda: search_images(index, test, args), args.repeats)
+        score = torch.topk(dist, k=args.topk, dim=1)[0].mean(dim=1)
+        score_drift = ((score - ref_score).abs() / ref_score).max()
+        patch_drift = ((dist - ref_dist).abs() / ref_dist).mean()
+        recall = (idx == ref_idx).float().mean()
+        line = (f"{precision}: {2 * bank.nbytes() / 2 ** 20:8.1f} MiB, {t / args.test_images * 1000:8.1f} ms per image "
+                f"({t_ref / t:.2f}x fp32), max image score drift {score_drift:.2e}, mean patch distance drift "
+                f"{patch_drift:.2e}, recall@1 {recall:.3f}")
+        if precision != "pq":
+            # one cast of every code tile per query batch
+            _, t_tiles = timed(lambda: [index.tile(start) for start in range(0, len(index), index.tile_size)], args.repeats)
+            line += f", casting the code tiles {t_tiles * args.test_images / t:.0%} of the search"
+        print(line)
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -6,12 +6,13 @@ from torchvision import transforms
 from tqdm import tqdm
 from utils.au_pro_util import calculate_au_pro
 from utils.visualize_util import *
-from utils.utils import KNNGaussianBlur
+from utils.utils import KNNGaussianBlur, GaussianBlur
 from sklearn.metrics import roc_auc_score
 
 # Diffusion model
 from diffusers import DDIMScheduler
 from core.models.unet_model import build_unet
+from core.models.kv_cache import enable_kv_cache
 from transformers import CLIPTextModel, AutoTokenizer
 from diffusers import AutoencoderKL
 # from utils.ptp_utils import *
@@ -32,7 +33,8 @@ class Base_Method():
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.initialize_score()
         self.data_type = args.dataset_type
-        self.blur = KNNGaussianBlur(4)
+        self.blur = KNNGaussianBlur(4) if args.pil_blur else GaussianBlur(4)
+        self.pil_blur = args.pil_blur
         self.criteria = torch.nn.MSELoss()    
         
         self.patch_lib = []
@@ -78,20 +80,38 @@ class Base_Method():
     def cluster_training_data(self):
         pass
 
+    def get_index_report(self):
+        return None
+
+    def get_forward_report(self):
+        return None
+
+    def get_throughput_report(self, n_images, predict_time):
+        return f'Throughput: {n_images / predict_time:.2f} images/s ({n_images} images)'
+
+    def save_fitted_bank(self, bank_dir):
+        pass
+
+    def load_fitted_bank(self, bank_dir):
+        return False
+
     def calculate_metrics(self, modality_name, cls_name=None):
 
         image_labels = np.stack(self.image_labels)
-        pixel_labels = np.stack(self.pixel_labels)
          
         if modality_name == 'RGB' and self.rgb_image_preds:
-            image_preds = np.stack(self.rgb_image_preds)
-            pixel_preds = np.stack(self.rgb_pixel_preds)
+            image_preds, pixel_preds = self.rgb_image_preds, self.rgb_pixel_preds
         elif modality_name == 'Nmap' and self.nmap_image_preds:
-            image_preds = np.stack(self.nmap_image_preds)
-            pixel_preds = np.stack(self.nmap_pixel_preds)
+            image_preds, pixel_preds = self.nmap_image_preds, self.nmap_pixel_preds
         else:
-            image_preds = np.stack(self.image_preds)
-            pixel_preds = np.stack(self.pixel_preds)
+            image_preds, pixel_preds = self.image_preds, self.pixel_preds
+        image_preds = np.stack(image_preds)
+        if any(pixel_pred is None for pixel_pred in pixel_preds):
+            # --image_score_only run, not every image has a score map
+            self.image_rocauc = roc_auc_score(image_labels, image_preds)
+            return self.image_rocauc, float("nan"), float("nan")
+        pixel_labels = np.stack(self.pixel_labels)
+        pixel_preds = np.stack(pixel_preds)
 
         if modality_name == "SA":
             image_labels = np.concatenate((image_labels[:LOCO_AD[cls_name]["good"]], image_labels[-LOCO_AD[cls_name]["SA"]:]))
@@ -232,8 +252,12 @@ class DDIM_Method(Base_Method):
 
         self.unet.eval()
         self.text_encoder.eval()
+        self.kv_cache = not args.no_kv_cache
+        if self.kv_cache:
+            enable_kv_cache(self.unet)
           
         # Prepare text embedding
+        self.text_embeddings = {}
         self.uncond_embeddings = self.get_text_embedding("", 6) # [6, 77, 768]
 
         self.mul_timesteps = args.noise_intensity
@@ -267,8 +291,11 @@ class DDIM_Method(Base_Method):
 
     @torch.no_grad()
     def get_text_embedding(self, text_prompt, bsz):
-        tok = self.tokenizer(text_prompt, padding="max_length", max_length=self.tokenizer.model_max_length, truncation=True, return_tensors="pt")
-        text_embedding = self.text_encoder(tok.input_ids.to(self.device))[0].repeat((bsz, 1, 1))
+        # one encoding per prompt, broadcast over the batch without copies so the cross-attention K/V cache applies
+        if text_prompt not in self.text_embeddings:
+            tok = self.tokenizer(text_prompt, padding="max_length", max_length=self.tokenizer.model_max_length, truncation=True, return_tensors="pt")
+            self.text_embeddings[text_prompt] = self.text_encoder(tok.input_ids.to(self.device))[0]
+        text_embedding = self.text_embeddings[text_prompt].expand(bsz, -1, -1)
         return text_embedding
     
     def prev_step(self, model_output: Union[torch.FloatTensor, np.ndarray], timestep: int, sample: Union[torch.FloatTensor, np.ndarray]):
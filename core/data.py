@@ -6,7 +6,7 @@ import glob
 from torch.utils.data import Dataset
 from utils.mvtec3d_util import *
 from utils.pair_augment import *
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 
 import numpy as np
 
@@ -134,6 +134,10 @@ class MemoryLightings(BaseDataset):
     
         return data_tot_paths
 
+    def sample_ids(self):
+        # a sample is named by its normal map path
+        return [img_path[1] for img_path in self.data_paths]
+
     def __len__(self):
         return len(self.data_paths)
 
@@ -298,7 +302,7 @@ def test_lightings_loader(args, cls, split):
                                 pin_memory=True)
     elif split == 'test':
         dataset = TestLightings(cls, args.image_size, args.data_path)
-        data_loader = DataLoader(dataset=dataset, batch_size=1, shuffle=False, num_workers=args.workers, drop_last=False,
+        data_loader = DataLoader(dataset=dataset, batch_size=args.test_batch_size, shuffle=False, num_workers=args.workers, drop_last=False,
                                 pin_memory=True)
     return data_loader
 
@@ -395,6 +399,10 @@ class MVTec3DTrain(Dataset):
         tot_labels.extend([0] * len(sample_paths))
         return img_tot_paths, tot_labels
 
+    def sample_ids(self):
+        # a sample is named by its rgb image path
+        return [img_path[0] for img_path in self.img_paths]
+
     def __len__(self):
         return len(self.img_paths)
 
@@ -501,5 +509,23 @@ def mvtec3D_test_loader(args, class_name, split):
         data_loader = DataLoader(dataset=dataset, batch_size=args.batch_size, num_workers=args.workers, shuffle=False, drop_last=False, pin_memory=True)
     elif split == "test":
         dataset = MVTec3DTest(args.image_size, args.data_path, class_name=class_name)
-        data_loader = DataLoader(dataset=dataset, batch_size=1, num_workers=args.workers, shuffle=False, drop_last=False,pin_memory=True)
+        data_loader = DataLoader(dataset=dataset, batch_size=args.test_batch_size, num_workers=args.workers, shuffle=False, drop_last=False,pin_memory=True)
     return data_loader
+
+def memory_update_loader(args, cls, data_path, skip_ids=()):
+    '''
+    Memory split of another data root (same layout as data_path) for incremental memory bank updates.
+    Samples whose ID is in skip_ids are already in the bank and left out. Returns (data_loader, sample ids).
+    '''
+    if args.dataset_type == "eyecandies":
+        dataset = MemoryLightings(cls, args.image_size, data_path)
+    elif args.dataset_type == "mvtec3d":
+        dataset = MVTec3DTrain(img_size=args.image_size, dataset_path=data_path, class_name=cls, split='train', is_memory=True)
+    else:
+        raise ValueError(f"Memory bank updates are not supported for dataset type {args.dataset_type}")
+    skip_ids = set(skip_ids)
+    sample_ids = dataset.sample_ids()
+    indices = [i for i, sample_id in enumerate(sample_ids) if sample_id not in skip_ids]
+    sample_ids = [sample_ids[i] for i in indices]
+    data_loader = DataLoader(dataset=Subset(dataset, indices), batch_size=args.batch_size, num_workers=args.workers, shuffle=False, drop_last=False, pin_memory=True)
+    return data_loader, sample_ids
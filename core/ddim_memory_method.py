@@ -3,7 +3,13 @@ import torch.nn as nn
 from torchvision import transforms
 from core.base import DDIM_Method
 from utils.utils import t2np, nxn_cos_sim
+from utils.knn_util import knn_search, knn_graph, update_knn_graph, build_index, load_index, ExactIndex, ImagePrefilterIndex, ClusterIndex, LocalWindowIndex, QuantizedIndex, PQIndex
+from utils.projection_util import FeatureProjection
+from utils.gaussian_util import LocationGaussian
+from utils.mvtec3d_util import nmap_foreground, foreground_patches
+from utils.bank_util import ids_hash, save_memory_bank, load_memory_bank, load_bank_samples, QuantizedBank, PQBank, StreamingBank, sparse_projection, greedy_coreset
 from core.models.controllora import  ControlLoRAModel
+from core.models.kv_cache import enable_kv_cache
 from torch.optim.adam import Adam
 # from scipy.stats import wasserstein_distance
 # from scipy.spatial.distance import cdist
@@ -20,95 +26,778 @@ import matplotlib.pyplot as plt
 import ot
 
 import os
+import time
 import os.path as osp
 np.seterr(divide='ignore', invalid='ignore')
 
 class Memory_Method(DDIM_Method):
     def __init__(self, args, cls_path):
         super().__init__(args, cls_path)
-        self.f_coreset = 1
+        self.f_coreset = args.f_coreset
+        self.coreset_size = args.coreset_size
         self.coreset_eps = 0.9
+        # n_components of the coreset projection of each bank (0: full dimension), saved with it for extend_coreset
+        self.coreset_dims = {}
         self.n_reweight = 3
+        # n_reweight - 1 nearest other bank patches of every bank patch, built with the bank for reweight_scores
+        self.reweight_graphs = {}
+        self.knn_tile_size = args.knn_tile_size
+        self.index_type = args.index_type
+        self.ivf_nlist = args.ivf_nlist
+        self.ivf_nprobe = args.ivf_nprobe
+        self.graph_degree = args.graph_degree
+        self.graph_ef = args.graph_ef
+        self.index_report = args.index_report
+        self.index_stats = {"recall": [], "index_time": [], "exact_time": []}
+        # scoring (search + score maps) time of the test images, reported per --test_batch_size
+        self.score_stats = {"images": 0, "time": 0.0}
+        self.test_batch_size = args.test_batch_size
+        self.bank_precision = args.bank_precision
+        self.rerank_k = args.rerank_k
+        self.cascade_k = args.cascade_k
+        # UNet forwards of the DDIM inversions: loop steps and early-exit feature forwards
+        self.unet_forwards = {"loop": 0, "feature": 0}
+        # score maps are built on demand, the visualization needs all of them
+        self.image_score_only = args.image_score_only and not args.viz
+        self.map_threshold = args.map_threshold
+        self.pq_m = args.pq_m
+        self.prefilter_images = args.prefilter_images
+        self.local_window = args.local_window
+        self.local_fallback = args.local_fallback
+        self.n_clusters = args.n_clusters
+        self.route_clusters = args.route_clusters
+        self.projection = args.projection
+        self.proj_dim = args.proj_dim
+        self.pca_patches = args.pca_patches
+        self.projections = {}  # modality -> FeatureProjection
+        self.fg_mask = args.fg_mask
+        if self.fg_mask and args.dataset_type != "mvtec3d":
+            raise ValueError("The foreground mask is derived from the MVTec 3D normal maps")
+        routed = [self.prefilter_images > 0, self.local_window > 0, self.n_clusters > 1]
+        if self.bank_precision != "fp32" and self.index_type != "exact":
+            raise ValueError("Reduced precision memory banks only support the exact index")
+        if self.bank_precision != "fp32" and any(routed):
+            raise ValueError("The training image prefilter, the local window search and the clustered bank need a float32 memory bank")
+        if sum(routed) > 1:
+            raise ValueError("Choose one of the training image prefilter, the local window search and the clustered bank")
+        self.args = args
+        self.bank_header = None
         self.target_timestep = max(args.noise_intensity)
         # print(self.target_timestep)
         self.patch_lib = []
         self.nmap_patch_lib = []
+        self.patch_index = None
+        self.nmap_patch_index = None
+        # IDs of the training samples, the sample number and feature map position of every bank patch
+        # and the pooled descriptor of every sample
+        self.sample_ids = []
+        # sample IDs of the training split, part of the bank header
+        self.train_ids = []
+        self.patch_lib_samples = None
+        self.nmap_patch_lib_samples = None
+        self.patch_lib_positions = None
+        self.nmap_patch_lib_positions = None
+        self.feature_map_dims = None
+        self.patch_lib_descs = None
+        self.nmap_patch_lib_descs = None
+        # (B, 1, S, S) foreground pixels of every memory batch, until run_coreset drops the background patches
+        self.fg_pixels = []
+        # budgeted banks filled batch by batch during fit, see memorize
+        self.bank_budget = args.bank_budget
+        self.dup_threshold = args.dup_threshold
+        self.streams = {}
+        self.n_streamed = 0
+        # accepted patches each budgeted bank stands for, the reservoir of update_bank goes on from there
+        self.stream_seen = {}
         
-        
-    def compute_s_s_map(self, patch, patch_lib, feature_map_dims, p=2, k=1):
-        _, _, C, _, _ = patch.shape
-        target_patch_lib = patch_lib[-1].permute(1, 0, 2, 3).reshape(C, -1).T.to(self.device)
-        target_patch = patch[-1].permute(1, 0, 2, 3).reshape(C, -1).T.to(self.device)
-       
-        # target_patch_lib = patch_lib[-1].to(self.device)
-        # target_patch = patch[-1].to(self.device)
-        dist = torch.cdist(target_patch, target_patch_lib, p=p)
-        smap, min_idx = torch.topk(dist, k=k, largest=False)
-        smap = smap[:, -1]
-        min_idx = min_idx[:, -1]
-        min_idx = min_idx.to('cpu')
+    def reshape_patches(self, unet_fs):
+        # (timesteps, B, C, H, W) -> (timesteps, B * H * W, C)
+        T, _, C, _, _ = unet_fs.shape
+        return unet_fs.permute(0, 1, 3, 4, 2).reshape(T, -1, C)
+
+    def to_device_bank(self, patch_lib, fp32_copy=None, pq_state=None):
+        # Keep the fitted bank on the compute device so scoring never moves it again
+        if self.bank_precision == "fp32":
+            return patch_lib.to(self.device)
+        elif self.bank_precision == "pq":
+            pq_state = pq_state or {}
+            return PQBank(patch_lib, self.pq_m, self.device, fp32_copy=fp32_copy,
+                          codebooks=pq_state.get("codebooks"), codes=pq_state.get("codes"))
+        return QuantizedBank(patch_lib, self.bank_precision, self.device, fp32_copy=fp32_copy)
+
+    def build_index(self, patch_lib):
+        if isinstance(patch_lib, PQBank):
+            return PQIndex(patch_lib, rerank_k=self.rerank_k, tile_size=self.knn_tile_size)
+        elif isinstance(patch_lib, QuantizedBank):
+            return QuantizedIndex(patch_lib, rerank_k=self.rerank_k, tile_size=self.knn_tile_size)
+        # Search runs on the target (last) timestep slice
+        return build_index(self.index_type, patch_lib[-1], tile_size=self.knn_tile_size,
+                           nlist=self.ivf_nlist, nprobe=self.ivf_nprobe, degree=self.graph_degree, ef=self.graph_ef)
+
+    def image_descs(self, patch_lib, n_samples):
+        # (timesteps, n_samples * H * W, C) features of whole samples -> (n_samples, C) mean of the target slice
+        return patch_lib[-1].reshape(n_samples, -1, patch_lib.shape[-1]).mean(dim=1).to(self.device)
+
+    def project_features(self, features, modality="rgb"):
+        # (B, C, H, W) features on the compute device -> (B, proj_dim, H, W). A "pca" projection is fitted on the
+        # first pca_patches memory patches: until fit_projections fits it, the memory features only go into its
+        # statistics and are kept in the full dimension
+        if self.projection == "none":
+            return features
+        if modality not in self.projections:
+            self.projections[modality] = FeatureProjection(self.projection, self.proj_dim, self.device)
+        projection = self.projections[modality]
+        features = features.to(self.device)
+        if projection.kind == "pca" and not projection.fitted:
+            projection.update(features)
+            return features
+        return projection(features)
+
+    def pending_projection(self):
+        return any(not projection.fitted for projection in self.projections.values())
+
+    def fit_projections(self, force=False):
+        # fit the pca projections that have seen pca_patches memory patches (all of them at the end of the split,
+        # force) and project the memory batches kept in the full dimension until then
+        for modality, name in (("rgb", "patch_lib"), ("nmap", "nmap_patch_lib")):
+            projection = self.projections.get(modality)
+            if projection is None or projection.fitted or (projection.n < self.pca_patches and not force):
+                continue
+            projection.fit()
+            # (timesteps, B, C, H, W) batches, projected one timestep slice at a time on the device
+            setattr(self, name, [torch.stack([projection(x.to(self.device)).to(x.device) for x in batch])
+                                 for batch in getattr(self, name)])
+
+    def add_foreground_mask(self, nmap):
+        if self.fg_mask:
+            self.fg_pixels.append(nmap_foreground(nmap.cpu()))
+
+    def foreground_mask(self, nmap, feature_map_dims):
+        # (B, H, W) foreground patches of a test batch, None when every patch is scored
+        if not self.fg_mask:
+            return None
+        return foreground_patches(nmap_foreground(nmap), feature_map_dims)
+
+    def drop_background(self, patch_lib, samples, positions, fg_pixels):
+        # (timesteps, N, C) bank of whole samples -> only the patches with foreground pixels
+        if not fg_pixels:
+            return patch_lib, samples, positions
+        keep = foreground_patches(torch.cat(fg_pixels), self.feature_map_dims).reshape(-1)
+        print(f"Foreground: {patch_lib.shape[1]} -> {int(keep.sum())} patches")
+        return patch_lib[:, keep], samples[keep], positions[keep]
+
+    def wrap_index(self, index, patch_lib, samples, positions, descs):
+        # two-stage search modes that run on top of the bank index
+        if self.prefilter_images > 0:
+            if descs is None:
+                raise ValueError("The memory bank has no image descriptors, refit it to use the training image prefilter")
+            return ImagePrefilterIndex(index, patch_lib[-1], samples, descs.to(self.device), n_images=self.prefilter_images)
+        if self.local_window > 0:
+            if positions is None:
+                raise ValueError("The memory bank has no patch positions, refit it to use the local window search")
+            return LocalWindowIndex(index, patch_lib[-1], positions, self.feature_map_dims, window=self.local_window,
+                                    fallback=self.local_fallback, tile_size=self.knn_tile_size)
+        return index
+
+    def sync_time(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def search_index(self, index, query, patch_lib, k=1, n_images=1):
+        # query holds the patches of n_images images, the prefilter picks training images per query image
+        search = lambda: index.search_images(query, n_images, k=k) if isinstance(index, (ImagePrefilterIndex, ClusterIndex, LocalWindowIndex)) else index.search(query, k=k)
+        if not self.index_report or isinstance(index, ExactIndex):
+            return search()
+        # Recall and latency of the approximate index against an exact scan of the same bank
+        start = self.sync_time()
+        knn_dist, knn_idx = search()
+        index_time = self.sync_time() - start
+        exact_index = ExactIndex(patch_lib[-1], tile_size=self.knn_tile_size)
+        start = self.sync_time()
+        _, exact_idx = exact_index.search(query, k=k)
+        exact_time = self.sync_time() - start
+        self.index_stats["recall"].append((knn_idx[:, -1] == exact_idx[:, -1]).float().mean().item())
+        self.index_stats["index_time"].append(index_time)
+        self.index_stats["exact_time"].append(exact_time)
+        return knn_dist, knn_idx
+
+    def get_index_report(self):
+        if not self.index_stats["recall"]:
+            return None
+        index_type = self.index_type
+        if self.prefilter_images > 0:
+            index_type += f' + {self.prefilter_images} image prefilter'
+        elif self.local_window > 0:
+            index_type += f' + {self.local_window}x{self.local_window} local window'
+        elif self.n_clusters > 1:
+            index_type += f' + {self.route_clusters} of {self.n_clusters} clusters'
+        return (f'Index: {index_type}, Recall: {np.mean(self.index_stats["recall"]):.4f}, '
+                f'Search: {np.mean(self.index_stats["index_time"]) * 1000:.2f} ms, '
+                f'Exact Search: {np.mean(self.index_stats["exact_time"]) * 1000:.2f} ms')
+
+    def get_throughput_report(self, n_images, predict_time):
+        report = f'Throughput: test_batch_size {self.test_batch_size}, {n_images / predict_time:.2f} images/s'
+        if self.score_stats["images"]:
+            report += f', scoring {self.score_stats["images"] / self.score_stats["time"]:.2f} images/s'
+        return report
+
+    def compute_s_s_map(self, patch, patch_lib, feature_map_dims, p=2, k=1, index=None, fg_mask=None, bank_name="patch_lib"):
+        s_star, smap = self.compute_s_s_map_batch(patch, patch_lib, feature_map_dims, p=p, k=k, index=index, fg_mask=fg_mask,
+                                                  full_maps=True, bank_name=bank_name)
+        return s_star[0], smap[0]
+
+    def compute_s_s_map_batch(self, patch, patch_lib, feature_map_dims, p=2, k=1, index=None, fg_mask=None, full_maps=False,
+                              bank_name="patch_lib"):
+        # Score the B images of patch (timesteps, B, C, H, W) with one nearest neighbour search over all of their patches.
+        # bank_name ("patch_lib" or "nmap_patch_lib") names the bank patch_lib is, e.g. for its reweight graph
+        start = time.perf_counter()
+        s_star, smap = self.patch_scores(patch, patch_lib, p=p, k=k, index=index, fg_mask=fg_mask, bank_name=bank_name)
+        s_star = s_star.to('cpu')
+        if full_maps or not self.image_score_only:
+            smap = self.upsample_smap(smap, feature_map_dims)
+        else:
+            smap = self.maps_on_demand(s_star, [smap], feature_map_dims)[0]
+        # the results are on the CPU, so the device work is done
+        self.score_stats["images"] += patch.shape[1]
+        self.score_stats["time"] += time.perf_counter() - start
+        return s_star, smap
+
+    def compute_s_s_map_pair(self, patches, patch_libs, feature_map_dims, indexes=(None, None), fg_mask=None, score_weights=(1, 1),
+                             bank_names=("patch_lib", "nmap_patch_lib")):
+        '''
+        Score the RGB and normal map features of the same B images: each bank is searched with its own index, then
+        both (B, H * W) patch score maps are upsampled, blurred and moved to the CPU together. Returns the RGB, Nmap
+        and combined image scores and score maps, the combined score weighted by score_weights.
+        '''
+        start = time.perf_counter()
+        scores = [self.patch_scores(patch, patch_lib, index=index, fg_mask=fg_mask, bank_name=bank_name)
+                  for patch, patch_lib, index, bank_name in zip(patches, patch_libs, indexes, bank_names)]
+        s_stars = [s_star.to('cpu') for s_star, _ in scores]
+        s = sum(weight * s_star for weight, s_star in zip(score_weights, s_stars))
+        if self.image_score_only:
+            smaps = self.maps_on_demand(s, [smap for _, smap in scores], feature_map_dims)
+            smaps = (*smaps, [None if maps[0] is None else sum(maps) for maps in zip(*smaps)])
+        else:
+            smaps = self.upsample_smap(torch.cat([smap for _, smap in scores]), feature_map_dims).chunk(len(scores))
+            smaps = (*smaps, sum(smaps))
+        self.score_stats["images"] += patches[0].shape[1]
+        self.score_stats["time"] += time.perf_counter() - start
+        return (*s_stars, s), smaps
+
+    def maps_on_demand(self, s_star, smaps, feature_map_dims):
+        # --image_score_only: full-resolution maps only of the images scoring above map_threshold, None for the others
+        # s_star (B,) on the CPU, smaps a list of (B, H * W) patch scores of the same images
+        keep = (s_star > self.map_threshold).nonzero().squeeze(1)
+        maps = [[None] * len(s_star) for _ in smaps]
+        if len(keep):
+            full = self.upsample_smap(torch.cat([smap[keep.to(smap.device)] for smap in smaps]), feature_map_dims).chunk(len(smaps))
+            for modality_maps, modality_full in zip(maps, full):
+                for i, smap in zip(keep.tolist(), modality_full):
+                    modality_maps[i] = smap
+        return maps
+
+    def patch_scores(self, patch, patch_lib, p=2, k=1, index=None, fg_mask=None, bank_name="patch_lib"):
+        # (timesteps, B, C, H, W) -> (B,) image scores and (B, H * W) patch scores, both on self.device
+        # patch_lib is already resident on self.device (see run_coreset), only the query is transferred
+        # fg_mask (B, H, W) restricts the search to the foreground patches, background patches score 0
+        B = patch.shape[1]
+        patch = self.reshape_patches(patch).to(self.device)
+        target_patch = patch[-1]
+        if index is None:
+            index = self.build_index(patch_lib)
+        fg = None if fg_mask is None else fg_mask.reshape(-1).to(self.device)
+        # the per-image search modes need the full grid of every query image
+        search_fg = fg is not None and not isinstance(index, (ImagePrefilterIndex, ClusterIndex, LocalWindowIndex))
+        query = target_patch[fg] if search_fg else target_patch
+
+        # with several timesteps the k-th neighbour and the next cascade_k - 1 are candidates for rerank_timesteps
+        n_search = k if len(patch_lib) == 1 else k + self.cascade_k - 1
+        if p == 2:
+            dist, idx = self.search_index(index, query, patch_lib, k=n_search, n_images=B)
+        else:
+            dist, idx = knn_search(query, patch_lib[-1], k=n_search, tile_size=self.knn_tile_size, p=p)
+        if search_fg:
+            dist = dist.new_zeros(len(target_patch), n_search).index_put_((fg,), dist)
+            idx = idx.new_zeros(len(target_patch), n_search).index_put_((fg,), idx)
+        smap, min_idx = dist[:, k - 1], idx[:, k - 1]
         if len(patch_lib) > 1:
-            mul_smap = self.pdist(patch.to(self.device), patch_lib[:, min_idx, :].to(self.device))
-            smap, _ = torch.max(mul_smap, dim=0)
+            smap, min_idx = self.rerank_timesteps(patch, patch_lib, idx[:, k - 1:])
+        if fg is not None:
+            smap = smap.masked_fill(~fg, 0)
+        smap = smap.view(B, -1)
+        min_idx = min_idx.view(B, -1)
         #s_star = torch.max(smap)
-        topk_value, _ = torch.topk(smap, k=self.topk)
-        s_star = torch.mean(topk_value)
+        topk_value, _ = torch.topk(smap, k=self.topk, dim=1)
+        s_star = torch.mean(topk_value, dim=1)
         if self.reweight:
-            s_idx = torch.argmax(smap)
-            m_test = target_patch[s_idx].unsqueeze(0)  # anomalous patch
-            m_star = target_patch_lib[min_idx[s_idx]].unsqueeze(0)  # closest neighbour
-            w_dist = torch.cdist(m_star, target_patch_lib)  # find knn to m_star pt.1
-            _, nn_idx = torch.topk(w_dist, k=self.n_reweight, largest=False)  # pt.2
-
-            m_star_knn = torch.linalg.norm(m_test - target_patch_lib[nn_idx[0, 1:]], dim=1)
-            D = torch.sqrt(torch.tensor(target_patch.shape[1]))
-            w = 1 - (torch.exp(s_star / D) / (torch.sum(torch.exp(m_star_knn / D)) + 1e-5))
-            s_star = w * s_star
-        smap = smap.view(1, 1, *feature_map_dims)
+            s_star = self.reweight_scores(s_star, smap, target_patch.view(B, -1, target_patch.shape[-1]), min_idx, patch_lib,
+                                          self.reweight_graphs[bank_name])
+        return s_star, smap
+
+    def upsample_smap(self, smap, feature_map_dims):
+        # (B, H * W) patch scores -> (B, 1, image_size, image_size) blurred score maps on the CPU
+        B = smap.shape[0]
+        smap = smap.view(B, 1, *feature_map_dims)
         smap = torch.nn.functional.interpolate(smap, size=(self.image_size, self.image_size), mode='bilinear')
-        smap = self.blur(smap.to('cpu'))
+        if self.pil_blur:
+            smap = smap.to('cpu')
+            return torch.stack([self.blur(smap[b:b + 1]) for b in range(B)])
+        return self.blur(smap).to('cpu')
+
+    def rerank_timesteps(self, patch, patch_lib, candidates):
+        # patch (timesteps, N, C), candidates (N, c) bank rows found on the target slice. A candidate scores the max
+        # of its distances over all timestep slices, computed for every candidate in one batched norm, and each
+        # patch keeps the candidate with the lowest score. Like the search, a chunk gathers at most knn_tile_size
+        # bank rows (of all timesteps)
+        T, N, C = patch.shape
+        chunk = max(1, self.knn_tile_size // candidates.shape[1]) if self.knn_tile_size > 0 else max(1, N)
+        smap, min_idx = [], []
+        for start in range(0, N, chunk):
+            cand = candidates[start:start + chunk]
+            lib = patch_lib[:, cand.reshape(-1)].view(T, *cand.shape, C)
+            score = torch.linalg.vector_norm(patch[:, start:start + chunk].unsqueeze(2) - lib, dim=-1).amax(dim=0)
+            score, best = score.min(dim=1)
+            smap.append(score)
+            min_idx.append(cand.gather(1, best.unsqueeze(1)).squeeze(1))
+        return torch.cat(smap), torch.cat(min_idx)
+
+    def reweight_scores(self, s_star, smap, target_patch, min_idx, patch_lib, graph):
+        # s_star (B,), smap and min_idx (B, H * W), target_patch (B, H * W, C), all B images at once,
+        # graph the (N, n_reweight - 1) reweight graph of patch_lib
+        images = torch.arange(len(s_star), device=smap.device)
+        s_idx = torch.argmax(smap, dim=1)
+        m_test = target_patch[images, s_idx]  # anomalous patch
+        nn_idx = graph[min_idx[images, s_idx]]  # knn of its closest neighbour m_star
+        m_star_knn = torch.linalg.norm(m_test.unsqueeze(1) - patch_lib[-1, nn_idx.reshape(-1)].view(*nn_idx.shape, -1), dim=2)
+        D = torch.sqrt(torch.tensor(target_patch.shape[-1]))
+        w = 1 - (torch.exp(s_star / D) / (torch.sum(torch.exp(m_star_knn / D), dim=1) + 1e-5))
+        return w * s_star
+
+    def build_reweight_graphs(self):
+        if not self.reweight:
+            return
+        # always exact: an approximate (e.g. IVF) index would miss true neighbours of the graph
+        for name, patch_lib in (("patch_lib", self.patch_lib), ("nmap_patch_lib", self.nmap_patch_lib)):
+            if not len(patch_lib):
+                continue
+            lib = patch_lib[-1].to(self.device)
+            self.reweight_graphs[name] = knn_graph(ExactIndex(lib, tile_size=self.knn_tile_size), lib, self.n_reweight - 1)
+
+    def update_reweight_graph(self, name, patch_lib, keep):
+        # patch_lib = cat(old bank[:, keep], new patches) of update_patch_lib, only the rows whose neighbours
+        # changed are searched again
+        if not self.reweight:
+            return
+        lib = patch_lib[-1].to(self.device)
+        index = ExactIndex(lib, tile_size=self.knn_tile_size)
+        if name in self.reweight_graphs:
+            self.reweight_graphs[name] = update_knn_graph(index, lib, self.reweight_graphs[name], keep, tile_size=self.knn_tile_size)
+        else:
+            self.reweight_graphs[name] = knn_graph(index, lib, self.n_reweight - 1)
 
-        return s_star.to('cpu'), smap
+    def patch_samples(self, patch_lib, first=0):
+        # sample number and feature map position of every patch of a list of (timesteps, B, C, H, W) features,
+        # samples are numbered from first
+        n_samples = sum(unet_f.shape[1] for unet_f in patch_lib)
+        H, W = patch_lib[0].shape[-2:]
+        self.feature_map_dims = (H, W)
+        return torch.arange(first, first + n_samples).repeat_interleave(H * W), torch.arange(H * W).repeat(n_samples)
+
+    def memorize(self, lightings, nmap, text_prompt):
+        # one memory batch, with a bank budget it goes straight into the streaming banks
+        self.add_foreground_mask(nmap)
+        self.add_sample_to_mem_bank(lightings, nmap, text_prompt)
+        self.fit_projections()
+        # the batches kept in the full dimension for a pca projection are streamed once they are projected
+        if self.bank_budget > 0 and not self.pending_projection():
+            self.stream_batch()
+
+    def stream_batch(self):
+        n_samples = sum(batch.shape[1] for batch in self.patch_lib)
+        for name in ("patch_lib", "nmap_patch_lib"):
+            features = getattr(self, name)
+            if not features:
+                continue
+            samples, positions = self.patch_samples(features, first=self.n_streamed)
+            patch_lib = self.reshape_patches(torch.cat(features, 1))
+            descs = self.image_descs(patch_lib, n_samples)
+            patch_lib, samples, positions = self.drop_background(patch_lib, samples, positions, self.fg_pixels)
+            if name not in self.streams:
+                self.streams[name] = StreamingBank(self.bank_budget, self.dup_threshold, self.device, tile_size=self.knn_tile_size)
+            self.streams[name].add(patch_lib, samples, positions, descs)
+            setattr(self, name, [])
+        self.fg_pixels = []
+        self.n_streamed += n_samples
 
     def run_coreset(self):
-        self.patch_lib = torch.cat(self.patch_lib , 1)
-        if self.nmap_patch_lib:
-            self.nmap_patch_lib = torch.cat(self.nmap_patch_lib , 1)
+        self.fit_projections(force=True)
+        if self.bank_budget > 0 and self.patch_lib:
+            self.stream_batch()
+        if self.streams:
+            n_samples = self.n_streamed
+            self.patch_lib, self.patch_lib_samples, self.patch_lib_positions, self.patch_lib_descs = self.streams["patch_lib"].finish()
+            if "nmap_patch_lib" in self.streams:
+                (self.nmap_patch_lib, self.nmap_patch_lib_samples, self.nmap_patch_lib_positions,
+                 self.nmap_patch_lib_descs) = self.streams["nmap_patch_lib"].finish()
+            self.stream_seen = {name: stream.seen for name, stream in self.streams.items()}
+            self.streams, self.n_streamed = {}, 0
+        else:
+            self.patch_lib_samples, self.patch_lib_positions = self.patch_samples(self.patch_lib)
+            n_samples = len(torch.unique(self.patch_lib_samples))
+            self.patch_lib = self.reshape_patches(torch.cat(self.patch_lib, 1))
+            self.patch_lib_descs = self.image_descs(self.patch_lib, n_samples)
+            self.patch_lib, self.patch_lib_samples, self.patch_lib_positions = self.drop_background(
+                self.patch_lib, self.patch_lib_samples, self.patch_lib_positions, self.fg_pixels)
+            if self.nmap_patch_lib:
+                self.nmap_patch_lib_samples, self.nmap_patch_lib_positions = self.patch_samples(self.nmap_patch_lib)
+                self.nmap_patch_lib = self.reshape_patches(torch.cat(self.nmap_patch_lib, 1))
+                self.nmap_patch_lib_descs = self.image_descs(self.nmap_patch_lib, n_samples)
+                self.nmap_patch_lib, self.nmap_patch_lib_samples, self.nmap_patch_lib_positions = self.drop_background(
+                    self.nmap_patch_lib, self.nmap_patch_lib_samples, self.nmap_patch_lib_positions, self.fg_pixels)
+            self.fg_pixels = []
+        if len(self.sample_ids) != n_samples:
+            self.sample_ids = [str(i) for i in range(n_samples)]
+
+        if self.f_coreset < 1 or self.coreset_size > 0:
+            idx = self.get_coreset_idx(self.patch_lib, "patch_lib")
+            self.patch_lib, self.patch_lib_samples, self.patch_lib_positions = self.patch_lib[:, idx], self.patch_lib_samples[idx], self.patch_lib_positions[idx]
+            if len(self.nmap_patch_lib):
+                idx = self.get_coreset_idx(self.nmap_patch_lib, "nmap_patch_lib")
+                self.nmap_patch_lib, self.nmap_patch_lib_samples, self.nmap_patch_lib_positions = \
+                    self.nmap_patch_lib[:, idx], self.nmap_patch_lib_samples[idx], self.nmap_patch_lib_positions[idx]
+
+        # Reduced precision banks keep the float32 bank for re-ranking only until it has been saved to disk
+        self.patch_lib = self.to_device_bank(self.patch_lib, fp32_copy=self.patch_lib if self.args.bank_dir else None)
+        if len(self.nmap_patch_lib):
+            self.nmap_patch_lib = self.to_device_bank(self.nmap_patch_lib, fp32_copy=self.nmap_patch_lib if self.args.bank_dir else None)
+        self.patch_index = self.wrap_index(self.build_index(self.patch_lib), self.patch_lib, self.patch_lib_samples,
+                                           self.patch_lib_positions, self.patch_lib_descs)
+        if len(self.nmap_patch_lib):
+            self.nmap_patch_index = self.wrap_index(self.build_index(self.nmap_patch_lib), self.nmap_patch_lib, self.nmap_patch_lib_samples,
+                                                    self.nmap_patch_lib_positions, self.nmap_patch_lib_descs)
+        self.build_reweight_graphs()
+
+    def get_bank_header(self):
+        # Everything that changes the fitted bank. Checkpoints are identified by the content hashes of the run
+        # (args.ckpt_hashes) and the training split by the hash of its sample IDs (train_ids, set by the runner)
+        if self.bank_header is None:
+            args = self.args
+            self.bank_header = {
+                "method_name": args.method_name,
+                "dataset_type": args.dataset_type,
+                "data_path": os.path.abspath(args.data_path),
+                "train_samples": ids_hash(self.train_ids),
+                "diffusion_id": args.diffusion_id,
+                **args.ckpt_hashes,
+                "noise_intensity": list(args.noise_intensity),
+                "step_size": args.step_size,
+                "feature_layers": list(self.feature_layers),
+                "image_size": args.image_size,
+                "f_coreset": self.f_coreset,
+                "coreset_size": self.coreset_size,
+                "index_type": self.index_type,
+                "bank_precision": self.bank_precision,
+                "pq_m": self.pq_m if self.bank_precision == "pq" else 0,
+                "ivf_nlist": self.ivf_nlist if self.index_type == "ivf" else 0,
+                "graph_degree": self.graph_degree if self.index_type == "hnsw" else 0,
+                "projection": self.projection,
+                "proj_dim": self.proj_dim if self.projection != "none" else 0,
+                "pca_patches": self.pca_patches if self.projection == "pca" else 0,
+                "fg_mask": self.fg_mask,
+                "bank_budget": self.bank_budget,
+                "dup_threshold": self.dup_threshold if self.bank_budget > 0 else 0,
+            }
+        return self.bank_header
+
+    def bank_tensors(self):
+        # The float32 bank is always what goes to disk, it is the re-rank source of reduced precision banks
+        fp32 = lambda patch_lib: patch_lib.fp32_copy if isinstance(patch_lib, QuantizedBank) else patch_lib
+        tensors = {"patch_lib": fp32(self.patch_lib), "patch_lib_samples": self.patch_lib_samples,
+                   "patch_lib_positions": self.patch_lib_positions, "patch_lib_descs": self.patch_lib_descs}
+        if self.feature_map_dims is not None:
+            tensors["feature_map_dims"] = torch.tensor(self.feature_map_dims)
+        if len(self.nmap_patch_lib):
+            tensors["nmap_patch_lib"] = fp32(self.nmap_patch_lib)
+            tensors["nmap_patch_lib_samples"] = self.nmap_patch_lib_samples
+            tensors["nmap_patch_lib_positions"] = self.nmap_patch_lib_positions
+            tensors["nmap_patch_lib_descs"] = self.nmap_patch_lib_descs
+        for name, patch_lib in (("patch_lib", self.patch_lib), ("nmap_patch_lib", self.nmap_patch_lib)):
+            if isinstance(patch_lib, PQBank):
+                for key, value in patch_lib.state_dict().items():
+                    tensors[f"{name}.{key}"] = value
+        for name, index in (("patch_index", self.patch_index), ("nmap_patch_index", self.nmap_patch_index)):
+            if index is not None:
+                for key, value in index.state_dict().items():
+                    tensors[f"{name}.{key}"] = value
+        for modality, projection in self.projections.items():
+            for key, value in projection.state_dict().items():
+                tensors[f"projection.{modality}.{key}"] = value
+        for name, graph in self.reweight_graphs.items():
+            tensors[f"{name}_knn"] = graph
+        for name, n_components in self.coreset_dims.items():
+            tensors[f"{name}_coreset_dim"] = torch.tensor(n_components)
+        for name, seen in self.stream_seen.items():
+            tensors[f"{name}_seen"] = torch.tensor(seen)
+        return tensors
+
+    def save_fitted_bank(self, bank_dir):
+        save_memory_bank(bank_dir, self.get_bank_header(), self.bank_tensors(), samples=self.sample_ids)
+        if isinstance(self.patch_lib, QuantizedBank):
+            # re-rank from the memory-mapped file from now on instead of the in-RAM float32 bank
+            tensors = load_memory_bank(bank_dir, self.get_bank_header())
+            self.patch_lib.fp32_copy = tensors["patch_lib"]
+            if len(self.nmap_patch_lib):
+                self.nmap_patch_lib.fp32_copy = tensors["nmap_patch_lib"]
+
+    def load_fitted_bank(self, bank_dir):
+        tensors = load_memory_bank(bank_dir, self.get_bank_header())
+        if tensors is None:
+            return False
+        self.sample_ids = load_bank_samples(bank_dir)
+        self.patch_lib_samples = tensors.get("patch_lib_samples")
+        self.nmap_patch_lib_samples = tensors.get("nmap_patch_lib_samples")
+        self.patch_lib_positions = tensors.get("patch_lib_positions")
+        self.nmap_patch_lib_positions = tensors.get("nmap_patch_lib_positions")
+        self.patch_lib_descs = tensors.get("patch_lib_descs")
+        self.nmap_patch_lib_descs = tensors.get("nmap_patch_lib_descs")
+        if "feature_map_dims" in tensors:
+            self.feature_map_dims = tuple(tensors["feature_map_dims"].tolist())
+        for modality in {key.split(".")[1] for key in tensors if key.startswith("projection.")}:
+            state = {key.rsplit(".", 1)[1]: value.to(self.device) for key, value in tensors.items()
+                     if key.startswith(f"projection.{modality}.")}
+            self.projections[modality] = FeatureProjection(self.projection, self.proj_dim, self.device, **state)
+        # On CPU .to() is a no-op, so the bank stays memory-mapped
+        self.patch_lib = self.to_device_bank(tensors["patch_lib"], fp32_copy=tensors["patch_lib"],
+                                             pq_state=self.sub_state(tensors, "patch_lib"))
+        self.patch_index = self.wrap_index(self.restore_index(self.patch_lib, tensors, "patch_index"), self.patch_lib,
+                                           self.patch_lib_samples, self.patch_lib_positions, self.patch_lib_descs)
+        if "nmap_patch_lib" in tensors:
+            self.nmap_patch_lib = self.to_device_bank(tensors["nmap_patch_lib"], fp32_copy=tensors["nmap_patch_lib"],
+                                                      pq_state=self.sub_state(tensors, "nmap_patch_lib"))
+            self.nmap_patch_index = self.wrap_index(self.restore_index(self.nmap_patch_lib, tensors, "nmap_patch_index"), self.nmap_patch_lib,
+                                                    self.nmap_patch_lib_samples, self.nmap_patch_lib_positions, self.nmap_patch_lib_descs)
+        self.coreset_dims = {name: int(tensors[f"{name}_coreset_dim"]) for name in ("patch_lib", "nmap_patch_lib")
+                             if f"{name}_coreset_dim" in tensors}
+        self.stream_seen = {name: int(tensors[f"{name}_seen"]) for name in ("patch_lib", "nmap_patch_lib")
+                            if f"{name}_seen" in tensors}
+        self.reweight_graphs = {name: tensors[f"{name}_knn"].to(self.device) for name in ("patch_lib", "nmap_patch_lib")
+                                if f"{name}_knn" in tensors}
+        if "patch_lib" not in self.reweight_graphs:
+            self.build_reweight_graphs()
+        self.cluster_training_data()
+        return True
+
+    def sub_state(self, tensors, name):
+        return {key.split(".", 1)[1]: value.to(self.device) for key, value in tensors.items() if key.startswith(name + ".")}
+
+    def restore_index(self, patch_lib, tensors, name):
+        if isinstance(patch_lib, QuantizedBank):
+            return self.build_index(patch_lib)
+        state = self.sub_state(tensors, name)
+        return load_index(self.index_type, patch_lib[-1], state, tile_size=self.knn_tile_size, nprobe=self.ivf_nprobe, ef=self.graph_ef)
+
+    def get_coreset_idx(self, patch_lib, name):
+        # Select on all timestep slices at once so that the same index stays valid for the multi-timestep gather.
+        # patch_lib may be on the device (e.g. a streamed bank), the projection is fitted on a CPU copy
+        T, N, C = patch_lib.shape
+        n = self.coreset_size if self.coreset_size > 0 else int(self.f_coreset * N)
+        n = max(1, min(n, N))
+        z_lib = patch_lib.permute(1, 0, 2).reshape(N, T * C)
+        (z_lib,), self.coreset_dims[name] = sparse_projection([z_lib], eps=self.coreset_eps)
+        coreset_idx = greedy_coreset(z_lib, n=n, device=self.device)
+        print(f"Coreset: {N} -> {len(coreset_idx)} patches")
+        return coreset_idx
+
+    def update_bank(self, batches=(), add_ids=(), remove_ids=()):
+        '''
+        Incrementally update a fitted (e.g. loaded) bank: the (lightings, nmap, text_prompt) batches, whose samples are
+        named by add_ids, go through add_sample_to_mem_bank and are appended, and every patch of the samples in
+        remove_ids is retired. The coreset is extended greedily from the kept bank and the indexes are updated in
+        place of a rebuild, so only the new samples are run through the UNet.
+        '''
+        if self.patch_lib_samples is None:
+            raise ValueError("The memory bank has no sample ids, refit it before updating")
+        fitted = self.patch_lib, self.nmap_patch_lib
+        self.patch_lib, self.nmap_patch_lib, self.fg_pixels = [], [], []
+        for lightings, nmap, text_prompt in batches:
+            self.add_foreground_mask(nmap)
+            self.add_sample_to_mem_bank(lightings, nmap, text_prompt)
+        new_patch_lib, new_nmap_patch_lib, new_fg_pixels = self.patch_lib, self.nmap_patch_lib, self.fg_pixels
+        self.fg_pixels = []
+        self.patch_lib, self.nmap_patch_lib = fitted
+
+        remove_ids = set(remove_ids)
+        unknown = remove_ids - set(self.sample_ids)
+        if unknown:
+            print(f"Samples not in the memory bank: {sorted(unknown)}")
+        keep_samples = torch.tensor([sample_id not in remove_ids for sample_id in self.sample_ids], dtype=torch.bool)
+        renumber = torch.cumsum(keep_samples, 0) - 1
+        n_samples = len(self.sample_ids)
+        self.sample_ids = [sample_id for sample_id, keep in zip(self.sample_ids, keep_samples.tolist()) if keep] + list(add_ids)
+
+        self.patch_lib, self.patch_lib_samples, self.patch_lib_positions, self.patch_lib_descs, self.patch_index = self.update_patch_lib(
+            self.patch_lib, self.patch_lib_samples, self.patch_lib_positions, self.patch_lib_descs, self.patch_index,
+            new_patch_lib, new_fg_pixels, keep_samples, renumber, n_samples, "patch_lib")
+        if len(self.nmap_patch_lib):
+            (self.nmap_patch_lib, self.nmap_patch_lib_samples, self.nmap_patch_lib_positions, self.nmap_patch_lib_descs,
+             self.nmap_patch_index) = self.update_patch_lib(
+                self.nmap_patch_lib, self.nmap_patch_lib_samples, self.nmap_patch_lib_positions, self.nmap_patch_lib_descs,
+                self.nmap_patch_index, new_nmap_patch_lib, new_fg_pixels, keep_samples, renumber, n_samples, "nmap_patch_lib")
+        print(f"Memory bank: {n_samples} -> {len(self.sample_ids)} samples, {self.patch_lib.shape[1]} patches")
+        self.cluster_training_data()
+
+    def cluster_training_data(self):
+        # Partition the bank into sub-banks of training samples with similar pooled descriptors, queries are routed
+        # to the route_clusters nearest ones (see ClusterIndex)
+        if self.n_clusters <= 1:
+            return
+        self.patch_index = self.cluster_index(self.patch_index, self.patch_lib, self.patch_lib_samples, self.patch_lib_descs)
+        if len(self.nmap_patch_lib):
+            self.nmap_patch_index = self.cluster_index(self.nmap_patch_index, self.nmap_patch_lib, self.nmap_patch_lib_samples,
+                                                       self.nmap_patch_lib_descs)
+
+    def cluster_index(self, index, patch_lib, samples, descs):
+        if descs is None:
+            raise ValueError("The memory bank has no image descriptors, refit it to cluster the training data")
+        if isinstance(index, ClusterIndex):
+            index = index.index
+        n_clusters = min(self.n_clusters, descs.shape[0])
+        kmeans = KMeans(n_clusters=n_clusters, n_init=10, random_state=0).fit(t2np(descs))
+        labels = torch.from_numpy(kmeans.labels_).long()
+        print(f"Clusters: {torch.bincount(labels, minlength=n_clusters).tolist()} samples")
+        centroids = torch.from_numpy(kmeans.cluster_centers_).float().to(self.device)
+        return ClusterIndex(index, patch_lib[-1], labels[samples.long()], centroids, n_route=self.route_clusters, tile_size=self.knn_tile_size)
+
+    def update_patch_lib(self, patch_lib, samples, positions, descs, index, new_patch_lib, new_fg_pixels, keep_samples, renumber, n_samples,
+                         name):
+        # the updated bank is cat(patch_lib[:, keep], new patches), which is the layout index.update expects
+        keep = keep_samples[samples.long()]
+        keep_idx = keep.nonzero().squeeze(1)
+        descs = descs.to(self.device)[keep_samples.to(self.device)]
+        if new_patch_lib:
+            new_samples, new_positions = self.patch_samples(new_patch_lib, first=int(keep_samples.sum()))
+            n_new_samples = sum(unet_f.shape[1] for unet_f in new_patch_lib)
+            new_patch_lib = self.reshape_patches(torch.cat(new_patch_lib, 1))
+            new_descs = self.image_descs(new_patch_lib, n_new_samples)
+            descs = torch.cat([descs, new_descs])
+            new_patch_lib, new_samples, new_positions = self.drop_background(new_patch_lib, new_samples, new_positions, new_fg_pixels)
+            if self.f_coreset < 1 or self.coreset_size > 0:
+                idx = self.extend_coreset(patch_lib[:, keep_idx], new_patch_lib, n_samples, n_new_samples, name)
+                new_patch_lib, new_samples, new_positions = new_patch_lib[:, idx], new_samples[idx], new_positions[idx]
+            if self.bank_budget > 0:
+                keep, new_patch_lib, new_samples, new_positions = self.stream_update(
+                    patch_lib, keep, renumber[samples.long()], positions, new_patch_lib, new_samples, new_positions, new_descs, name)
+                keep_idx = keep.nonzero().squeeze(1)
+        else:
+            new_patch_lib = torch.zeros((patch_lib.shape[0], 0, patch_lib.shape[2]))
+            new_samples = new_positions = samples.new_zeros(0)
+        samples = renumber[samples[keep].long()]
+        positions = positions[keep]
+        samples = torch.cat([samples, new_samples])
+        positions = torch.cat([positions, new_positions])
+        if isinstance(index, (ImagePrefilterIndex, ClusterIndex, LocalWindowIndex)):
+            index = index.index
+
+        if isinstance(patch_lib, QuantizedBank):
+            fp32 = torch.cat([patch_lib[:, keep_idx].cpu(), new_patch_lib], dim=1)
+            pq_state = None
+            if isinstance(patch_lib, PQBank):
+                # keep the trained codebooks, only the new patches are encoded
+                new_codes = torch.stack([patch_lib.encode(new_patch_lib[t], patch_lib.codebooks[t]) for t in range(len(patch_lib))])
+                pq_state = {"codebooks": patch_lib.codebooks,
+                            "codes": torch.cat([patch_lib.codes[:, keep_idx.to(self.device)], new_codes], dim=1)}
+            patch_lib = self.to_device_bank(fp32, fp32_copy=fp32, pq_state=pq_state)
+            self.update_reweight_graph(name, patch_lib, keep)
+            return patch_lib, samples, positions, descs, self.build_index(patch_lib)
+
+        patch_lib = torch.cat([patch_lib[:, keep_idx.to(patch_lib.device)].to(self.device), new_patch_lib.to(self.device)], dim=1)
+        index = self.wrap_index(index.update(patch_lib[-1], keep.to(self.device)), patch_lib, samples, positions, descs)
+        self.update_reweight_graph(name, patch_lib, keep)
+        return patch_lib, samples, positions, descs, index
+
+    def stream_update(self, patch_lib, keep, samples, positions, new_patch_lib, new_samples, new_positions, new_descs, name):
+        '''
+        Budget of an updated bank: the kept patches go back into a StreamingBank, which stood for stream_seen accepted
+        patches before the removed samples (scaled down by the patches they held), and the new patches are added to it,
+        so they are deduplicated and kept by reservoir sampling like during fit. Returns the kept mask over the rows of
+        patch_lib, without the patches the new ones replaced, and the new patches that went in.
+        '''
+        keep_idx = keep.nonzero().squeeze(1)
+        n_kept = len(keep_idx)
+        seen = round(self.stream_seen.get(name, 0) * n_kept / max(1, len(keep)))
+        stream = StreamingBank(self.bank_budget, self.dup_threshold, self.device, tile_size=self.knn_tile_size, seed=len(self.sample_ids))
+        stream.resume(patch_lib[:, keep_idx.to(patch_lib.device)], samples[keep], positions[keep], seen=seen)
+        stream.add(new_patch_lib, new_samples, new_positions, new_descs)
+        self.stream_seen[name] = stream.seen
+        rows = stream.rows[:stream.size]
+        keep = torch.zeros_like(keep)
+        keep[keep_idx[rows[rows < n_kept]]] = True
+        slots = (rows >= n_kept).nonzero().squeeze(1)
+        print(f"Streaming bank: {stream.size} of {stream.seen} accepted patches kept, {len(slots)} new")
+        return keep, stream.patch_lib[:, slots.to(self.device)].cpu(), stream.samples[slots], stream.positions[slots]
+
+    def extend_coreset(self, patch_lib, new_patch_lib, n_samples, n_new_samples, name):
+        # greedy k-center over the new patches, starting from the patches already in the bank, at the compression
+        # ratio of the fitted bank and in the projected space its coreset was selected in (coreset_dims). A bank saved
+        # without its coreset_dims gets a new projection of the same eps
+        T, N, C = new_patch_lib.shape
+        n_full = n_samples * N // n_new_samples
+        ratio = min(1, self.coreset_size / n_full) if self.coreset_size > 0 else self.f_coreset
+        n = max(1, min(int(ratio * N), N))
+        z_libs = [new_patch_lib.permute(1, 0, 2).reshape(N, T * C)]
+        if patch_lib.shape[1] > 0:
+            z_libs.append(patch_lib.permute(1, 0, 2).reshape(patch_lib.shape[1], T * C))
+        z_libs, self.coreset_dims[name] = sparse_projection(z_libs, eps=self.coreset_eps,
+                                                            n_components=self.coreset_dims.get(name, "auto"))
+        min_distances = None
+        if len(z_libs) > 1:
+            min_distances = knn_search(z_libs[0].to(self.device), z_libs[1].to(self.device), k=1, tile_size=self.knn_tile_size)[0]
+        coreset_idx = greedy_coreset(z_libs[0], n=n, device=self.device, min_distances=min_distances)
+        print(f"Coreset: {N} -> {len(coreset_idx)} new patches")
+        return coreset_idx
 
     @torch.no_grad()
     def ddim_loop(self, latents, text_emb):
+        # yields (t, latent) on the device for every mul_timesteps entry, the features of a latent are extracted before
+        # the loop goes on. The loop evaluates the UNet on the latent before each step and the features are those of
+        # the latent after it at the same t, so no loop forward can be reused and the extra forward is an early-exit one
         self.noise_scheduler.set_timesteps(self.num_inference_timesteps, device=self.device)
-        latent_list = []
-        t_list = []
+        latents = latents.to(self.device)
         for t in reversed(self.timesteps_list):
-            noise_pred = self.unet(latents.to(self.device), t, text_emb)['sample']
+            noise_pred = self.unet(latents, t, text_emb)['sample']
+            self.unet_forwards["loop"] += 1
             latents = self.next_step(noise_pred, t, latents)
             if t in self.mul_timesteps:
-                latent_list.append(latents.to('cpu'))
-                t_list.append(t)
-        return latent_list, t_list
+                yield t, latents
     
+    def get_forward_report(self):
+        if not self.unet_forwards["feature"]:
+            return None
+        return (f'UNet forwards: {self.unet_forwards["loop"]} DDIM steps, {self.unet_forwards["feature"]} feature forwards '
+                f'stopped after up block {max(self.feature_layers)}')
+
     @torch.no_grad()
     def get_feature_layers(self, latent, t, text_emb):
-        pred_f = self.unet(latent.to(self.device), t, text_emb)['up_ft']
+        pred_f = self.unet.extract_features(latent.to(self.device), t, text_emb, self.feature_layers)
+        self.unet_forwards["feature"] += 1
         resized_f = []
-        for i in range(len(pred_f)):
-            if i in self.feature_layers:
-                largest_fmap_size = pred_f[self.feature_layers[-1]].shape[-2:]
-                resized_f.append(torch.nn.functional.interpolate(pred_f[i], largest_fmap_size, mode='bicubic').to('cpu'))
+        for i in sorted(pred_f):
+            largest_fmap_size = pred_f[self.feature_layers[-1]].shape[-2:]
+            resized_f.append(torch.nn.functional.interpolate(pred_f[i], largest_fmap_size, mode='bicubic'))
         features = torch.cat(resized_f, dim=1)
         return features
         
     @torch.no_grad() 
-    def get_unet_f(self, latents, text_emb, islighting=True):
-        latent_list, t_list = self.ddim_loop(latents, text_emb)
+    def get_unet_f(self, latents, text_emb, islighting=True, modality="rgb"):
         unetf_list = []
-        for i, t in enumerate(t_list):
+        for t, latent in self.ddim_loop(latents, text_emb):
 
-            unet_f = self.get_feature_layers(latent_list[i], t, text_emb)
+            unet_f = self.get_feature_layers(latent, t, text_emb)
             B, C, H, W = unet_f.shape
             if islighting and self.data_type=="eyecandies":
                 unet_f = torch.mean(unet_f.view(-1, 6, C, H, W), dim=1)
+            unet_f = self.project_features(unet_f, modality)
             # unet_f = unet_f.permute(1, 0, 2, 3).reshape(C, -1).T
             unetf_list.append(unet_f.to('cpu'))
 
@@ -136,16 +825,15 @@ class DDIM_Memory(Memory_Method):
         unet_f = model_output['up_ft'][3]
         B, C, H, W = unet_f.shape
         
-        train_unet_f = torch.mean(unet_f.view(-1, 6, C, H, W), dim=1)
-        train_unet_f = train_unet_f.permute(1, 0, 2, 3).reshape(C, -1).T
-        self.patch_lib.append(train_unet_f.cpu())
+        train_unet_f = self.project_features(torch.mean(unet_f.view(-1, 6, C, H, W), dim=1))
+        self.patch_lib.append(train_unet_f.unsqueeze(0).cpu())
     
     def predict(self, i, lightings, nmap, text_prompt, gt, label):
         lightings = lightings.to(self.device)
         lightings = lightings.reshape(-1, 3, self.image_size, self.image_size)
     
         latents = self.image2latents(lightings)
-        cond_embeddings = self.get_text_embedding(text_prompt, 6)
+        cond_embeddings = self.get_text_embedding(text_prompt, latents.shape[0])
 
     
         _, timesteps, noisy_latents = self.forward_process_with_T(latents, self.timesteps_list[-1])
@@ -159,16 +847,19 @@ class DDIM_Memory(Memory_Method):
         unet_f = model_output['up_ft'][3]
         B, C, H, W = unet_f.shape
         
-        test_unet_f = torch.mean(unet_f.view(-1, 6, C, H, W), dim=1)
-        test_unet_f = test_unet_f.permute(1, 0, 2, 3).reshape(C, -1).T
+        test_unet_f = self.project_features(torch.mean(unet_f.view(-1, 6, C, H, W), dim=1)).unsqueeze(0)
 
-        s, smap = self.compute_s_s_map(test_unet_f, self.patch_lib, unet_f.shape[-2:])
-        img = lightings[5, :, :, :]
-        self.image_labels.append(label.numpy())
-        self.image_preds.append(s.numpy())
-        self.image_list.append(t2np(img))
-        self.pixel_preds.append(t2np(smap))
-        self.pixel_labels.extend(t2np(gt))
+        s, smap = self.compute_s_s_map_batch(test_unet_f, self.patch_lib, unet_f.shape[-2:], index=self.patch_index)
+        imgs = lightings.view(label.shape[0], -1, 3, self.image_size, self.image_size)
+        for b in range(label.shape[0]):
+            img = imgs[b, 5, :, :, :]
+            self.image_labels.append(label[b:b + 1].numpy())
+            self.image_preds.append(s[b].numpy())
+            self.pixel_preds.append(t2np(smap[b]))
+            if smap[b] is not None:
+                # --image_score_only keeps the image and ground truth only with its score map
+                self.image_list.append(t2np(img))
+                self.pixel_labels.extend(t2np(gt[b:b + 1]))
 
 class DDIMInvRGB_Memory(Memory_Method):
     def __init__(self, args, cls_path):
@@ -189,16 +880,20 @@ class DDIMInvRGB_Memory(Memory_Method):
         #lightings = lightings.reshape(-1, 3, self.image_size, self.image_size)
         
         latents = self.image2latents(lightings)
-        text_emb = self.get_text_embedding(text_prompt, 1)
+        text_emb = self.get_text_embedding(text_prompt, latents.shape[0])
         unet_f = self.get_unet_f(latents, text_emb, islighting=False)
         
-        s, smap = self.compute_s_s_map(unet_f, self.patch_lib, latents.shape[-2:])
-        img = lightings[0]
-        self.image_labels.append(label.numpy())
-        self.image_preds.append(s.numpy())
-        self.image_list.append(t2np(img))
-        self.pixel_preds.append(t2np(smap))
-        self.pixel_labels.extend(t2np(gt))
+        s, smap = self.compute_s_s_map_batch(unet_f, self.patch_lib, latents.shape[-2:], index=self.patch_index,
+                                             fg_mask=self.foreground_mask(nmap, latents.shape[-2:]))
+        for b in range(label.shape[0]):
+            img = lightings[b]
+            self.image_labels.append(label[b:b + 1].numpy())
+            self.image_preds.append(s[b].numpy())
+            self.pixel_preds.append(t2np(smap[b]))
+            if smap[b] is not None:
+                # --image_score_only keeps the image and ground truth only with its score map
+                self.image_list.append(t2np(img))
+                self.pixel_labels.extend(t2np(gt[b:b + 1]))
 
 class DDIMInvNmap_Memory(Memory_Method):
     def __init__(self, args, cls_path):
@@ -218,15 +913,20 @@ class DDIMInvNmap_Memory(Memory_Method):
         nmap = nmap.to(self.device)
         lightings = lightings.reshape(-1, 3, self.image_size, self.image_size)
         latents = self.image2latents(nmap)
-        text_emb = self.get_text_embedding(text_prompt, 1)
+        text_emb = self.get_text_embedding(text_prompt, latents.shape[0])
         unet_f = self.get_unet_f(latents, text_emb, islighting=False)
-        s, smap = self.compute_s_s_map(unet_f, self.patch_lib, latents.shape[-2:])
-        img = lightings[5, :, :, :]
-        self.image_labels.append(label.numpy())
-        self.image_preds.append(s.numpy())
-        self.image_list.append(t2np(img))
-        self.pixel_preds.append(t2np(smap))
-        self.pixel_labels.extend(t2np(gt))
+        s, smap = self.compute_s_s_map_batch(unet_f, self.patch_lib, latents.shape[-2:], index=self.patch_index,
+                                             fg_mask=self.foreground_mask(nmap, latents.shape[-2:]))
+        imgs = lightings.view(label.shape[0], -1, 3, self.image_size, self.image_size)
+        for b in range(label.shape[0]):
+            img = imgs[b, 5, :, :, :]
+            self.image_labels.append(label[b:b + 1].numpy())
+            self.image_preds.append(s[b].numpy())
+            self.pixel_preds.append(t2np(smap[b]))
+            if smap[b] is not None:
+                # --image_score_only keeps the image and ground truth only with its score map
+                self.image_list.append(t2np(img))
+                self.pixel_labels.extend(t2np(gt[b:b + 1]))
         # print(img)
         
 class DDIMInvUnified_Memory(Memory_Method):
@@ -243,7 +943,7 @@ class DDIMInvUnified_Memory(Memory_Method):
         lightings = lightings.reshape(-1, 3, self.image_size, self.image_size)
         rgb_latents = self.image2latents(lightings)
         bsz = rgb_latents.shape[0]
-        rgb_text_embs = text_emb.repeat(bsz, 1, 1)
+        rgb_text_embs = text_emb.expand(bsz, -1, -1)
         rgb_unet_f = self.get_unet_f(rgb_latents, rgb_text_embs, islighting=True)
         self.patch_lib.append(rgb_unet_f.cpu())
         
@@ -251,8 +951,8 @@ class DDIMInvUnified_Memory(Memory_Method):
         nmap = nmap.to(self.device)
         nmap_latents = self.image2latents(nmap)
         bsz = nmap_latents.shape[0]
-        nmap_text_embs = text_emb.repeat(bsz, 1, 1)
-        nmap_unet_f = self.get_unet_f(nmap_latents, nmap_text_embs, islighting=False)
+        nmap_text_embs = text_emb.expand(bsz, -1, -1)
+        nmap_unet_f = self.get_unet_f(nmap_latents, nmap_text_embs, islighting=False, modality="nmap")
         self.nmap_patch_lib.append(nmap_unet_f.cpu())
 
     def predict_align_data(self, lightings, nmap, text_prompt):
@@ -262,17 +962,19 @@ class DDIMInvUnified_Memory(Memory_Method):
         lightings = lightings.reshape(-1, 3, self.image_size, self.image_size)
         rgb_latents = self.image2latents(lightings)
         bsz = rgb_latents.shape[0]
-        rgb_text_embs = text_emb.repeat(bsz, 1, 1)
+        rgb_text_embs = text_emb.expand(bsz, -1, -1)
         rgb_unet_f = self.get_unet_f(rgb_latents, rgb_text_embs)
-        rgb_s, rgb_smap = self.compute_s_s_map(rgb_unet_f, self.patch_lib, rgb_latents.shape[-2:], k=2)
+        fg_mask = self.foreground_mask(nmap, rgb_latents.shape[-2:])
+        rgb_s, rgb_smap = self.compute_s_s_map(rgb_unet_f, self.patch_lib, rgb_latents.shape[-2:], k=2, index=self.patch_index, fg_mask=fg_mask)
         
         # nromal map
         nmap = nmap.to(self.device)
         nmap_latents = self.image2latents(nmap)
         bsz = nmap_latents.shape[0]
-        nmap_text_embs = text_emb.repeat(bsz, 1, 1)
-        nmap_unet_f = self.get_unet_f(nmap_latents, nmap_text_embs)
-        nmap_s, nmap_smap = self.compute_s_s_map(nmap_unet_f, self.nmap_patch_lib, nmap_latents.shape[-2:], k=2)
+        nmap_text_embs = text_emb.expand(bsz, -1, -1)
+        nmap_unet_f = self.get_unet_f(nmap_latents, nmap_text_embs, modality="nmap")
+        nmap_s, nmap_smap = self.compute_s_s_map(nmap_unet_f, self.nmap_patch_lib, nmap_latents.shape[-2:], k=2, index=self.nmap_patch_index,
+                                                 fg_mask=fg_mask, bank_name="nmap_patch_lib")
 
         # image_level
         self.nmap_image_preds.append(nmap_s.numpy())
@@ -289,33 +991,160 @@ class DDIMInvUnified_Memory(Memory_Method):
         lightings = lightings.reshape(-1, 3, self.image_size, self.image_size)
         rgb_latents = self.image2latents(lightings)
         bsz = rgb_latents.shape[0]
-        rgb_text_embs = text_emb.repeat(bsz, 1, 1)
+        rgb_text_embs = text_emb.expand(bsz, -1, -1)
         rgb_unet_f = self.get_unet_f(rgb_latents, rgb_text_embs, islighting=True)
-        rgb_s, rgb_smap = self.compute_s_s_map(rgb_unet_f, self.patch_lib, rgb_latents.shape[-2:])
         
         # normal map
         nmap = nmap.to(self.device)
         nmap_latents = self.image2latents(nmap)
         bsz = nmap_latents.shape[0]
-        nmap_text_embs = text_emb.repeat(bsz, 1, 1)
-        nmap_unet_f = self.get_unet_f(nmap_latents, nmap_text_embs, islighting=False)
-        nmap_s, nmap_smap = self.compute_s_s_map(nmap_unet_f, self.nmap_patch_lib, nmap_latents.shape[-2:])
+        nmap_text_embs = text_emb.expand(bsz, -1, -1)
+        nmap_unet_f = self.get_unet_f(nmap_latents, nmap_text_embs, islighting=False, modality="nmap")
 
-        pixel_map = rgb_smap + nmap_smap
-        s = rgb_s + nmap_s
+        (rgb_s, nmap_s, s), (rgb_smap, nmap_smap, pixel_map) = self.compute_s_s_map_pair(
+            (rgb_unet_f, nmap_unet_f), (self.patch_lib, self.nmap_patch_lib), rgb_latents.shape[-2:],
+            indexes=(self.patch_index, self.nmap_patch_index), fg_mask=self.foreground_mask(nmap, rgb_latents.shape[-2:]),
+            bank_names=("patch_lib", "nmap_patch_lib"))
         
         ### Record Score ###
-        img = lightings[-1, :, :, :]
-        self.image_list.append(t2np(img))
-        self.image_labels.append(label.numpy())
-        self.image_preds.append(s.numpy())
-        self.rgb_image_preds.append(rgb_s.numpy())
-        self.nmap_image_preds.append(nmap_s.numpy())
-        
-        self.pixel_labels.append(t2np(gt))
-        self.pixel_preds.append(t2np(pixel_map))
-        self.rgb_pixel_preds.append(t2np(rgb_smap))
-        self.nmap_pixel_preds.append(t2np(nmap_smap))
+        imgs = lightings.view(label.shape[0], -1, 3, self.image_size, self.image_size)
+        for b in range(label.shape[0]):
+            img = imgs[b, -1, :, :, :]
+            self.image_labels.append(label[b:b + 1].numpy())
+            self.image_preds.append(s[b].numpy())
+            self.rgb_image_preds.append(rgb_s[b].numpy())
+            self.nmap_image_preds.append(nmap_s[b].numpy())
+            
+            if pixel_map[b] is not None:
+                # --image_score_only keeps the image and ground truth only with its score map
+                self.image_list.append(t2np(img))
+                self.pixel_labels.append(t2np(gt[b:b + 1]))
+            self.pixel_preds.append(t2np(pixel_map[b]))
+            self.rgb_pixel_preds.append(t2np(rgb_smap[b]))
+            self.nmap_pixel_preds.append(t2np(nmap_smap[b]))
+
+class DDIMInvUnified_Gaussian(DDIMInvUnified_Memory):
+    '''
+    DDIMInvUnified_Memory with one Gaussian per feature map location and modality (PaDiM) in place of the memory
+    bank. The Gaussians are fitted on the target timestep features with streaming sums and test patches are scored
+    by their Mahalanobis distance, so neither memory nor scoring grows with the number of training images.
+    The covariances are C x C per location. With --projection none, a modality whose Gaussians would take more than
+    --gauss_max_mib gets a seeded random projection to the widest dimension that fits, at most --proj_dim (PaDiM
+    reduces its features the same way). An explicit --projection is kept as given and the fit stops on the first
+    batch when it does not fit.
+    There is no k-th neighbour of a Gaussian: patch_scores ignores k, so predict_align_data (which asks for the
+    2nd neighbour to skip the self match of a memory sample) scores the Mahalanobis distance as well.
+    '''
+    def __init__(self, args, cls_path):
+        super().__init__(args, cls_path)
+        if self.prefilter_images > 0 or self.local_window > 0 or self.n_clusters > 1 or self.bank_precision != "fp32" or self.bank_budget > 0:
+            raise ValueError("The Gaussian scorer has no memory bank to prefilter, cluster, quantize or budget")
+        if self.reweight:
+            raise ValueError("The Gaussian scorer has no bank patches to reweight image scores with")
+        self.gauss_shrinkage = args.gauss_shrinkage
+        self.gauss_max_mib = args.gauss_max_mib
+        self.gaussians = {}  # modality -> LocationGaussian
+
+    def get_bank_header(self):
+        header = super().get_bank_header()
+        header["gauss_shrinkage"] = self.gauss_shrinkage
+        # both decide the automatic projection of --projection none
+        header["gauss_max_mib"] = self.gauss_max_mib
+        header["proj_dim"] = self.proj_dim
+        return header
+
+    def project_features(self, features, modality="rgb"):
+        if self.projection != "none":
+            return super().project_features(features, modality)
+        if modality not in self.projections and modality not in self.gaussians:
+            # first batch of the fit: project the modality when its full-dimension Gaussians do not fit
+            _, C, H, W = features.shape
+            dim = min(self.proj_dim, int((self.gauss_max_mib * 2 ** 20 / (H * W * 4)) ** 0.5))
+            if dim < C:
+                print(f"The {modality} Gaussians take {H * W * C * C * 4 / 2 ** 20:.0f} MiB with {C} channels, more than "
+                      f"--gauss_max_mib {self.gauss_max_mib:g}: randomly projected to {dim} channels")
+                self.projections[modality] = FeatureProjection("random", dim, self.device)
+        if modality not in self.projections:
+            return features
+        return self.projections[modality](features.to(self.device))
+
+    def memorize(self, lightings, nmap, text_prompt):
+        super().memorize(lightings, nmap, text_prompt)
+        # the batches kept in the full dimension for a pca projection are folded once they are projected
+        if not self.pending_projection():
+            self.fold_batches()
+
+    def fold_batches(self):
+        # fold the target timestep features of the memory batches into the running sums instead of keeping them
+        fg_pixels = self.fg_pixels or [None] * len(self.patch_lib)
+        for rgb_f, nmap_f, fg in zip(self.patch_lib, self.nmap_patch_lib, fg_pixels):
+            self.feature_map_dims = tuple(rgb_f.shape[-2:])
+            weights = foreground_patches(fg, self.feature_map_dims) if fg is not None else None
+            for modality, unet_f in (("rgb", rgb_f[-1]), ("nmap", nmap_f[-1])):
+                if modality not in self.gaussians:
+                    self.check_gaussian_size(unet_f)
+                    self.gaussians[modality] = LocationGaussian(self.gauss_shrinkage, self.device)
+                self.gaussians[modality].update(unet_f, weights)
+        self.patch_lib, self.nmap_patch_lib, self.fg_pixels = [], [], []
+
+    def check_gaussian_size(self, features):
+        # the running sums of a modality, and later its inverse Cholesky factors, are (H * W, C, C) float32
+        _, C, H, W = features.shape
+        mib = H * W * C * C * 4 / 2 ** 20
+        if mib > self.gauss_max_mib:
+            raise ValueError(f"The Gaussians take {mib:.0f} MiB per modality ({H * W} locations, {C} channels), more than "
+                             f"--gauss_max_mib {self.gauss_max_mib:g}: use a smaller --proj_dim or fewer --feature_layers")
+
+    def run_coreset(self):
+        self.fit_projections(force=True)
+        self.fold_batches()
+        for gaussian in self.gaussians.values():
+            gaussian.fit()
+        self.patch_lib, self.nmap_patch_lib = self.gaussians["rgb"], self.gaussians["nmap"]
+        print(f"Gaussians: {self.feature_map_dims} locations, {self.patch_lib.mean.shape[1]} channels, "
+              f"{(self.patch_lib.nbytes() + self.nmap_patch_lib.nbytes()) / 2 ** 20:.1f} MiB")
+
+    def update_bank(self, batches=(), add_ids=(), remove_ids=()):
+        raise ValueError("The Gaussian scorer keeps no training samples to update, refit it")
+
+    def bank_tensors(self):
+        tensors = {"feature_map_dims": torch.tensor(self.feature_map_dims)}
+        for modality, gaussian in self.gaussians.items():
+            for key, value in gaussian.state_dict().items():
+                tensors[f"gaussian.{modality}.{key}"] = value
+        for modality, projection in self.projections.items():
+            for key, value in projection.state_dict().items():
+                tensors[f"projection.{modality}.{key}"] = value
+        return tensors
+
+    def load_fitted_bank(self, bank_dir):
+        tensors = load_memory_bank(bank_dir, self.get_bank_header())
+        if tensors is None:
+            return False
+        self.sample_ids = load_bank_samples(bank_dir)
+        self.feature_map_dims = tuple(tensors["feature_map_dims"].tolist())
+        state = lambda name: {key.rsplit(".", 1)[1]: value.to(self.device) for key, value in tensors.items()
+                              if key.startswith(name + ".")}
+        for modality in ("rgb", "nmap"):
+            self.gaussians[modality] = LocationGaussian(self.gauss_shrinkage, self.device, **state(f"gaussian.{modality}"))
+        for modality in {key.split(".")[1] for key in tensors if key.startswith("projection.")}:
+            # a projection saved with --projection none is the automatic random one
+            kind = self.projection if self.projection != "none" else "random"
+            self.projections[modality] = FeatureProjection(kind, self.proj_dim, self.device, **state(f"projection.{modality}"))
+        self.patch_lib, self.nmap_patch_lib = self.gaussians["rgb"], self.gaussians["nmap"]
+        return True
+
+    def patch_scores(self, patch, patch_lib, p=2, k=1, index=None, fg_mask=None, bank_name="patch_lib"):
+        # patch (timesteps, B, C, H, W), patch_lib the LocationGaussian of the modality
+        if p != 2:
+            raise ValueError("The Gaussian scorer scores Mahalanobis distances, it has no p-norm")
+        # k is ignored, see the class docstring
+        smap = patch_lib.score(patch[-1])
+        if fg_mask is not None:
+            smap = smap.masked_fill(~fg_mask.reshape(smap.shape).to(smap.device), 0)
+        topk_value, _ = torch.topk(smap, k=self.topk, dim=1)
+        s_star = torch.mean(topk_value, dim=1)
+        return s_star, smap
 
 class ControlNet_DDIMInv_Memory(Memory_Method):
     def __init__(self, args, cls_path):
@@ -329,6 +1158,8 @@ class ControlNet_DDIMInv_Memory(Memory_Method):
         self.controllora.requires_grad_(False)
         self.controllora.eval()
         self.controllora.to(self.device)
+        if self.kv_cache:
+            enable_kv_cache(self.controllora)
 
         self.weight = args.rgb_weight
         self.bias = 0
@@ -336,16 +1167,17 @@ class ControlNet_DDIMInv_Memory(Memory_Method):
         
     @torch.no_grad()
     def get_feature_layers(self, latent, condition_map, t, text_emb):
-        pred_f = self.controlnet(latent.to(self.device), condition_map, t, text_emb)['up_ft']
+        pred_f = self.controlnet(latent.to(self.device), condition_map, t, text_emb, up_ft_indices=self.feature_layers)['up_ft']
+        self.unet_forwards["feature"] += 1
         features_list = []
         for layer in self.feature_layers:
             resized_f = torch.nn.functional.interpolate(pred_f[layer], size=(32, 32), mode='bicubic')
-            features_list.append(resized_f.to('cpu'))
+            features_list.append(resized_f)
         features = torch.cat(features_list, dim=1)
         return features
     
     @torch.no_grad()    
-    def controlnet(self, noisy_latents, condition_map, timestep, text_emb):
+    def controlnet(self, noisy_latents, condition_map, timestep, text_emb, up_ft_indices=None):
         down_block_res_samples, mid_block_res_sample = self.controllora(
             noisy_latents, timestep,
             encoder_hidden_states=text_emb,
@@ -356,33 +1188,32 @@ class ControlNet_DDIMInv_Memory(Memory_Method):
             noisy_latents, timestep,
             encoder_hidden_states=text_emb,
             down_block_additional_residuals=[sample for sample in down_block_res_samples],
-            mid_block_additional_residual=mid_block_res_sample
+            mid_block_additional_residual=mid_block_res_sample,
+            up_ft_indices=up_ft_indices,
         )
         return model_output
     
     @torch.no_grad()
     def controlnet_ddim_loop(self, latents, condition_map, text_emb):
-        latents = latents.clone().detach()
+        # yields (t, latent) like Memory_Method.ddim_loop
+        latents = latents.clone().detach().to(self.device)
         self.noise_scheduler.set_timesteps(self.num_inference_timesteps, device=self.device)
-        latent_list = []
-        t_list = []
         for t in reversed(self.timesteps_list):
-            noise_pred = self.controlnet(latents.to(self.device), condition_map, t, text_emb)['sample']
+            noise_pred = self.controlnet(latents, condition_map, t, text_emb)['sample']
+            self.unet_forwards["loop"] += 1
             latents = self.next_step(noise_pred, t, latents)
             if t in self.mul_timesteps:
-                latent_list.append(latents.to('cpu'))
-                t_list.append(t)
-        return latent_list, t_list
+                yield t, latents
     
     @torch.no_grad() 
-    def get_controlnet_f(self, latents, condition_map, text_emb, islighting=True):
-        noisy_latents, t_list  = self.controlnet_ddim_loop(latents, condition_map, text_emb)
+    def get_controlnet_f(self, latents, condition_map, text_emb, islighting=True, modality="rgb"):
         control_fs = []
-        for i, t in enumerate(t_list):
-            contol_f = self.get_feature_layers(noisy_latents[i].to(self.device), condition_map, t, text_emb)
+        for t, noisy_latent in self.controlnet_ddim_loop(latents, condition_map, text_emb):
+            contol_f = self.get_feature_layers(noisy_latent, condition_map, t, text_emb)
             B, C, H, W = contol_f.shape
             if islighting and self.data_type=="eyecandies":
                 contol_f = torch.mean(contol_f.view(-1, 6, C, H, W), dim=1)
+            contol_f = self.project_features(contol_f, modality)
             control_fs.append(contol_f.to('cpu'))
         control_fs = torch.stack(control_fs)
         return control_fs
@@ -405,7 +1236,7 @@ class ControlNet_DDIMInv_Memory(Memory_Method):
         rgb_latents = self.image2latents(lightings)
         
         bsz = rgb_latents.shape[0]
-        rgb_text_embs = text_emb.repeat(bsz, 1, 1)
+        rgb_text_embs = text_emb.expand(bsz, -1, -1)
         rgb_unet_f = self.get_controlnet_f(rgb_latents, nmap_repeat, rgb_text_embs)
         self.patch_lib.append(rgb_unet_f.cpu())
 
@@ -414,8 +1245,8 @@ class ControlNet_DDIMInv_Memory(Memory_Method):
         if self.data_type == "eyecandies":
             nmap_latents = nmap_latents.repeat_interleave(6, dim=0) # [bs * 6, 3, 256, 256]      
         bsz = nmap_latents.shape[0]
-        nmap_text_embs = text_emb.repeat(bsz, 1, 1)
-        nmap_unet_f = self.get_controlnet_f(nmap_latents, lightings, nmap_text_embs)
+        nmap_text_embs = text_emb.expand(bsz, -1, -1)
+        nmap_unet_f = self.get_controlnet_f(nmap_latents, lightings, nmap_text_embs, modality="nmap")
         self.nmap_patch_lib.append(nmap_unet_f.cpu())  
 
     def predict(self, i, lightings, nmap, text_prompt, gt, label):
@@ -434,9 +1265,8 @@ class ControlNet_DDIMInv_Memory(Memory_Method):
         lightings = lightings.reshape(-1, 3, self.image_size, self.image_size)
         rgb_latents = self.image2latents(lightings)
         bsz = rgb_latents.shape[0]
-        rgb_text_embs = text_emb.repeat(bsz, 1, 1)
+        rgb_text_embs = text_emb.expand(bsz, -1, -1)
         rgb_unet_f = self.get_controlnet_f(rgb_latents, nmap_repeat, rgb_text_embs)
-        rgb_s, rgb_smap = self.compute_s_s_map(rgb_unet_f, self.patch_lib, rgb_latents.shape[-2:])
         
         # normal map
         nmap = nmap.to(self.device)
@@ -444,23 +1274,28 @@ class ControlNet_DDIMInv_Memory(Memory_Method):
         if self.data_type == "eyecandies":
             nmap_latents = nmap_latents.repeat_interleave(6, dim=0) # [bs * 6, 3, 256, 256]      
         bsz = nmap_latents.shape[0]
-        nmap_text_embs = text_emb.repeat(bsz, 1, 1)
-        nmap_unet_f = self.get_controlnet_f(nmap_latents, lightings, nmap_text_embs)
-        nmap_s, nmap_smap = self.compute_s_s_map(nmap_unet_f, self.nmap_patch_lib, nmap_latents.shape[-2:])
+        nmap_text_embs = text_emb.expand(bsz, -1, -1)
+        nmap_unet_f = self.get_controlnet_f(nmap_latents, lightings, nmap_text_embs, modality="nmap")
 
         ### Combine RGB and Nmap score map ###
-        s = rgb_s * self.weight + nmap_s * self.nmap_weight
-        smap = rgb_smap + nmap_smap
+        (rgb_s, nmap_s, s), (rgb_smap, nmap_smap, smap) = self.compute_s_s_map_pair(
+            (rgb_unet_f, nmap_unet_f), (self.patch_lib, self.nmap_patch_lib), rgb_latents.shape[-2:],
+            indexes=(self.patch_index, self.nmap_patch_index), fg_mask=self.foreground_mask(nmap, rgb_latents.shape[-2:]),
+            score_weights=(self.weight, self.nmap_weight), bank_names=("patch_lib", "nmap_patch_lib"))
         # s, _ = torch.topk(smap, k=self.topk)
         # s = torch.mean(s)
-        img = lightings[-1, :, :, :]
-        self.image_list.append(t2np(img))
-        self.image_labels.append(label.numpy())
-        self.image_preds.append(s.numpy())
-        self.rgb_image_preds.append(rgb_s.numpy())
-        self.nmap_image_preds.append(nmap_s.numpy())
-        
-        self.pixel_labels.append(t2np(gt))
-        self.pixel_preds.append(t2np(smap))
-        self.rgb_pixel_preds.append(t2np(rgb_smap))
-        self.nmap_pixel_preds.append(t2np(nmap_smap))
+        imgs = lightings.view(label.shape[0], -1, 3, self.image_size, self.image_size)
+        for b in range(label.shape[0]):
+            img = imgs[b, -1, :, :, :]
+            self.image_labels.append(label[b:b + 1].numpy())
+            self.image_preds.append(s[b].numpy())
+            self.rgb_image_preds.append(rgb_s[b].numpy())
+            self.nmap_image_preds.append(nmap_s[b].numpy())
+            
+            if smap[b] is not None:
+                # --image_score_only keeps the image and ground truth only with its score map
+                self.image_list.append(t2np(img))
+                self.pixel_labels.append(t2np(gt[b:b + 1]))
+            self.pixel_preds.append(t2np(smap[b]))
+            self.rgb_pixel_preds.append(t2np(rgb_smap[b]))
+            self.nmap_pixel_preds.append(t2np(nmap_smap[b]))
@@ -0,0 +1,62 @@
+import torch
+import torch.nn.functional as F
+from diffusers.models.attention_processor import AttnProcessor2_0
+
+
+class CachedKVAttnProcessor(AttnProcessor2_0):
+    '''
+    Cross-attention with the keys and values of the prompt computed once and reused by every later call. It applies
+    when encoder_hidden_states is one prompt embedding, alone or broadcast over the batch (expand, stride 0): K/V
+    are projected from that single row and the batch is folded into the query rows, so they are never repeated.
+    Anything else (self-attention, masks, per-sample prompts, training) runs the stock AttnProcessor2_0.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.cache = None  # (attn, encoder_hidden_states, version, scale, key, value)
+
+    def cached_kv(self, attn, encoder_hidden_states, scale):
+        if self.cache is not None:
+            cached_attn, emb, version, cached_scale, key, value = self.cache
+            if (cached_attn is attn and emb.data_ptr() == encoder_hidden_states.data_ptr()
+                    and emb.shape[1:] == encoder_hidden_states.shape[1:]
+                    and version == encoder_hidden_states._version and cached_scale == scale):
+                return key, value
+        # (1, heads, tokens, head_dim)
+        context = encoder_hidden_states[:1]
+        head_dim = attn.to_k.out_features // attn.heads
+        key = attn.to_k(context, scale=scale).view(1, -1, attn.heads, head_dim).transpose(1, 2)
+        value = attn.to_v(context, scale=scale).view(1, -1, attn.heads, head_dim).transpose(1, 2)
+        # holding the embedding keeps its storage from being reused by another tensor with the same data_ptr
+        self.cache = (attn, encoder_hidden_states, encoder_hidden_states._version, scale, key, value)
+        return key, value
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None, scale=1.0):
+        if (encoder_hidden_states is None or attention_mask is not None
+                or (encoder_hidden_states.shape[0] != 1 and encoder_hidden_states.stride(0) != 0)
+                or hidden_states.ndim != 3 or attn.spatial_norm is not None or attn.group_norm is not None
+                or attn.norm_cross or torch.is_grad_enabled()):
+            return super().__call__(attn, hidden_states, encoder_hidden_states, attention_mask, temb, scale)
+
+        residual = hidden_states
+        batch_size, sequence_length, _ = hidden_states.shape
+        key, value = self.cached_kv(attn, encoder_hidden_states, scale)
+        head_dim = key.shape[-1]
+
+        # (B, N, heads * head_dim) -> (1, heads, B * N, head_dim), every query row attends to the same K/V
+        query = attn.to_q(hidden_states, scale=scale)
+        query = query.view(batch_size * sequence_length, attn.heads, head_dim).transpose(0, 1).unsqueeze(0)
+        hidden_states = F.scaled_dot_product_attention(query, key, value, dropout_p=0.0, is_causal=False)
+        hidden_states = hidden_states[0].transpose(0, 1).reshape(batch_size, sequence_length, attn.heads * head_dim)
+        hidden_states = hidden_states.to(query.dtype)
+
+        hidden_states = attn.to_out[0](hidden_states, scale=scale)
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+        return hidden_states / attn.rescale_output_factor
+
+
+def enable_kv_cache(model):
+    # one processor per attention layer of a UNet / ControlLoRA, each caches the K/V of its own to_k / to_v
+    model.set_attn_processor({name: CachedKVAttnProcessor() for name in model.attn_processors})
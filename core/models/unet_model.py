@@ -19,7 +19,10 @@ class MyUNet2DConditionModel(UNet2DConditionModel):
         mid_block_additional_residual: Optional[torch.Tensor] = None,
         encoder_attention_mask: Optional[torch.Tensor] = None,
         return_dict: bool = True,
+        up_ft_indices: Optional[List[int]] = None,
     ) -> Tuple:
+        # up_ft_indices: keep only these up block outputs and stop after the deepest of them,
+        # the remaining up blocks and the output head are skipped and no 'sample' is returned
 
         default_overall_up_factor = 2**self.num_upsamplers
 
@@ -236,7 +239,8 @@ class MyUNet2DConditionModel(UNet2DConditionModel):
         
         # 5. up
         up_ft = {}
-        for i, upsample_block in enumerate(self.up_blocks):
+        last_block = len(self.up_blocks) - 1 if up_ft_indices is None else max(up_ft_indices)
+        for i, upsample_block in enumerate(self.up_blocks[: last_block + 1]):
             is_final_block = i == len(self.up_blocks) - 1
 
             res_samples = down_block_res_samples[-len(upsample_block.resnets) :]
@@ -267,7 +271,11 @@ class MyUNet2DConditionModel(UNet2DConditionModel):
                     scale=lora_scale,
                 )
             
-            up_ft[i] = sample
+            if up_ft_indices is None or i in up_ft_indices:
+                up_ft[i] = sample
+
+        if up_ft_indices is not None:
+            return {'up_ft': up_ft}
 
         # 6. post-process
         if self.conv_norm_out:
@@ -280,6 +288,10 @@ class MyUNet2DConditionModel(UNet2DConditionModel):
         output['up_ft'] = up_ft
         return output
 
+    def extract_features(self, sample, timestep, encoder_hidden_states, up_ft_indices, **kwargs):
+        # up block features only, e.g. with the ControlLoRA down_block_additional_residuals / mid_block_additional_residual
+        return self(sample, timestep, encoder_hidden_states, up_ft_indices=sorted(set(up_ft_indices)), **kwargs)['up_ft']
+
 def build_unet(args):
     unet = MyUNet2DConditionModel.from_pretrained(
         args.diffusion_id,
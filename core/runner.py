@@ -1,8 +1,9 @@
-from core.data import test_lightings_loader, mvtec3D_test_loader
+from core.data import test_lightings_loader, mvtec3D_test_loader, memory_update_loader
 from core.ddim_memory_method import *
 from tqdm import tqdm
 import torch
 import os
+import time
 import os.path as osp
 
 class Runner():
@@ -22,6 +23,8 @@ class Runner():
             self.method = DDIMInvNmap_Memory(args, cls_path)
         elif args.method_name == "ddiminvunified_memory":
             self.method = DDIMInvUnified_Memory(args, cls_path)
+        elif args.method_name == "ddiminvunified_gaussian":
+            self.method = DDIMInvUnified_Gaussian(args, cls_path)
         elif args.method_name == "controlnet_ddiminv_memory":
             self.method = ControlNet_DDIMInv_Memory(args, cls_path)
         else:
@@ -31,6 +34,7 @@ class Runner():
 
         self.log_file = open(osp.join(cls_path, "class_score.txt"), "a", 1)
         self.method_name = args.method_name
+        self.bank_dir = osp.join(args.bank_dir, args.dataset_type, args.method_name, cls) if args.bank_dir else ""
         
         if args.dataset_type == "eyecandies":
             self.memory_loader = test_lightings_loader(args, cls, "memory")
@@ -44,12 +48,35 @@ class Runner():
             self.align_loader = mvtec3D_test_loader(args, cls, "memory") 
             
     def fit(self):
+        self.method.train_ids = self.memory_loader.dataset.sample_ids()
+        if self.bank_dir and self.method.load_fitted_bank(self.bank_dir):
+            print(f'Loaded fitted memory bank for class {self.cls} from {self.bank_dir}')
+            if self.args.bank_add_path or self.args.bank_remove_ids:
+                self.update()
+                self.method.save_fitted_bank(self.bank_dir)
+            return
         with torch.no_grad():
+            self.method.sample_ids = self.memory_loader.dataset.sample_ids()
             for i, (lightings, nmap, text_prompt) in enumerate(tqdm(self.memory_loader, desc=f'Extracting train features for class {self.cls}')):
                 text_prompt = f'A photo of a {self.cls}'
-                self.method.add_sample_to_mem_bank(lightings, nmap, text_prompt)
+                self.method.memorize(lightings, nmap, text_prompt)
             self.method.run_coreset()
+            if self.args.bank_add_path or self.args.bank_remove_ids:
+                self.update()
             self.method.cluster_training_data()
+        if self.bank_dir:
+            self.method.save_fitted_bank(self.bank_dir)
+
+    def update(self):
+        # Incremental update of the fitted bank: new good samples of bank_add_path in, bank_remove_ids out
+        add_ids = []
+        batches = []
+        if self.args.bank_add_path:
+            update_loader, add_ids = memory_update_loader(self.args, self.cls, self.args.bank_add_path, skip_ids=self.method.sample_ids)
+            batches = ((lightings, nmap, f'A photo of a {self.cls}') for lightings, nmap, _ in
+                       tqdm(update_loader, desc=f'Extracting new train features for class {self.cls}'))
+        with torch.no_grad():
+            self.method.update_bank(batches, add_ids=add_ids, remove_ids=self.args.bank_remove_ids)
 
     def alignment(self):
         with torch.no_grad():
@@ -63,12 +90,29 @@ class Runner():
         
     def evaluate(self):
         
+        n_images, predict_time = 0, 0.0
         with torch.no_grad():
             for i, ((images, nmap, text_prompt), gt, label) in enumerate(tqdm(self.test_loader, desc="Extracting test features")):
                 # if i == 105:
                 #     break
                 text_prompt = f'A photo of a {self.cls}'
+                start = time.perf_counter()
                 self.method.predict(i, images, nmap, text_prompt, gt, label)
+                predict_time += time.perf_counter() - start
+                n_images += label.shape[0]
+
+        throughput_report = self.method.get_throughput_report(n_images, predict_time)
+        print(throughput_report)
+        self.log_file.write(f'Class: {self.cls} {throughput_report}\n')
+
+        index_report = self.method.get_index_report()
+        if index_report is not None:
+            print(index_report)
+            self.log_file.write(f'Class: {self.cls} {index_report}\n')
+        forward_report = self.method.get_forward_report()
+        if forward_report is not None:
+            print(forward_report)
+            self.log_file.write(f'Class: {self.cls} {forward_report}\n')
 
         if self.args.viz:
             for modality_name in self.modality_names:
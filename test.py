@@ -6,6 +6,7 @@ import pandas as pd
 import os.path as osp
 from core.runner import Runner
 from utils.utils import set_seeds, log_args
+from utils.bank_util import checkpoint_hashes
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 parser = argparse.ArgumentParser(description='test')
 
@@ -18,6 +19,7 @@ parser.add_argument('--data_path', default="/mnt/home_6T/public/jayliu0313/datas
 parser.add_argument('--output_dir', default="./output")
 parser.add_argument('--dataset_type', default="mvtecloco", help="eyecandies, mvtec3d")
 parser.add_argument('--batch_size', default=4, type=int)
+parser.add_argument('--test_batch_size', default=1, type=int, help="test images scored together by one memory bank search")
 parser.add_argument('--image_size', default=256, type=int)
 parser.add_argument("--workers", default=4)
 parser.add_argument('--CUDA', type=int, default=0, help="choose the device of CUDA")
@@ -26,11 +28,15 @@ parser.add_argument('--seed', type=int, default=7)
 
 # Method choose
 parser.add_argument('--method_name', default="ddiminvunified_memory", help="ddim_memory, ddiminvrgb_memory,\
-ddiminvnmap_memory, ddiminvunified_memory, controlnet_ddiminv_memory")
+ddiminvnmap_memory, ddiminvunified_memory, ddiminvunified_gaussian, controlnet_ddiminv_memory")
                     
 parser.add_argument('--rgb_weight', type=float, default=1)
 parser.add_argument('--nmap_weight', type=float, default=1)
 parser.add_argument('--reweight', default=False, type=bool)
+parser.add_argument('--image_score_only', action="store_true", help="score images from the latent resolution patch scores and skip the full resolution score maps and pixel metrics, unless --viz is set")
+parser.add_argument('--map_threshold', default=float("inf"), type=float, help="with --image_score_only, still build the score maps of images scoring above this")
+parser.add_argument('--pil_blur', action="store_true", help="smooth score maps with the 8-bit PIL Gaussian blur instead of the batched torch one")
+parser.add_argument('--no_kv_cache', action="store_true", help="recompute the cross-attention keys and values of the class prompt in every UNet call instead of caching them")
 parser.add_argument('--score_type', default=0, type=int, help="0 is max score, 1 is mean score") # just for score map, max score: maximum each pixel of 6 score maps, mean score: mean of 6 score maps 
 parser.add_argument('--feature_layers', default=[2], type=int)
 
@@ -38,10 +44,39 @@ parser.add_argument('--feature_layers', default=[2], type=int)
 parser.add_argument('--g_feature_layers', default=[1, 2], type=int, help="just works on mvtec-loco")
 parser.add_argument('--num_class', default=5, type=int, help="just works on mvtec-loco")  
 parser.add_argument('--topk', default=3, type=int)
+parser.add_argument('--f_coreset', default=1, type=float, help="fraction of memory bank patches kept by greedy coreset subsampling, 1 keeps all")
+parser.add_argument('--coreset_size', default=0, type=int, help="absolute number of memory bank patches kept by coreset subsampling, overrides f_coreset when > 0")
+parser.add_argument('--knn_tile_size', default=0, type=int, help="number of memory bank patches per distance tile in the kNN search and gathered per chunk when re-ranking the cascade_k candidates, 0 searches the whole bank at once")
+parser.add_argument('--index_type', default="exact", type=str, help="exact, ivf, hnsw: nearest neighbour index over the memory bank")
+parser.add_argument('--ivf_nlist', default=256, type=int, help="number of k-means cells of the ivf index")
+parser.add_argument('--ivf_nprobe', default=8, type=int, help="number of cells scanned per query by the ivf index")
+parser.add_argument('--graph_degree', default=16, type=int, help="maximum out-degree of a patch in the hnsw index graph")
+parser.add_argument('--graph_ef', default=32, type=int, help="beam width of the hnsw index search")
+parser.add_argument('--bank_precision', default="fp32", type=str, help="fp32, fp16, int8, pq: storage precision of the memory bank")
+parser.add_argument('--pq_m', default=16, type=int, help="number of product quantization sub-vectors per patch when bank_precision is pq")
+parser.add_argument('--rerank_k', default=8, type=int, help="candidates re-ranked in float32 when the memory bank is stored in fp16, int8 or pq")
+parser.add_argument('--bank_budget', default=0, type=int, help="build the memory bank batch by batch with at most this many patches per timestep, also when samples are added with update_bank, 0 keeps every patch until the coreset")
+parser.add_argument('--dup_threshold', default=0.0, type=float, help="patches closer than this to the budgeted bank are rejected as near duplicates")
+parser.add_argument('--cascade_k', default=1, type=int, help="with several noise_intensity timesteps, neighbours of the target slice re-ranked by their max distance over all slices, 1 keeps the nearest one")
+parser.add_argument('--prefilter_images', default=0, type=int, help="search only the patches of the N training images nearest to the pooled query descriptor, 0 searches the whole bank")
+parser.add_argument('--local_window', default=0, type=int, help="compare each patch only with bank patches within a local_window x local_window window around its position, 0 searches the whole bank")
+parser.add_argument('--local_fallback', default=float("inf"), type=float, help="patches whose local window distance exceeds this are searched over the whole bank")
+parser.add_argument('--n_clusters', default=1, type=int, help="partition the memory bank into sub-banks of k-means clusters of training images, 1 keeps one bank")
+parser.add_argument('--route_clusters', default=1, type=int, help="number of nearest clusters whose sub-banks each test image is searched in")
+parser.add_argument('--projection', default="none", type=str, choices=["none", "pca", "random"], help="linear reduction of the UNet features before they are banked or moved to the CPU, pca is fitted on the first --pca_patches memory patches, which are projected once it is fitted")
+parser.add_argument('--proj_dim', default=128, type=int, help="number of channels kept by --projection")
+parser.add_argument('--pca_patches', default=65536, type=int, help="memory patches (of all timesteps) the pca projection is fitted on before the memory features are projected as they arrive")
+parser.add_argument('--fg_mask', action="store_true", help="drop the background patches (black normal map pixels, i.e. invalid xyz points) of MVTec 3D from the memory bank and score them 0")
+parser.add_argument('--gauss_shrinkage', default=0.01, type=float, help="shrinkage of the per-location covariances of ddiminvunified_gaussian towards a scaled identity")
+parser.add_argument('--gauss_max_mib', default=1024, type=float, help="largest per-modality size of the ddiminvunified_gaussian covariances: with --projection none wider features are randomly projected to fit, otherwise the fit stops on the first batch above it")
+parser.add_argument('--index_report', action="store_true", help="log recall and latency of the index against exact search")
 
 #### Load Checkpoint ####
 parser.add_argument("--load_unet_ckpt", default="")
 parser.add_argument('--load_controlnet_ckpt', type=str, default="")
+parser.add_argument('--bank_dir', type=str, default="./memory_bank", help="where fitted memory banks are cached and reloaded, empty disables caching")
+parser.add_argument('--bank_add_path', type=str, default="", help="data root with the same layout as data_path whose new good samples are added to the fitted memory bank")
+parser.add_argument('--bank_remove_ids', type=str, nargs="*", default=[], help="sample ids (image paths) retired from the fitted memory bank")
 
 # Unet Model (Diffusion Model)
 parser.add_argument("--diffusion_id", type=str, default="CompVis/stable-diffusion-v1-4", help="CompVis/stable-diffusion-v1-4, runwayml/stable-diffusion-v1-5")
@@ -87,6 +122,7 @@ def run(args):
         raise SyntaxError
 
     result_file = open(osp.join(args.output_dir, "results.txt"), "a", 1)   
+    args.ckpt_hashes = checkpoint_hashes(args) if args.bank_dir else {}
     
     image_rocaucs_df = pd.DataFrame(MODALITY_NAMES, columns=['Method'])
     pixel_rocaucs_df = pd.DataFrame(MODALITY_NAMES, columns=['Method'])
@@ -0,0 +1,200 @@
+from types import SimpleNamespace
+import pytest
+import torch
+from utils.bank_util import (save_memory_bank, load_memory_bank, load_bank_samples, checkpoint_hashes, ids_hash,
+                             StreamingBank, QuantizedBank, PQBank, sparse_projection,
+                             greedy_coreset)
+from utils.knn_util import QuantizedIndex, PQIndex, rerank
+
+
+@pytest.fixture
+def bank():
+    generator = torch.Generator().manual_seed(0)
+    return torch.randn(2, 2000, 32, generator=generator)
+
+
+@pytest.fixture
+def wide_bank():
+    # wide enough for the sparse random projection at eps 0.9
+    generator = torch.Generator().manual_seed(0)
+    return torch.randn(2, 2000, 256, generator=generator)
+
+
+def test_save_load_round_trip(tmp_path, bank):
+    header = {"cls": "bagel", "layers": (2,)}
+    save_memory_bank(str(tmp_path), header, {"patch_lib": bank}, samples=["a.png", "b.png"])
+    tensors = load_memory_bank(str(tmp_path), {"cls": "bagel", "layers": [2]})
+    assert torch.equal(tensors["patch_lib"], bank)
+    assert load_bank_samples(str(tmp_path)) == ["a.png", "b.png"]
+
+
+def test_load_rejects_other_header(tmp_path, bank):
+    save_memory_bank(str(tmp_path), {"cls": "bagel"}, {"patch_lib": bank})
+    assert load_memory_bank(str(tmp_path), {"cls": "carrot"}) is None
+    assert load_memory_bank(str(tmp_path / "missing"), {"cls": "bagel"}) is None
+
+
+def test_save_over_memory_mapped_bank(tmp_path, bank):
+    save_memory_bank(str(tmp_path), {"v": 1}, {"patch_lib": bank})
+    mapped = load_memory_bank(str(tmp_path), {"v": 1})["patch_lib"]
+    save_memory_bank(str(tmp_path), {"v": 2}, {"patch_lib": mapped * 2})
+    assert torch.equal(load_memory_bank(str(tmp_path), {"v": 2})["patch_lib"], bank * 2)
+
+
+def stream(streaming, lib, batch=500):
+    N = lib.shape[1]
+    for start in range(0, N, batch):
+        rows = torch.arange(start, min(start + batch, N))
+        streaming.add(lib[:, rows], rows // 100, rows % 100, lib[-1, rows].view(-1, 100, lib.shape[-1]).mean(dim=1))
+    return streaming.finish()
+
+
+def test_streaming_bank_respects_budget(bank):
+    lib, samples, positions, descs = stream(StreamingBank(budget=300), bank)
+    assert lib.shape == (2, 300, 32)
+    assert descs.shape == (20, 32)
+    # every kept patch is an unmodified training patch with its own sample number and position
+    rows = samples * 100 + positions
+    assert torch.equal(lib, bank[:, rows])
+    assert len(torch.unique(rows)) == 300
+
+
+def test_streaming_bank_keeps_everything_under_budget(bank):
+    lib, samples, positions, _ = stream(StreamingBank(budget=5000), bank)
+    assert torch.equal(lib, bank)
+
+
+def test_streaming_bank_rejects_near_duplicates(bank):
+    lib = torch.cat([bank, bank + 1e-4], dim=1)
+    streaming = StreamingBank(budget=10000, threshold=1e-2)
+    kept = stream(streaming, lib)[0]
+    assert streaming.n_rejected == 2000
+    assert torch.equal(kept, bank)
+
+
+def test_resumed_streaming_bank_keeps_budget_and_tracks_rows(bank):
+    fitted = stream(StreamingBank(budget=300), bank[:, :1000])
+    streaming = StreamingBank(budget=300, threshold=1e-2)
+    streaming.resume(*fitted[:3], seen=1000)
+    rows = torch.arange(1000, 2000)
+    streaming.add(torch.cat([bank[:, rows], fitted[0][:, :10] + 1e-4], dim=1), torch.cat([rows // 100, rows[:10]]),
+                  torch.cat([rows % 100, rows[:10]]), bank[-1, rows].view(-1, 100, 32).mean(dim=1))
+    lib, samples, positions, _ = streaming.finish()
+    assert lib.shape == (2, 300, 32) and streaming.seen == 2000 and streaming.n_rejected == 10
+    # resumed patches keep their slot, row numbers below 300, and about half of the bank is replaced
+    old = streaming.rows[:300] < 300
+    assert torch.equal(lib[:, old], fitted[0][:, streaming.rows[:300][old]])
+    assert 100 < int((~old).sum()) < 200
+
+
+DEVICES = ["cpu", pytest.param("cuda", marks=pytest.mark.skipif(not torch.cuda.is_available(), reason="no GPU"))]
+
+
+@pytest.mark.parametrize("device", DEVICES)
+def test_coreset_of_streamed_bank_on_device(wide_bank, device):
+    # the streamed bank stays on its device, the coreset projection is fitted on a CPU copy
+    lib = stream(StreamingBank(budget=300, device=device), wide_bank)[0]
+    assert lib.device.type == device
+    T, N, C = lib.shape
+    (z_lib,), n_components = sparse_projection([lib.permute(1, 0, 2).reshape(N, T * C)], eps=0.9)
+    assert z_lib.shape == (N, n_components)
+    idx = greedy_coreset(z_lib, n=30, device=device, float16=False)
+    assert idx.device.type == "cpu"
+    assert len(torch.unique(idx)) == 30 and idx.max() < N
+
+
+def test_sparse_projection_is_reproduced_from_n_components(wide_bank):
+    (z_bank,), n_components = sparse_projection([wide_bank[-1, :1000]], eps=0.9)
+    assert 0 < n_components < 256
+    # a later projection of other rows with the same n_components is the same linear map
+    (z_new, z_again), same = sparse_projection([wide_bank[-1, 1000:], wide_bank[-1, :1000]], eps=0.9,
+                                               n_components=n_components)
+    assert same == n_components
+    assert torch.allclose(z_again, z_bank, atol=1e-5)
+    (z_full,), n_components = sparse_projection([wide_bank[-1]], n_components=0)
+    assert n_components == 0 and torch.equal(z_full, wide_bank[-1])
+
+
+def test_extended_coreset_matches_selection_in_one_pass(wide_bank):
+    # continuing from a selected set in the stored projection selects what a single greedy pass over
+    # the projected rows picks after that set
+    (z_lib,), n_components = sparse_projection([wide_bank[-1]], eps=0.9)
+    idx = greedy_coreset(z_lib, n=40)
+    selected, rest = idx[:20], torch.ones(len(z_lib), dtype=torch.bool)
+    rest[selected] = False
+    (z_new, z_sel), _ = sparse_projection([wide_bank[-1, rest], wide_bank[-1, selected]], eps=0.9,
+                                          n_components=n_components)
+    min_distances = torch.cdist(z_new, z_sel).min(dim=1)[0]
+    new_idx = greedy_coreset(z_new, n=20, min_distances=min_distances)
+    assert torch.equal(rest.nonzero().squeeze(1)[new_idx], idx[20:])
+
+
+def test_greedy_coreset_continues_from_selected_set(bank):
+    z_lib = bank[-1]
+    min_distances = torch.cdist(z_lib, z_lib[:10]).min(dim=1)[0]
+    idx = greedy_coreset(z_lib, n=20, min_distances=min_distances)
+    assert len(idx) == 20 and not (idx < 10).any()
+
+
+@pytest.mark.parametrize("precision, atol", [("fp16", 1e-2), ("int8", 5e-2)])
+def test_quantized_bank_dequantizes_close(bank, precision, atol):
+    quantized = QuantizedBank(bank, precision=precision)
+    assert quantized.shape == bank.shape
+    assert (quantized[-1] - bank[-1]).abs().max() < atol * bank.abs().max()
+    assert quantized.nbytes() < bank.numel() * 4
+
+
+def test_quantized_bank_reads_fp32_copy(bank):
+    quantized = QuantizedBank(bank, precision="int8", fp32_copy=bank)
+    rows = torch.tensor([3, 7, 11])
+    assert torch.equal(quantized[-1, rows], bank[-1, rows])
+
+
+def test_pq_bank_codes_and_decoding(bank):
+    pq = PQBank(bank, m=8)
+    assert pq.codes.shape == (2, 2000, 8) and pq.codes.dtype == torch.uint8
+    assert pq[-1].shape == (2000, 32)
+    # decoding beats the mean patch by a wide margin
+    err = (pq[-1] - bank[-1]).pow(2).sum(dim=1).mean()
+    assert err < 0.5 * (bank[-1] - bank[-1].mean(dim=0)).pow(2).sum(dim=1).mean()
+
+
+def test_pq_bank_rejects_indivisible_channels(bank):
+    with pytest.raises(ValueError):
+        PQBank(bank, m=7)
+
+
+def test_rerank_orders_candidates_exactly(bank):
+    query = bank[-1, :10] + 0.01
+    cand = torch.stack([torch.randperm(2000)[:20] for _ in range(10)])
+    cand[:, 5] = torch.arange(10)
+    dist, idx = rerank(bank, query, cand, k=1)
+    assert torch.equal(idx[:, 0], torch.arange(10))
+    assert torch.allclose(dist[:, 0], torch.linalg.norm(bank[-1, :10] - query, dim=1))
+
+
+@pytest.mark.parametrize("make_index", [
+    lambda b: QuantizedIndex(QuantizedBank(b, precision="int8", fp32_copy=b), rerank_k=16),
+    lambda b: PQIndex(PQBank(b, m=8, fp32_copy=b), rerank_k=64),
+])
+def test_compressed_indexes_find_own_rows(bank, make_index):
+    query = bank[-1, :50] + 0.001
+    _, idx = make_index(bank).search(query, k=1)
+    assert (idx[:, 0] == torch.arange(50)).float().mean() >= 0.95
+
+
+def test_checkpoint_hashes_follow_file_content(tmp_path):
+    ckpt = tmp_path / "unet.pt"
+    ckpt.write_bytes(b"weights")
+    args = SimpleNamespace(load_unet_ckpt=str(ckpt), load_vae_ckpt="", load_controlnet_ckpt=str(ckpt),
+                           method_name="ddiminvunified_memory")
+    hashes = checkpoint_hashes(args)
+    assert hashes["unet_ckpt"] and hashes["vae_ckpt"] == "" and hashes["controlnet_ckpt"] == ""
+    ckpt.write_bytes(b"other weights")
+    assert checkpoint_hashes(args)["unet_ckpt"] != hashes["unet_ckpt"]
+
+
+def test_ids_hash_changes_with_the_split():
+    assert ids_hash(["a.png", "b.png"]) == ids_hash(["a.png", "b.png"])
+    assert ids_hash(["a.png", "b.png"]) != ids_hash(["a.png"])
+    assert ids_hash(["a.png", "b.png"]) != ids_hash(["b.png", "a.png"])
@@ -0,0 +1,236 @@
+import pytest
+import torch
+from utils.knn_util import (knn_search, knn_graph, update_knn_graph, ExactIndex, IVFIndex, GraphIndex, ImagePrefilterIndex, ClusterIndex,
+                            LocalWindowIndex)
+
+
+def brute_force(query, lib, k):
+    return torch.topk(torch.cdist(query, lib), k=k, largest=False)
+
+
+@pytest.fixture
+def data():
+    generator = torch.Generator().manual_seed(0)
+    return torch.randn(64, 16, generator=generator), torch.randn(1000, 16, generator=generator)
+
+
+@pytest.mark.parametrize("tile_size", [0, 1, 64, 333, 5000])
+def test_knn_search_tiles_match_full_search(data, tile_size):
+    query, lib = data
+    dist, idx = knn_search(query, lib, k=5, tile_size=tile_size)
+    ref_dist, ref_idx = brute_force(query, lib, 5)
+    assert torch.equal(idx, ref_idx)
+    assert torch.allclose(dist, ref_dist, atol=1e-5)
+
+
+@pytest.mark.parametrize("tile_size", [0, 128, 999])
+def test_exact_index_matches_brute_force(data, tile_size):
+    query, lib = data
+    dist, idx = ExactIndex(lib, tile_size=tile_size).search(query, k=3)
+    ref_dist, ref_idx = brute_force(query, lib, 3)
+    assert torch.equal(idx, ref_idx)
+    assert torch.allclose(dist, ref_dist, atol=1e-4)
+
+
+@pytest.mark.parametrize("tile_size", [0, 4])
+def test_exact_index_empty_bank(tile_size):
+    dist, idx = ExactIndex(torch.empty(0, 16), tile_size=tile_size).search(torch.randn(7, 16), k=2)
+    assert dist.shape == idx.shape == (7, 2)
+    assert torch.isinf(dist).all() and (idx == -1).all()
+
+
+def test_exact_index_pads_when_k_exceeds_bank(data):
+    query, lib = data
+    dist, idx = ExactIndex(lib[:3]).search(query, k=5)
+    assert dist.shape == (64, 5)
+    assert torch.equal(idx[:, :3], brute_force(query, lib[:3], 3)[1])
+    assert torch.isinf(dist[:, 3:]).all() and (idx[:, 3:] == -1).all()
+
+
+def test_exact_index_update_keeps_norms(data):
+    _, lib = data
+    keep = torch.arange(len(lib)) % 3 != 0
+    new_lib = torch.cat([lib[keep], torch.randn(50, 16)])
+    index = ExactIndex(lib).update(new_lib, keep)
+    assert torch.allclose(index.lib_sq, new_lib.pow(2).sum(dim=1))
+
+
+def test_ivf_probing_every_cell_is_exact(data):
+    query, lib = data
+    dist, idx = IVFIndex(lib, nlist=16, nprobe=16).search(query, k=4)
+    ref_dist, ref_idx = brute_force(query, lib, 4)
+    assert torch.equal(idx, ref_idx)
+    assert torch.allclose(dist, ref_dist, atol=1e-4)
+
+
+def test_ivf_state_dict_round_trip(data):
+    query, lib = data
+    index = IVFIndex(lib, nlist=16, nprobe=4)
+    loaded = IVFIndex.from_state_dict(lib, index.state_dict(), nprobe=4)
+    assert torch.equal(index.search(query, k=2)[1], loaded.search(query, k=2)[1])
+
+
+def test_prefilter_searches_selected_images_only(data):
+    _, lib = data
+    samples = torch.arange(len(lib)) // 100  # 10 images of 100 patches
+    descs = lib.view(10, 100, -1).mean(dim=1)
+    index = ImagePrefilterIndex(ExactIndex(lib), lib, samples, descs, n_images=2)
+    query = lib[200:300] + 0.01  # patches of image 2
+    dist, idx = index.search_images(query, 1, k=1)
+    assert (samples[idx[:, 0]] == 2).all()
+
+
+def test_prefilter_falls_back_when_images_hold_too_few_patches(data):
+    _, lib = data
+    samples = torch.zeros(len(lib), dtype=torch.long)
+    samples[:2] = 1  # image 1 holds only two patches
+    descs = torch.stack([lib[2:].mean(dim=0), lib[:2].mean(dim=0)])
+    index = ImagePrefilterIndex(ExactIndex(lib), lib, samples, descs, n_images=1)
+    query = lib[:2].mean(dim=0, keepdim=True).expand(4, -1).contiguous()
+    dist, idx = index.search_images(query, 1, k=3)
+    ref_dist, ref_idx = brute_force(query, lib, 3)
+    assert torch.equal(idx, ref_idx) and (idx >= 0).all()
+
+
+@pytest.mark.parametrize("tile_size", [0, 7])
+def test_cluster_index_searches_routed_cluster_rows(data, tile_size):
+    _, lib = data
+    samples = torch.arange(len(lib)) // 100  # 10 images of 100 patches
+    groups = (samples >= 5).long()
+    descs = lib.view(10, 100, -1).mean(dim=1)
+    centroids = torch.stack([descs[:5].mean(dim=0), descs[5:].mean(dim=0)])
+    index = ClusterIndex(ExactIndex(lib), lib, groups, centroids, tile_size=tile_size)
+    query = lib[700:800] + 0.01  # patches of image 7, routed to cluster 1
+    dist, idx = index.search_images(query, 1, k=3)
+    ref_dist, ref_idx = brute_force(query, lib[500:], 3)
+    assert torch.equal(idx, ref_idx + 500)
+    assert torch.allclose(dist, ref_dist, atol=1e-4)
+
+
+def test_cluster_index_pads_clusters_smaller_than_k(data):
+    _, lib = data
+    groups = torch.zeros(len(lib), dtype=torch.long)
+    groups[:2] = 1
+    centroids = torch.stack([lib[2:].mean(dim=0), lib[:2].mean(dim=0)])
+    index = ClusterIndex(ExactIndex(lib), lib, groups, centroids)
+    query = lib[:2].mean(dim=0, keepdim=True)
+    dist, idx = index.search_images(query, 1, k=3)
+    assert set(idx[0, :2].tolist()) == {0, 1}
+    assert idx[0, 2] == -1 and torch.isinf(dist[0, 2])
+
+
+def test_ivf_falls_back_when_probed_cells_hold_fewer_than_k_rows(data):
+    query, lib = data
+    index = IVFIndex(lib, nlist=256, nprobe=1)
+    dist, idx = index.search(query, k=16)
+    assert (idx >= 0).all() and torch.isfinite(dist).all()
+    # queries served by the fallback are exact
+    cells = index.coarse_index.search(query, k=1)[1][:, 0].tolist()
+    short = torch.tensor([index.offsets[c + 1] - index.offsets[c] < 16 for c in cells])
+    assert short.any()
+    assert torch.equal(idx[short], brute_force(query[short], lib, 16)[1])
+
+
+@pytest.mark.parametrize("tile_size", [0, 4, 10])
+def test_local_window_matches_brute_force_within_window(tile_size):
+    generator = torch.Generator().manual_seed(0)
+    lib = torch.randn(4 * 64, 16, generator=generator)  # 4 images of an 8 x 8 feature map
+    positions = torch.arange(len(lib)) % 64
+    index = LocalWindowIndex(ExactIndex(lib), lib, positions, (8, 8), window=3, tile_size=tile_size)
+    assert index.lib is lib
+    query = torch.randn(2 * 64, 16, generator=generator)
+    dist, idx = index.search_images(query, 2, k=2)
+    # every window holds at least 4 rows, so all results come from the window around the query position
+    qpos = torch.arange(len(query)) % 64
+    for q in range(len(query)):
+        near = ((positions // 8 - qpos[q] // 8).abs() <= 1) & ((positions % 8 - qpos[q] % 8).abs() <= 1)
+        ref_dist, ref_idx = brute_force(query[q:q + 1], lib[near], 2)
+        assert torch.equal(idx[q], near.nonzero().squeeze(1)[ref_idx[0]])
+        assert torch.allclose(dist[q], ref_dist[0], atol=1e-4)
+
+
+def test_local_window_falls_back_when_window_holds_fewer_than_k_rows():
+    generator = torch.Generator().manual_seed(0)
+    lib = torch.randn(2 * 64, 16, generator=generator)
+    positions = torch.arange(len(lib)) % 64
+    index = LocalWindowIndex(ExactIndex(lib), lib, positions, (8, 8), window=1)  # 2 rows per window
+    query = torch.randn(64, 16, generator=generator)
+    dist, idx = index.search_images(query, 1, k=3)
+    ref_dist, ref_idx = brute_force(query, lib, 3)
+    assert (idx >= 0).all() and torch.isfinite(dist).all()
+    assert torch.equal(idx, ref_idx)
+
+
+def test_knn_graph_over_exact_index_drops_self_match(data):
+    _, lib = data
+    graph = knn_graph(ExactIndex(lib, tile_size=128), lib, degree=2, chunk=300)
+    assert torch.equal(graph, brute_force(lib, lib, 3)[1][:, 1:])
+
+
+def test_knn_graph_drops_self_match_by_index_with_duplicate_rows(data):
+    _, lib = data
+    lib = torch.cat([lib[:10], lib[:10]])  # row i and row i + 10 are the same patch
+    graph = knn_graph(ExactIndex(lib), lib, degree=2)
+    rows = torch.arange(len(lib)).unsqueeze(1)
+    assert (graph != rows).all()
+    # the duplicate is the nearest other row
+    assert (graph == (rows + 10) % 20).any(dim=1).all()
+
+
+def test_update_knn_graph_matches_rebuilt_graph(data):
+    _, lib = data
+    keep = torch.arange(len(lib)) % 4 != 0
+    new_lib = torch.cat([lib[keep], torch.randn(100, 16, generator=torch.Generator().manual_seed(1))])
+    graph = knn_graph(ExactIndex(lib), lib, degree=3)
+    updated = update_knn_graph(ExactIndex(new_lib, tile_size=128), new_lib, graph, keep, tile_size=64, chunk=300)
+    assert torch.equal(updated, knn_graph(ExactIndex(new_lib), new_lib, degree=3))
+
+
+def test_ivf_reads_cells_from_the_library_and_updates(data):
+    query, lib = data
+    index = IVFIndex(lib, nlist=16, nprobe=16)
+    assert index.index.lib is lib and set(index.state_dict()) == {"centroids", "order", "offsets", "lib_sq"}
+    keep = torch.arange(len(lib)) % 3 != 0
+    new_lib = torch.cat([lib[keep], torch.randn(50, 16)])
+    dist, idx = index.update(new_lib, keep).search(query, k=4)
+    assert torch.equal(idx, brute_force(query, new_lib, 4)[1])
+
+
+def test_graph_index_bounds_degree_and_finds_nearest_rows(data):
+    query, lib = data
+    index = GraphIndex(lib, degree=8, ef=32, batch_size=100)
+    assert index.graph.shape == (len(lib), 8)
+    assert (index.graph != torch.arange(len(lib)).unsqueeze(1)).all() and (index.graph >= 0).all()
+    dist, idx = index.search(query, k=3)
+    ref_dist, ref_idx = brute_force(query, lib, 3)
+    assert (idx[:, 0] == ref_idx[:, 0]).float().mean() >= 0.95
+    assert torch.allclose(dist, torch.linalg.norm(lib[idx] - query.unsqueeze(1), dim=2), atol=1e-4)
+
+
+def test_graph_index_state_dict_round_trip(data):
+    query, lib = data
+    index = GraphIndex(lib, degree=8, ef=16)
+    loaded = GraphIndex.from_state_dict(lib, index.state_dict(), ef=16)
+    assert torch.equal(index.search(query, k=2)[1], loaded.search(query, k=2)[1])
+
+
+def test_graph_index_update_drops_removed_rows_and_inserts_new_ones(data):
+    query, lib = data
+    keep = torch.arange(len(lib)) % 3 != 0
+    new_lib = torch.cat([lib[keep], torch.randn(200, 16, generator=torch.Generator().manual_seed(1))])
+    index = GraphIndex(lib, degree=8, ef=32).update(new_lib, keep)
+    assert index.graph.shape == (len(new_lib), 8)
+    assert (index.graph >= 0).all() and (index.graph < len(new_lib)).all()
+    assert (index.entry_ids < len(new_lib)).all()
+    # the new rows are reachable
+    dist, idx = index.search(new_lib[-200:], k=1)
+    assert (idx[:, 0] == torch.arange(int(keep.sum()), len(new_lib))).float().mean() >= 0.95
+    _, ref_idx = brute_force(query, new_lib, 1)
+    assert (index.search(query, k=1)[1] == ref_idx).float().mean() >= 0.95
+
+
+def test_graph_index_pads_small_libraries(data):
+    query, lib = data
+    dist, idx = GraphIndex(lib[:3], degree=8).search(query, k=5)
+    assert torch.equal(idx[:, :3], brute_force(query, lib[:3], 3)[1])
+    assert torch.isinf(dist[:, 3:]).all() and (idx[:, 3:] == -1).all()
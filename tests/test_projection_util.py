@@ -0,0 +1,36 @@
+import torch
+from utils.projection_util import FeatureProjection
+from utils.gaussian_util import LocationGaussian
+
+
+def batches(n=4, C=16):
+    # (B, C, H, W) batches whose spread grows from batch to batch, so the first batch alone is not representative
+    generator = torch.Generator().manual_seed(0)
+    return [torch.randn(3, C, 4, 4, generator=generator) * (1 + i * torch.arange(C) / C).view(1, -1, 1, 1) + i
+            for i in range(n)]
+
+
+def test_pca_is_fitted_on_every_batch():
+    features = batches()
+    projection = FeatureProjection("pca", out_dim=4)
+    for x in features:
+        projection.update(x)
+    projection.fit()
+    x = torch.cat(features).permute(0, 2, 3, 1).reshape(-1, 16)
+    eigvals, eigvecs = torch.linalg.eigh(torch.cov(x.T))
+    assert torch.allclose(projection.mean, x.mean(dim=0), atol=1e-5)
+    # same principal axes up to their sign
+    assert torch.allclose((projection.components * eigvecs[:, -4:].flip(1)).sum(dim=0).abs(), torch.ones(4), atol=1e-4)
+
+
+def test_gaussian_projected_after_fit_matches_projected_features():
+    features = batches()
+    projection = FeatureProjection("pca", out_dim=4).fit(torch.cat(features))
+    full, projected = LocationGaussian(), LocationGaussian()
+    for x in features:
+        full.update(x)
+        projected.update(projection(x))
+    full.fit(projection)
+    projected.fit()
+    assert torch.allclose(full.mean, projected.mean, atol=1e-4)
+    assert torch.allclose(full.inv_chol, projected.inv_chol, rtol=1e-3, atol=1e-3)
@@ -0,0 +1,30 @@
+import torch
+from utils.utils import KNNGaussianBlur, GaussianBlur
+
+
+def score_maps(n=8):
+    # 32 x 32 patch scores bilinearly upsampled to 256 x 256, like upsample_smap
+    generator = torch.Generator().manual_seed(0)
+    maps = torch.rand(n, 1, 32, 32, generator=generator) * 5
+    return torch.nn.functional.interpolate(maps, size=(256, 256), mode='bilinear')
+
+
+def test_gaussian_blur_matches_pil_blur():
+    maps = score_maps()
+    out = GaussianBlur(4)(maps)
+    ref = torch.stack([KNNGaussianBlur(4)(maps[b]) for b in range(len(maps))])
+    # PIL approximates the Gaussian with box passes on 8-bit maps, about 2% of the map maximum apart at most
+    tolerance = 0.03 * maps.amax(dim=(1, 2, 3), keepdim=True)
+    assert ((out - ref).abs() <= tolerance).all()
+    # and within a few 8-bit steps on average
+    assert ((out - ref).abs() / maps.amax(dim=(1, 2, 3), keepdim=True)).mean() < 3 / 255
+
+
+def test_gaussian_blur_keeps_constant_maps_and_mass():
+    blur = GaussianBlur(4)
+    constant = torch.full((2, 1, 64, 48), 3.0)
+    assert torch.allclose(blur(constant), constant, atol=1e-5)
+    # a peak away from the borders keeps its mass
+    peak = torch.zeros(1, 1, 64, 64)
+    peak[..., 32, 32] = 1
+    assert torch.allclose(blur(peak).sum(), torch.tensor(1.0), atol=1e-5)
@@ -0,0 +1,337 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+from tqdm import tqdm
+from sklearn import random_projection
+from utils.knn_util import kmeans, knn_search, ExactIndex
+
+HEADER_FILE = "header.json"
+
+
+def file_hash(path, chunk_size=1 << 20):
+    '''sha256 of a checkpoint file, "" when the file does not exist (pretrained weights).'''
+    if not path or not os.path.isfile(path):
+        return ""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def checkpoint_hashes(args):
+    '''Content hashes of the checkpoints a fitted bank depends on, computed once per run for every class.'''
+    return {
+        "unet_ckpt": file_hash(args.load_unet_ckpt),
+        "vae_ckpt": file_hash(args.load_vae_ckpt),
+        "controlnet_ckpt": file_hash(args.load_controlnet_ckpt) if args.method_name == "controlnet_ddiminv_memory" else "",
+    }
+
+
+def ids_hash(sample_ids):
+    '''sha256 of a list of sample IDs, e.g. the training split a bank was fitted on.'''
+    return hashlib.sha256("\n".join(sample_ids).encode()).hexdigest()
+
+
+
+def sparse_projection(z_libs, eps=0.90, n_components="auto", seed=0):
+    '''
+    Project every (N_i, D) tensor of z_libs, on any device, with one sparse random projection fitted on z_libs[0]
+    and return the float32 CPU projections with the n_components of the projection. The projection matrix only
+    depends on (n_components, D, seed), so passing the returned n_components again gives back the same projection.
+    n_components 0 (or a projection that cannot be fitted) leaves z_libs in the full dimension.
+    '''
+    if n_components == 0:
+        return z_libs, 0
+    transformer = random_projection.SparseRandomProjection(n_components=n_components, eps=eps, random_state=seed)
+    try:
+        transformer.fit(z_libs[0].cpu().numpy())
+    except ValueError:
+        print("Could not project the memory bank for coreset selection, using the full dimension.")
+        return z_libs, 0
+    z_libs = [torch.tensor(transformer.transform(z_lib.cpu().numpy()), dtype=torch.float32) for z_lib in z_libs]
+    return z_libs, int(transformer.n_components_)
+
+
+def greedy_coreset(z_lib, n=1000, device="cpu", float16=True, min_distances=None):
+    '''
+    Greedy k-center selection (PatchCore) of n rows of z_lib (N, D), e.g. projected by sparse_projection. With
+    min_distances, the distance of every row to an already selected set, the selection continues from that set
+    instead of starting from row 0. Returns the selected row numbers on the CPU.
+    '''
+    device = torch.device(device)
+    z_lib = z_lib.to(device)
+    if float16 and device.type == "cuda":
+        z_lib = z_lib.half()
+
+    if min_distances is None:
+        select_idx = 0
+        coreset_idx = [torch.tensor(select_idx)]
+        min_distances = torch.linalg.norm(z_lib - z_lib[select_idx:select_idx + 1], dim=1, keepdims=True)
+    else:
+        coreset_idx = []
+        min_distances = min_distances.view(-1, 1).to(z_lib)
+    for _ in tqdm(range(n - len(coreset_idx)), desc="Coreset subsampling"):
+        select_idx = torch.argmax(min_distances)
+        last_item = z_lib[select_idx:select_idx + 1]
+        distances = torch.linalg.norm(z_lib - last_item, dim=1, keepdims=True)
+        min_distances = torch.minimum(distances, min_distances)
+        min_distances[select_idx] = 0
+        coreset_idx.append(select_idx.to('cpu'))
+    return torch.stack(coreset_idx)
+
+
+def save_memory_bank(bank_dir, header, tensors, samples=()):
+    '''
+    Save a fitted memory bank as one .npy file per tensor plus a json header, together with the IDs of the
+    training samples in the bank. The header is written last, so a bank without header.json is incomplete and
+    never loaded. Every file is written next to its target and renamed over it, so a bank that is still
+    memory-mapped can be saved back to its own directory.
+    '''
+    os.makedirs(bank_dir, exist_ok=True)
+    header_path = os.path.join(bank_dir, HEADER_FILE)
+    if os.path.exists(header_path):
+        os.remove(header_path)
+    for name, tensor in tensors.items():
+        path = os.path.join(bank_dir, name + ".npy")
+        np.save(path + ".tmp.npy", tensor.detach().cpu().numpy())
+        os.replace(path + ".tmp.npy", path)
+    with open(header_path, "w") as f:
+        json.dump({"header": header, "tensors": list(tensors.keys()), "samples": list(samples)}, f, indent=2)
+
+
+def load_memory_bank(bank_dir, header):
+    '''
+    Open a saved memory bank whose header matches, None otherwise.
+    Tensors are memory-mapped copy-on-write, so nothing is read into RAM until it is touched.
+    '''
+    header_path = os.path.join(bank_dir, HEADER_FILE)
+    if not os.path.isfile(header_path):
+        return None
+    with open(header_path) as f:
+        saved = json.load(f)
+    # round trip through json so tuples and lists compare equal
+    if saved["header"] != json.loads(json.dumps(header)):
+        return None
+    tensors = {}
+    for name in saved["tensors"]:
+        tensors[name] = torch.from_numpy(np.load(os.path.join(bank_dir, name + ".npy"), mmap_mode="c"))
+    return tensors
+
+
+def load_bank_samples(bank_dir):
+    '''IDs of the training samples in a saved memory bank, in the order of their sample numbers.'''
+    with open(os.path.join(bank_dir, HEADER_FILE)) as f:
+        return json.load(f).get("samples", [])
+
+
+class StreamingBank():
+    '''
+    (timesteps, N, C) memory bank of at most budget patches, filled batch by batch during fit so the full set of
+    training patches is never held. Incoming patches closer than threshold to a bank patch or to an earlier patch
+    of their batch are rejected as near duplicates. Once the budget is full, the accepted patches are kept by
+    reservoir sampling, so every accepted patch ends up in the bank with the same probability.
+    resume starts from a fitted bank, e.g. to add the patches of new samples under the same budget.
+    '''
+    def __init__(self, budget, threshold=0.0, device="cpu", tile_size=0, seed=0):
+        self.budget = budget
+        self.threshold = threshold
+        self.device = torch.device(device)
+        self.tile_size = tile_size
+        self.generator = torch.Generator().manual_seed(seed)
+        self.patch_lib = None  # (timesteps, budget, C)
+        self.samples = None
+        self.positions = None
+        self.rows = None  # acceptance number of the patch in every slot, resumed patches count from 0
+        self.descs = []
+        self.size = 0  # filled slots
+        self.seen = 0  # accepted patches so far
+        self.n_patches = 0
+        self.n_rejected = 0
+
+    def reject_duplicates(self, lib, chunk=4096):
+        # (N, C) target slice -> bool mask of the patches that are not near duplicates
+        keep = torch.ones(len(lib), dtype=torch.bool, device=lib.device)
+        if self.threshold <= 0:
+            return keep
+        if self.size > 0:
+            dist, _ = knn_search(lib, self.patch_lib[-1, :self.size], k=1, tile_size=self.tile_size)
+            keep &= dist[:, -1] >= self.threshold
+        # a patch is a duplicate of any earlier patch of the batch closer than threshold, kept or not
+        for start in range(0, len(lib), chunk):
+            close = torch.cdist(lib[start:start + chunk], lib[:start + chunk]) < self.threshold
+            close = torch.tril(close, diagonal=start - 1)
+            keep[start:start + chunk] &= ~close.any(dim=1)
+        return keep
+
+    def allocate(self, T, C, samples, positions):
+        self.patch_lib = torch.zeros((T, self.budget, C), device=self.device)
+        self.samples = samples.new_zeros(self.budget)
+        self.positions = positions.new_zeros(self.budget)
+        self.rows = torch.full((self.budget,), -1, dtype=torch.long)
+
+    def write(self, slots, lib, samples, positions, rows):
+        self.patch_lib[:, slots.to(self.device)] = lib
+        self.samples[slots] = samples
+        self.positions[slots] = positions
+        self.rows[slots] = rows
+
+    def resume(self, lib, samples, positions, seen=0):
+        '''
+        Start from a (timesteps, N, C) bank of at most budget patches that stands for seen accepted patches
+        (N when that is not known), its patches are in slots 0 to N - 1 with rows 0 to N - 1.
+        '''
+        T, N, C = lib.shape
+        if N > self.budget:
+            raise ValueError(f"A bank of {N} patches does not fit a budget of {self.budget}")
+        self.allocate(T, C, samples, positions)
+        self.write(torch.arange(N), lib.to(self.device), samples, positions, torch.arange(N))
+        self.size = N
+        self.seen = max(N, seen)
+
+    def add(self, lib, samples, positions, descs):
+        # lib (timesteps, N, C) patches with their sample numbers and positions, descs (n_samples, C) of their samples
+        lib = lib.to(self.device)
+        self.descs.append(descs.to(self.device))
+        self.n_patches += lib.shape[1]
+        keep = self.reject_duplicates(lib[-1])
+        self.n_rejected += int((~keep).sum())
+        keep_cpu = keep.cpu()
+        lib, samples, positions = lib[:, keep], samples[keep_cpu], positions[keep_cpu]
+        T, N, C = lib.shape
+        if self.patch_lib is None:
+            self.allocate(T, C, samples, positions)
+
+        # free slots first
+        n_fill = min(self.budget - self.size, N)
+        self.write(torch.arange(self.size, self.size + n_fill), lib[:, :n_fill], samples[:n_fill], positions[:n_fill],
+                   self.seen + torch.arange(n_fill))
+        self.size += n_fill
+        # reservoir sampling: the i-th accepted patch replaces a random slot with probability budget / i
+        i = self.seen + n_fill + torch.arange(1, N - n_fill + 1)
+        r = (torch.rand(N - n_fill, generator=self.generator) * i).long()
+        replace = (r < self.budget).nonzero().squeeze(1)
+        slots = r[replace]
+        # a slot drawn twice keeps the later patch
+        order = torch.arange(len(slots))
+        last = torch.full((self.budget,), -1, dtype=torch.long).scatter_reduce(0, slots, order, "amax")
+        final = last[slots] == order
+        rows = replace[final] + n_fill
+        self.write(slots[final], lib[:, rows.to(self.device)], samples[rows], positions[rows], self.seen + rows)
+        self.seen += N
+
+    def finish(self):
+        '''The (timesteps, size, C) bank, the sample numbers and positions of its patches and the sample descriptors.'''
+        print(f"Streaming bank: {self.n_patches} patches, {self.n_rejected} near duplicates rejected, "
+              f"{self.size} of {self.seen} accepted patches kept")
+        return (self.patch_lib[:, :self.size], self.samples[:self.size], self.positions[:self.size],
+                torch.cat(self.descs))
+
+
+class QuantizedBank():
+    '''
+    (timesteps, N, C) patch library stored in float16 or per-channel-scaled int8.
+    Indexing works like the float32 tensor it replaces. Rows are read from fp32_copy (e.g. the memory-mapped
+    .npy of a saved bank) when one is given, and dequantized from the codes otherwise.
+    '''
+    def __init__(self, patch_lib, precision="fp16", device="cpu", fp32_copy=None):
+        self.precision = precision
+        self.device = torch.device(device)
+        self.fp32_copy = fp32_copy
+        self.shape = patch_lib.shape
+        if precision == "fp16":
+            self.codes = patch_lib.to(self.device, torch.float16)
+            self.scale = None
+        elif precision == "int8":
+            patch_lib = patch_lib.to(self.device)
+            # one scale per timestep slice and channel
+            self.scale = (patch_lib.abs().amax(dim=1, keepdim=True) / 127).clamp(min=1e-12)
+            self.codes = torch.round(patch_lib / self.scale).clamp(-127, 127).to(torch.int8)
+        else:
+            raise TypeError(f"Unknown bank precision: {precision}")
+
+    def __len__(self):
+        return self.shape[0]
+
+    def nbytes(self):
+        nbytes = self.codes.numel() * self.codes.element_size()
+        if self.scale is not None:
+            nbytes += self.scale.numel() * self.scale.element_size()
+        return nbytes
+
+    def dequantize(self, key, dtype=torch.float32):
+        codes = self.codes[key].to(dtype)
+        if self.scale is None:
+            return codes
+        t_key = key[0] if isinstance(key, tuple) else key
+        return codes * self.scale[t_key].to(dtype)
+
+    def __getitem__(self, key):
+        if self.fp32_copy is None:
+            return self.dequantize(key)
+        if isinstance(key, tuple):
+            key = tuple(k.cpu() if torch.is_tensor(k) else k for k in key)
+        elif torch.is_tensor(key):
+            key = key.cpu()
+        return self.fp32_copy[key].to(self.device)
+
+
+class PQBank(QuantizedBank):
+    '''
+    (timesteps, N, C) patch library compressed with product quantization. Every timestep slice has m sub-codebooks
+    of 256 centroids over C / m channels, trained on up to n_train patches, and each patch is stored as m uint8 codes.
+    Indexing decodes rows like QuantizedBank, from fp32_copy when one is given.
+    '''
+    def __init__(self, patch_lib, m=16, device="cpu", fp32_copy=None, n_train=65536, codebooks=None, codes=None):
+        T, N, C = patch_lib.shape
+        if C % m != 0:
+            raise ValueError(f"{C} channels can not be split into {m} product quantization sub-vectors")
+        self.precision = "pq"
+        self.m = m
+        self.device = torch.device(device)
+        self.fp32_copy = fp32_copy
+        self.shape = patch_lib.shape
+        if codebooks is None:
+            codebooks, codes = zip(*[self.train(patch_lib[t], n_train) for t in range(T)])
+            codebooks, codes = torch.stack(codebooks), torch.stack(codes)
+        self.codebooks = codebooks.to(self.device)  # (T, m, 256, C / m)
+        self.codes = codes.to(self.device)  # (T, N, m) uint8
+
+    def train(self, lib, n_train, chunk=65536):
+        N, C = lib.shape
+        d = C // self.m
+        generator = torch.Generator().manual_seed(0)
+        sample = lib[torch.randperm(N, generator=generator)[:n_train]].to(self.device).view(-1, self.m, d)
+        codebook = torch.stack([kmeans(sample[:, j], 256)[0] for j in range(self.m)])
+        if codebook.shape[1] < 256:
+            # fewer patches than centroids, pad with copies that are never the unique nearest
+            codebook = torch.cat([codebook, codebook[:, :1].expand(-1, 256 - codebook.shape[1], -1)], dim=1)
+        return codebook, self.encode(lib, codebook, chunk)
+
+    def encode(self, lib, codebook, chunk=65536):
+        '''(N, C) patches -> (N, m) uint8 codes of their nearest sub-centroids in codebook.'''
+        d = lib.shape[1] // self.m
+        codes = []
+        for start in range(0, lib.shape[0], chunk):
+            sub = lib[start:start + chunk].to(self.device).view(-1, self.m, d)
+            codes.append(torch.stack([ExactIndex(codebook[j]).search(sub[:, j], k=1)[1][:, 0] for j in range(self.m)], dim=1))
+        return torch.cat(codes).to(torch.uint8)
+
+    def nbytes(self):
+        return self.codes.numel() * self.codes.element_size() + self.codebooks.numel() * self.codebooks.element_size()
+
+    def state_dict(self):
+        return {"codebooks": self.codebooks, "codes": self.codes}
+
+    def dequantize(self, key, dtype=torch.float32):
+        t_key = key[0] if isinstance(key, tuple) else key
+        codes = self.codes[key].long()
+        codebooks = self.codebooks[t_key]
+        m = torch.arange(self.m, device=self.device)
+        if codes.dim() == 2:
+            rows = codebooks[m.view(1, -1), codes]
+        else:
+            rows = codebooks[torch.arange(codes.shape[0], device=self.device).view(-1, 1, 1), m.view(1, 1, -1), codes]
+        return rows.flatten(-2).to(dtype)
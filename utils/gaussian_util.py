@@ -0,0 +1,72 @@
+import torch
+
+
+class LocationGaussian():
+    '''
+    One Gaussian per feature map location (PaDiM) over (B, C, H, W) features, accumulated batch by batch so the
+    training features are never stored. The covariance is shrunk towards a scaled identity and patches are scored
+    by their Mahalanobis distance to the Gaussian of their location, independent of the number of training images.
+    '''
+    def __init__(self, shrinkage=0.01, device="cpu", mean=None, inv_chol=None):
+        self.shrinkage = shrinkage
+        self.device = torch.device(device)
+        self.mean = mean  # (H * W, C)
+        self.inv_chol = inv_chol  # (H * W, C, C) inverse Cholesky factor of the covariance
+        # running sums of the features shifted by the mean of the first batch, which keeps float32 sums accurate
+        self.n = None
+        self.shift = None
+        self.sum_x = None
+        self.sum_xx = None
+
+    @property
+    def fitted(self):
+        return self.inv_chol is not None
+
+    def nbytes(self):
+        return self.mean.numel() * self.mean.element_size() + self.inv_chol.numel() * self.inv_chol.element_size()
+
+    def update(self, features, weights=None):
+        # features (B, C, H, W), weights (B, H, W) counts every patch with its weight, 0 leaves it out
+        B, C, H, W = features.shape
+        x = features.to(self.device, torch.float32).permute(2, 3, 0, 1).reshape(H * W, B, C)
+        w = torch.ones(H * W, B, 1, device=self.device) if weights is None else \
+            weights.to(self.device, torch.float32).permute(1, 2, 0).reshape(H * W, B, 1)
+        if self.n is None:
+            self.shift = x.mean(dim=1, keepdim=True)
+            self.n = torch.zeros(H * W, 1, device=self.device)
+            self.sum_x = torch.zeros(H * W, C, device=self.device)
+            self.sum_xx = torch.zeros(H * W, C, C, device=self.device)
+        x = x - self.shift
+        self.n += w.sum(dim=1)
+        self.sum_x += (w * x).sum(dim=1)
+        self.sum_xx += torch.bmm((w * x).transpose(1, 2), x)
+
+    def fit(self, projection=None):
+        # with a fitted FeatureProjection, the Gaussians are those of the projected features
+        n = self.n.clamp(min=1)
+        mean = self.sum_x / n
+        cov = (self.sum_xx - n.unsqueeze(2) * mean.unsqueeze(2) * mean.unsqueeze(1)) / (n - 1).clamp(min=1).unsqueeze(2)
+        mean = mean + self.shift.squeeze(1)
+        if projection is not None:
+            components = projection.components.to(self.device)
+            mean = (mean - projection.mean.to(self.device)) @ components
+            cov = components.T @ cov @ components
+        C = cov.shape[-1]
+        eye = torch.eye(C, device=self.device)
+        scale = cov.diagonal(dim1=1, dim2=2).mean(dim=1).view(-1, 1, 1)
+        cov = (1 - self.shrinkage) * cov + (self.shrinkage * scale + 1e-6) * eye
+        chol = torch.linalg.cholesky(cov)
+        self.inv_chol = torch.linalg.solve_triangular(chol, eye.expand_as(chol), upper=False)
+        self.mean = mean
+        self.n = self.shift = self.sum_x = self.sum_xx = None
+        return self
+
+    def score(self, features):
+        # (B, C, H, W) -> (B, H * W) Mahalanobis distances
+        B, C, H, W = features.shape
+        diff = features.to(self.device, torch.float32).permute(2, 3, 0, 1).reshape(H * W, B, C) - self.mean.unsqueeze(1)
+        z = torch.bmm(diff, self.inv_chol.transpose(1, 2))
+        return z.norm(dim=2).T
+
+    def state_dict(self):
+        return {"mean": self.mean, "inv_chol": self.inv_chol}
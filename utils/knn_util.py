@@ -0,0 +1,699 @@
+import torch
+
+
+def merge_topk(knn_dist, knn_idx, tile_dist, tile_idx, k):
+    '''Merge the running top-k (knn_dist, knn_idx) with the candidates of a new tile.'''
+    if knn_dist is not None:
+        tile_dist = torch.cat([knn_dist, tile_dist], dim=1)
+        tile_idx = torch.cat([knn_idx, tile_idx], dim=1)
+    knn_dist, order = torch.topk(tile_dist, k=min(k, tile_dist.shape[1]), largest=False)
+    return knn_dist, torch.gather(tile_idx, 1, order)
+
+
+def knn_search(query, lib, k=1, tile_size=0, p=2):
+    '''
+    Exact k nearest neighbours of each row of query in lib.
+    With tile_size > 0 the library is walked in blocks of tile_size rows and a running top-k is merged,
+    so the peak distance matrix is (len(query), tile_size) instead of (len(query), len(lib)).
+    Returns (dist, idx), both (len(query), k), sorted by increasing distance.
+    '''
+    if tile_size <= 0 or tile_size >= lib.shape[0]:
+        dist = torch.cdist(query, lib, p=p)
+        return torch.topk(dist, k=k, largest=False)
+
+    knn_dist, knn_idx = None, None
+    for start in range(0, lib.shape[0], tile_size):
+        dist = torch.cdist(query, lib[start:start + tile_size], p=p)
+        tile_dist, tile_idx = torch.topk(dist, k=min(k, dist.shape[1]), largest=False)
+        knn_dist, knn_idx = merge_topk(knn_dist, knn_idx, tile_dist, tile_idx + start, k)
+    return knn_dist, knn_idx
+
+
+def knn_graph(index, lib, degree, chunk=4096, rows=None):
+    '''(len(rows), degree) nearest other rows of the rows (default every row) of the library lib that index searches.'''
+    rows = torch.arange(len(lib), device=lib.device) if rows is None else rows
+    graph = [torch.zeros((0, degree), dtype=torch.long, device=lib.device)]
+    for start in range(0, len(rows), chunk):
+        row = rows[start:start + chunk]
+        _, nn_idx = index.search(lib[row], k=degree + 1)
+        # drop the self match by index, a duplicate row may come before it; a row whose self match was pushed out
+        # by more than degree duplicates drops its last match instead
+        self_match = nn_idx == row.to(nn_idx.device).unsqueeze(1)
+        self_match[:, -1] |= ~self_match.any(dim=1)
+        graph.append(nn_idx[~self_match].view(len(row), degree).to(lib.device))
+    return torch.cat(graph)
+
+
+def update_knn_graph(index, lib, graph, keep, tile_size=0, chunk=4096):
+    '''
+    knn_graph of the library lib = cat(old_lib[keep], new rows) that index searches, from the (N_old, degree) graph
+    of old_lib. Only the new rows, the kept rows that lost a neighbour and the kept rows a new row is closer to than
+    their farthest neighbour are searched again, the others keep their neighbours.
+    '''
+    degree = graph.shape[1]
+    keep = keep.to(lib.device)
+    graph = graph.to(lib.device)
+    n_kept = int(keep.sum())
+    remap = torch.cumsum(keep, 0) - 1
+    remap[~keep] = -1
+    graph = torch.where(graph >= 0, remap[graph.clamp(min=0)], -1)[keep]
+    stale = (graph < 0).any(dim=1)
+    if n_kept and len(lib) > n_kept:
+        new_index = ExactIndex(lib[n_kept:], tile_size=tile_size)
+        for start in range(0, n_kept, chunk):
+            kept = lib[start:min(start + chunk, n_kept)]
+            far = torch.linalg.vector_norm(kept - lib[graph[start:start + chunk, -1].clamp(min=0)], dim=1)
+            near = new_index.search(kept, k=1)[0][:, 0].to(lib.device)
+            stale[start:start + chunk] |= near < far
+    rows = torch.cat([stale.nonzero().squeeze(1), torch.arange(n_kept, len(lib), device=lib.device)])
+    graph = torch.cat([graph, graph.new_full((len(lib) - n_kept, degree), -1)])
+    graph[rows] = knn_graph(index, lib, degree, chunk=chunk, rows=rows)
+    return graph
+
+
+class ExactIndex():
+    '''
+    Brute-force L2 index over a (N, C) patch library.
+    The squared norms of the library are computed once, so query-to-bank distances are a single
+    matmul plus a norm correction: ||q - x||^2 = ||q||^2 - 2 q.x + ||x||^2.
+    '''
+    def __init__(self, lib, tile_size=0, lib_sq=None):
+        self.lib = lib
+        self.lib_sq = lib.pow(2).sum(dim=1) if lib_sq is None else lib_sq
+        self.tile_size = tile_size
+
+    def state_dict(self):
+        return {"lib_sq": self.lib_sq}
+
+    @classmethod
+    def from_state_dict(cls, lib, state, tile_size=0, **kwargs):
+        return cls(lib, tile_size=tile_size, lib_sq=state["lib_sq"])
+
+    def __len__(self):
+        return self.lib.shape[0]
+
+    def update(self, lib, keep):
+        '''
+        Index over lib = cat(old_lib[keep], new rows), reusing the norms of the kept rows.
+        keep is an (N,) bool mask over the rows of the current library.
+        '''
+        new_sq = lib[int(keep.sum()):].pow(2).sum(dim=1)
+        return ExactIndex(lib, tile_size=self.tile_size, lib_sq=torch.cat([self.lib_sq[keep], new_sq]))
+
+    def distances(self, query, start=0, end=None):
+        lib = self.lib[start:end]
+        lib_sq = self.lib_sq[start:end]
+        query_sq = query.pow(2).sum(dim=1, keepdim=True)
+        dist = torch.addmm(lib_sq.unsqueeze(0) + query_sq, query, lib.T, alpha=-2)
+        return dist.clamp_(min=0).sqrt_()
+
+    def search_rows(self, query, rows, k=1):
+        '''
+        Top-k of (Q, C) queries among the library rows listed in rows, as library row numbers. The rows are read
+        tile by tile with index_select instead of being copied out of the library at once.
+        '''
+        tile_size = max(1, self.tile_size if self.tile_size > 0 else len(rows))
+        query_sq = query.pow(2).sum(dim=1, keepdim=True)
+        knn_dist, knn_idx = None, None
+        for start in range(0, len(rows), tile_size):
+            tile_rows = rows[start:start + tile_size]
+            lib = self.lib.index_select(0, tile_rows)
+            dist = torch.addmm(self.lib_sq[tile_rows].unsqueeze(0) + query_sq, query, lib.T, alpha=-2).clamp_(min=0).sqrt_()
+            tile_dist, tile_idx = torch.topk(dist, k=min(k, dist.shape[1]), largest=False)
+            knn_dist, knn_idx = merge_topk(knn_dist, knn_idx, tile_dist, tile_rows[tile_idx], k)
+        return knn_dist, knn_idx
+
+    def search(self, query, k=1):
+        '''
+        Batched top-k for (Q, C) queries. Returns (dist, idx), both (Q, k), sorted by increasing distance.
+        When the library holds fewer than k rows (or none) the missing neighbours are distance inf, index -1.
+        '''
+        tile_size = max(1, self.tile_size if self.tile_size > 0 else len(self))
+        knn_dist = query.new_full((query.shape[0], k), float('inf'))
+        knn_idx = torch.full((query.shape[0], k), -1, dtype=torch.long, device=query.device)
+        for start in range(0, len(self), tile_size):
+            dist = self.distances(query, start, start + tile_size)
+            tile_dist, tile_idx = torch.topk(dist, k=min(k, dist.shape[1]), largest=False)
+            knn_dist, knn_idx = merge_topk(knn_dist, knn_idx, tile_dist, tile_idx + start, k)
+        return knn_dist, knn_idx
+
+
+def kmeans(x, n_clusters, n_iter=20, seed=0):
+    '''Plain Lloyd k-means on the device of x. Returns (centroids, assignments).'''
+    generator = torch.Generator().manual_seed(seed)
+    n_clusters = min(n_clusters, x.shape[0])
+    init = torch.randperm(x.shape[0], generator=generator)[:n_clusters].to(x.device)
+    centroids = x[init].clone()
+    for _ in range(n_iter):
+        _, assign = ExactIndex(centroids).search(x, k=1)
+        assign = assign[:, 0]
+        counts = torch.bincount(assign, minlength=n_clusters).unsqueeze(1)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        # keep empty clusters where they were
+        centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+    _, assign = ExactIndex(centroids).search(x, k=1)
+    return centroids, assign[:, 0]
+
+
+class IVFIndex():
+    '''
+    Inverted-file index: the library is partitioned into nlist k-means cells and each query only scans
+    the nprobe cells whose centroids are closest to it. Queries whose probed cells hold fewer than k rows
+    are searched exactly over the whole library.
+    A cell is a slice of order, the library rows sorted by cell, and is read from the library with index_select,
+    so the library is not copied.
+    '''
+    def __init__(self, lib, nlist=256, nprobe=8, tile_size=0):
+        self.centroids, assign = kmeans(lib, nlist)
+        self.nprobe = min(nprobe, self.centroids.shape[0])
+        self.index = ExactIndex(lib, tile_size=tile_size)
+        self.coarse_index = ExactIndex(self.centroids)
+        self.set_cells(assign)
+
+    def __len__(self):
+        return len(self.index)
+
+    def set_cells(self, assign):
+        # library rows sorted by cell, cell c holds order[offsets[c]:offsets[c + 1]]
+        self.order = torch.argsort(assign)
+        counts = torch.bincount(assign, minlength=self.centroids.shape[0])
+        self.offsets = torch.cat([counts.new_zeros(1), torch.cumsum(counts, 0)]).tolist()
+
+    def state_dict(self):
+        return {"centroids": self.centroids, "order": self.order, "offsets": torch.tensor(self.offsets),
+                "lib_sq": self.index.lib_sq}
+
+    @classmethod
+    def from_state_dict(cls, lib, state, tile_size=0, nprobe=8, **kwargs):
+        index = cls.__new__(cls)
+        index.centroids = state["centroids"]
+        index.nprobe = min(nprobe, index.centroids.shape[0])
+        index.order = state["order"]
+        index.offsets = state["offsets"].tolist()
+        index.index = ExactIndex(lib, tile_size=tile_size, lib_sq=state["lib_sq"])
+        index.coarse_index = ExactIndex(index.centroids)
+        return index
+
+    def update(self, lib, keep):
+        '''Drop the rows not in keep and assign the new rows of lib to the existing cells, without re-running k-means.'''
+        counts = torch.tensor(self.offsets[1:], device=self.order.device) - torch.tensor(self.offsets[:-1], device=self.order.device)
+        sorted_assign = torch.repeat_interleave(torch.arange(len(counts), device=self.order.device), counts)
+        assign = torch.empty_like(sorted_assign)
+        assign[self.order] = sorted_assign
+        _, new_assign = self.coarse_index.search(lib[int(keep.sum()):], k=1)
+
+        index = IVFIndex.__new__(IVFIndex)
+        index.centroids = self.centroids
+        index.nprobe = self.nprobe
+        index.index = self.index.update(lib, keep)
+        index.coarse_index = self.coarse_index
+        index.set_cells(torch.cat([assign[keep], new_assign[:, 0]]))
+        return index
+
+    def search(self, query, k=1):
+        _, probe = self.coarse_index.search(query, k=self.nprobe)
+        knn_dist = query.new_full((query.shape[0], k), float('inf'))
+        knn_idx = torch.full((query.shape[0], k), -1, dtype=torch.long, device=query.device)
+        for cell in torch.unique(probe).tolist():
+            start, end = self.offsets[cell], self.offsets[cell + 1]
+            if start == end:
+                continue
+            rows = (probe == cell).any(dim=1).nonzero().squeeze(1)
+            dist, idx = self.index.search_rows(query[rows], self.order[start:end], k)
+            knn_dist[rows], knn_idx[rows] = merge_topk(knn_dist[rows], knn_idx[rows], dist, idx, k)
+        short = (knn_idx[:, -1] < 0).nonzero().squeeze(1)
+        if len(short):
+            knn_dist[short], knn_idx[short] = self.index.search(query[short], k=k)
+        return knn_dist, knn_idx
+
+
+class GraphIndex():
+    '''
+    Single-layer HNSW-style proximity graph over a (N, C) library, built incrementally. Rows are inserted in a random
+    order, batch_size rows at a time: a batch is searched through the graph built so far with a beam of width
+    ef_construction (and exactly among itself), every row keeps at most degree of the candidates picked by the HNSW
+    neighbour heuristic, and every picked neighbour gets the reverse edge, pruned back to degree the same way.
+    The first n_entry inserted rows stand in for the upper HNSW layers: queries search them exhaustively for the
+    entry points of an ef-bounded beam search over the graph.
+    The graph is an (N, degree) tensor of library rows, -1 where a row has fewer than degree neighbours.
+    '''
+    def __init__(self, lib, degree=16, ef=32, ef_construction=64, n_entry=256, batch_size=256, tile_size=0, seed=0):
+        self.index = ExactIndex(lib, tile_size=tile_size)
+        self.set_params(ef, ef_construction, n_entry, batch_size)
+        self.graph = torch.full((len(lib), min(degree, max(1, len(lib) - 1))), -1, dtype=torch.long, device=lib.device)
+        self.entry_ids = self.graph.new_empty(0)
+        generator = torch.Generator().manual_seed(seed)
+        rows = torch.randperm(len(lib), generator=generator).to(lib.device)
+        self.insert(rows)
+        self.entry_ids = rows[:n_entry]
+
+    def set_params(self, ef, ef_construction, n_entry, batch_size, n_expand=4, max_iter=256, chunk=256):
+        self.ef = ef
+        self.ef_construction = ef_construction
+        self.n_entry = n_entry
+        self.batch_size = batch_size
+        # beam rows expanded per query and step, steps per search, and rows per batched gather
+        self.n_expand = n_expand
+        self.max_iter = max_iter
+        self.chunk = chunk
+
+    def __len__(self):
+        return len(self.index)
+
+    def state_dict(self):
+        return {"lib_sq": self.index.lib_sq, "graph": self.graph, "entry_ids": self.entry_ids}
+
+    @classmethod
+    def from_state_dict(cls, lib, state, tile_size=0, ef=32, ef_construction=64, batch_size=256, **kwargs):
+        index = cls.__new__(cls)
+        index.index = ExactIndex(lib, tile_size=tile_size, lib_sq=state["lib_sq"])
+        index.graph = state["graph"]
+        index.entry_ids = state["entry_ids"]
+        index.set_params(ef, ef_construction, max(1, len(index.entry_ids)), batch_size)
+        return index
+
+    def update(self, lib, keep):
+        '''
+        Graph over lib = cat(old_lib[keep], new rows) without rebuilding it. Rows that lost a neighbour pick new ones
+        among their remaining neighbours and the neighbours of those, then the new rows are inserted like at build time.
+        '''
+        index = GraphIndex.__new__(GraphIndex)
+        index.index = self.index.update(lib, keep)
+        index.set_params(self.ef, self.ef_construction, self.n_entry, self.batch_size)
+        n_kept = int(keep.sum())
+        remap = torch.cumsum(keep, 0) - 1
+        remap[~keep] = -1
+        kept = self.graph[keep]
+        kept = torch.where(kept >= 0, remap[kept.clamp(min=0)], -1)
+        degree = min(self.graph.shape[1], max(1, len(lib) - 1))
+        index.graph = torch.full((len(lib), degree), -1, dtype=torch.long, device=lib.device)
+        index.graph[:n_kept, :min(degree, kept.shape[1])] = kept[:, :degree]
+
+        stale = ((self.graph[keep] >= 0) & (kept < 0)).any(dim=1).nonzero().squeeze(1)
+        for start in range(0, len(stale), self.chunk):
+            rows = stale[start:start + self.chunk]
+            nbrs = index.graph[rows]
+            second = index.graph[nbrs.clamp(min=0)].masked_fill((nbrs < 0).unsqueeze(2), -1).flatten(1)
+            index.graph[rows] = index.select(rows, torch.cat([nbrs, second], dim=1))
+
+        # keep the entry points that survived, the new rows top them back up
+        entry_ids = remap[self.entry_ids]
+        index.entry_ids = entry_ids[entry_ids >= 0]
+        generator = torch.Generator().manual_seed(len(lib))
+        rows = n_kept + torch.randperm(len(lib) - n_kept, generator=generator).to(lib.device)
+        index.insert(rows)
+        index.entry_ids = torch.cat([index.entry_ids, rows])[:self.n_entry]
+        return index
+
+    def candidate_distances(self, query, cand):
+        # (Q, C) queries to the (Q, M) library rows cand, inf where cand is -1
+        lib = self.index.lib[cand.clamp(min=0)]
+        dist = query.pow(2).sum(dim=1, keepdim=True) + self.index.lib_sq[cand.clamp(min=0)] - 2 * torch.bmm(lib, query.unsqueeze(2)).squeeze(2)
+        return dist.clamp_(min=0).sqrt_().masked_fill_(cand < 0, float("inf"))
+
+    def select(self, rows, cand):
+        '''
+        Out-neighbours of the library rows rows among their (R, M) candidates cand (-1 padded, duplicates and the row
+        itself allowed). A candidate is kept when it is closer to the row than to every neighbour kept before it (the
+        HNSW heuristic, which spreads the edges over directions), then the nearest skipped candidates fill the
+        list up to degree.
+        '''
+        degree = self.graph.shape[1]
+        cand = torch.cat([cand, cand.new_full((len(rows), max(0, degree - cand.shape[1])), -1)], dim=1)
+        cand = cand.masked_fill(cand == rows.unsqueeze(1), -1)
+        cand, _ = torch.sort(cand, dim=1)
+        cand[:, 1:] = cand[:, 1:].masked_fill(cand[:, 1:] == cand[:, :-1], -1)
+        dist, order = torch.sort(self.candidate_distances(self.index.lib[rows], cand), dim=1)
+        cand = torch.gather(cand, 1, order)
+        lib = self.index.lib[cand.clamp(min=0)]
+        pair = torch.cdist(lib, lib)
+        kept = torch.zeros_like(cand, dtype=torch.bool)
+        n_kept = torch.zeros(len(rows), dtype=torch.long, device=cand.device)
+        for j in range(cand.shape[1]):
+            occluded = ((pair[:, j] < dist[:, j:j + 1]) & kept).any(dim=1)
+            kept[:, j] = torch.isfinite(dist[:, j]) & (n_kept < degree) & ~occluded
+            n_kept += kept[:, j]
+        slot = torch.arange(cand.shape[1], device=cand.device).expand_as(cand)
+        key = torch.where(kept, slot, slot + cand.shape[1]).masked_fill(~torch.isfinite(dist), 2 * cand.shape[1])
+        key, pick = torch.topk(key, k=degree, dim=1, largest=False)
+        return torch.gather(cand, 1, pick).masked_fill(key == 2 * cand.shape[1], -1)
+
+    def insert(self, rows):
+        for start in range(0, len(rows), self.batch_size):
+            batch = rows[start:start + self.batch_size]
+            query = self.index.lib[batch]
+            _, cand = self.index.search_rows(query, batch, k=min(self.ef_construction + 1, len(batch)))
+            entry_ids = torch.cat([self.entry_ids, rows[:start]])[:self.n_entry]
+            if len(entry_ids):
+                cand = torch.cat([cand, self.beam_search(query, self.ef_construction, entry_ids)[1]], dim=1)
+            nbrs = torch.cat([self.select(batch[s:s + self.chunk], cand[s:s + self.chunk]) for s in range(0, len(batch), self.chunk)])
+            self.graph[batch] = nbrs
+            self.link(batch, nbrs)
+
+    def link(self, batch, nbrs):
+        # add the reverse edge of every new edge batch -> nbrs, re-selecting the neighbours of the rows that get one
+        src = batch.unsqueeze(1).expand_as(nbrs).flatten()
+        dst = nbrs.flatten()
+        src, dst = src[dst >= 0], dst[dst >= 0]
+        dst, order = torch.sort(dst)
+        src = src[order]
+        targets, counts = torch.unique_consecutive(dst, return_counts=True)
+        if len(targets) == 0:
+            return
+        group_start = torch.cumsum(counts, 0) - counts
+        slot = torch.arange(len(dst), device=dst.device) - torch.repeat_interleave(group_start, counts)
+        incoming = dst.new_full((len(targets), int(counts.max())), -1)
+        incoming[torch.repeat_interleave(torch.arange(len(targets), device=dst.device), counts), slot] = src
+        for start in range(0, len(targets), self.chunk):
+            rows = targets[start:start + self.chunk]
+            self.graph[rows] = self.select(rows, torch.cat([self.graph[rows], incoming[start:start + self.chunk]], dim=1))
+
+    def search(self, query, k=1):
+        knn_dist, knn_idx = [], []
+        for start in range(0, query.shape[0], self.chunk):
+            dist, idx = self.beam_search(query[start:start + self.chunk], max(self.ef, k), self.entry_ids)
+            knn_dist.append(dist[:, :k])
+            knn_idx.append(idx[:, :k])
+        return torch.cat(knn_dist), torch.cat(knn_idx)
+
+    def beam_search(self, query, ef, entry_ids):
+        '''
+        Beam of the ef nearest rows found so far for each of the (Q, C) queries, sorted by distance and -1 / inf padded.
+        Every step expands the n_expand nearest beam rows not expanded yet, and a query is done once its whole beam
+        has been expanded, i.e. no unexpanded row is nearer than the ef-th best one.
+        '''
+        beam_dist, beam = self.index.search_rows(query, entry_ids, k=min(ef, len(entry_ids)))
+        pad = ef - beam.shape[1]
+        beam_dist = torch.cat([beam_dist, beam_dist.new_full((len(query), pad), float("inf"))], dim=1)
+        beam = torch.cat([beam, beam.new_full((len(query), pad), -1)], dim=1)
+        expanded = beam < 0
+        n_expand = min(self.n_expand, ef)
+        for _ in range(self.max_iter):
+            _, pick = torch.topk(beam_dist.masked_fill(expanded, float("inf")), k=n_expand, dim=1, largest=False)
+            fresh = ~torch.gather(expanded, 1, pick)
+            if not fresh.any():
+                break
+            expanded.scatter_(1, pick, True)
+            nodes = torch.gather(beam, 1, pick).masked_fill(~fresh, -1)
+            cand = self.graph[nodes.clamp(min=0)].masked_fill((nodes < 0).unsqueeze(2), -1).flatten(1)
+            all_idx = torch.cat([beam, cand], dim=1)
+            all_dist = torch.cat([beam_dist, self.candidate_distances(query, cand)], dim=1)
+            all_expanded = torch.cat([expanded, cand < 0], dim=1)
+            # drop the rows already in the beam, the stable sort keeps the beam copy first
+            all_idx, order = torch.sort(all_idx, dim=1, stable=True)
+            all_dist = torch.gather(all_dist, 1, order)
+            all_expanded = torch.gather(all_expanded, 1, order)
+            dup = torch.zeros_like(all_expanded)
+            dup[:, 1:] = all_idx[:, 1:] == all_idx[:, :-1]
+            all_idx = all_idx.masked_fill(dup, -1)
+            all_dist = all_dist.masked_fill(dup, float("inf"))
+            all_expanded = all_expanded | dup
+            beam_dist, order = torch.topk(all_dist, k=ef, dim=1, largest=False)
+            beam = torch.gather(all_idx, 1, order)
+            expanded = torch.gather(all_expanded, 1, order)
+        return beam_dist, beam
+
+
+INDEX_TYPES = {
+    "exact": ExactIndex,
+    "ivf": IVFIndex,
+    "hnsw": GraphIndex,
+}
+
+
+def build_index(index_type, lib, tile_size=0, nlist=256, nprobe=8, degree=16, ef=32):
+    if index_type == "exact":
+        return ExactIndex(lib, tile_size=tile_size)
+    elif index_type == "ivf":
+        return IVFIndex(lib, nlist=nlist, nprobe=nprobe, tile_size=tile_size)
+    elif index_type == "hnsw":
+        return GraphIndex(lib, degree=degree, ef=ef, tile_size=tile_size)
+    else:
+        raise TypeError(f"Unknown index type: {index_type}")
+
+
+def load_index(index_type, lib, state, tile_size=0, nprobe=8, ef=32):
+    if index_type not in INDEX_TYPES:
+        raise TypeError(f"Unknown index type: {index_type}")
+    return INDEX_TYPES[index_type].from_state_dict(lib, state, tile_size=tile_size, nprobe=nprobe, ef=ef)
+
+
+class ImagePrefilterIndex():
+    '''
+    Two-stage search over a (N, C) library of patches from whole training images. Every training image has a
+    pooled descriptor, the mean of its patches. A query image first picks its n_images nearest training images
+    by descriptor, then its patches are searched exactly over the patches of those images only.
+    Plain search() goes to the wrapped index over the whole library.
+    '''
+    def __init__(self, index, lib, samples, descs, n_images=8):
+        self.index = index
+        self.lib = lib
+        self.lib_sq = lib.pow(2).sum(dim=1)
+        self.n_images = min(n_images, descs.shape[0])
+        self.desc_index = ExactIndex(descs)
+        # bank rows grouped by training image
+        samples = samples.to(lib.device)
+        self.order = torch.argsort(samples)
+        counts = torch.bincount(samples, minlength=descs.shape[0])
+        self.offsets = torch.cat([counts.new_zeros(1), torch.cumsum(counts, 0)]).tolist()
+
+    def __len__(self):
+        return len(self.index)
+
+    def state_dict(self):
+        return self.index.state_dict()
+
+    def search(self, query, k=1):
+        return self.index.search(query, k=k)
+
+    def search_images(self, query, n_query_images, k=1):
+        '''query holds the patches of n_query_images images, one image after the other.'''
+        query = query.view(n_query_images, -1, query.shape[-1])
+        _, near = self.desc_index.search(query.mean(dim=1), k=self.n_images)
+        knn_dist, knn_idx = [], []
+        for b, images in enumerate(near.tolist()):
+            rows = torch.cat([self.order[self.offsets[i]:self.offsets[i + 1]] for i in images])
+            if len(rows) < k:
+                # the selected images hold fewer than k patches (e.g. all background), search the whole bank
+                dist, idx = self.index.search(query[b], k=k)
+            else:
+                dist, idx = ExactIndex(self.lib[rows], lib_sq=self.lib_sq[rows]).search(query[b], k=k)
+                idx = rows[idx]
+            knn_dist.append(dist)
+            knn_idx.append(idx)
+        return torch.cat(knn_dist), torch.cat(knn_idx)
+
+
+class ClusterIndex():
+    '''
+    Library partitioned into sub-banks, one per cluster of training images (groups holds the cluster of every row).
+    Each query image is routed to the n_route clusters whose centroids are nearest to its pooled descriptor and
+    searched exactly in those sub-banks only. Plain search() goes to the wrapped index over the whole library.
+    A sub-bank is only the list of its library rows, read tile by tile with index_select, so the library is not copied.
+    '''
+    def __init__(self, index, lib, groups, centroids, n_route=1, tile_size=0):
+        self.index = index
+        self.lib = lib
+        self.lib_sq = lib.pow(2).sum(dim=1)
+        self.tile_size = tile_size if tile_size > 0 else 65536
+        self.n_route = min(n_route, centroids.shape[0])
+        self.centroid_index = ExactIndex(centroids)
+        groups = groups.to(lib.device)
+        self.sub_rows = [(groups == c).nonzero().squeeze(1) for c in range(centroids.shape[0])]
+
+    def __len__(self):
+        return len(self.index)
+
+    def state_dict(self):
+        return self.index.state_dict()
+
+    def search(self, query, k=1):
+        return self.index.search(query, k=k)
+
+    def search_rows(self, query, rows, k):
+        # exact top-k of query among the library rows listed in rows, as library row numbers
+        query_sq = query.pow(2).sum(dim=1, keepdim=True)
+        knn_dist, knn_idx = None, None
+        for start in range(0, len(rows), self.tile_size):
+            tile_rows = rows[start:start + self.tile_size]
+            lib = self.lib.index_select(0, tile_rows)
+            dist = torch.addmm(self.lib_sq[tile_rows].unsqueeze(0) + query_sq, query, lib.T, alpha=-2).clamp_(min=0).sqrt_()
+            tile_dist, tile_idx = torch.topk(dist, k=min(k, dist.shape[1]), largest=False)
+            knn_dist, knn_idx = merge_topk(knn_dist, knn_idx, tile_dist, tile_rows[tile_idx], k)
+        return knn_dist, knn_idx
+
+    def search_images(self, query, n_query_images, k=1):
+        '''query holds the patches of n_query_images images, one image after the other.'''
+        query = query.view(n_query_images, -1, query.shape[-1])
+        _, route = self.centroid_index.search(query.mean(dim=1), k=self.n_route)
+        knn_dist = query.new_full((*query.shape[:2], k), float("inf"))
+        knn_idx = route.new_full((*query.shape[:2], k), -1)
+        # one search per cluster over all of the images routed to it
+        for c in torch.unique(route).tolist():
+            if len(self.sub_rows[c]) == 0:
+                continue
+            images = (route == c).any(dim=1).nonzero().squeeze(1)
+            dist, idx = self.search_rows(query[images].flatten(0, 1), self.sub_rows[c], k)
+            dist, idx = merge_topk(knn_dist[images].flatten(0, 1), knn_idx[images].flatten(0, 1), dist, idx, k)
+            knn_dist[images], knn_idx[images] = dist.view(len(images), -1, k), idx.view(len(images), -1, k)
+        return knn_dist.flatten(0, 1), knn_idx.flatten(0, 1)
+
+
+class LocalWindowIndex():
+    '''
+    Position-conditioned search for registered objects. The (N, C) library rows come from an H x W feature map and
+    are listed sorted by (position, sample), so the rows at a position are one range of that list. A query patch at
+    (h, w) is compared with the rows at the window x window positions around (h, w) by one batched matmul per window
+    offset, over positions padded to the most populated one. The rows are read from the library with index_select,
+    tile_size rows at a time, so the library is not copied.
+    Query patches whose best local distance exceeds fallback, or whose window holds fewer than k rows, are searched
+    again over the whole library with the wrapped index, which also serves plain search().
+    '''
+    def __init__(self, index, lib, positions, feature_map_dims, window=5, fallback=float("inf"), tile_size=0):
+        self.index = index
+        self.lib = lib
+        self.lib_sq = lib.pow(2).sum(dim=1)
+        self.H, self.W = feature_map_dims
+        self.radius = window // 2
+        self.fallback = fallback
+        self.tile_size = tile_size if tile_size > 0 else 65536
+        positions = positions.to(lib.device)
+        # position p holds the library rows order[offsets[p]:offsets[p + 1]], stable so that samples stay in bank order
+        self.order = torch.sort(positions, stable=True)[1]
+        self.counts = torch.bincount(positions, minlength=self.H * self.W)
+        self.offsets = torch.cumsum(self.counts, 0) - self.counts
+        self.max_count = int(self.counts.max()) if len(positions) else 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def state_dict(self):
+        return self.index.state_dict()
+
+    def search(self, query, k=1):
+        return self.index.search(query, k=k)
+
+    def slots(self, src):
+        # (len(src), max_count) library rows at the positions src, -1 where a position has fewer rows
+        slot = torch.arange(self.max_count, device=src.device)
+        rows = self.order[(self.offsets[src].unsqueeze(1) + slot).clamp(max=len(self.order) - 1)]
+        return torch.where(slot < self.counts[src].unsqueeze(1), rows, -1)
+
+    def search_images(self, query, n_query_images, k=1):
+        '''query holds the H * W patches of n_query_images images, one image after the other.'''
+        C = query.shape[-1]
+        grid_query = query.view(n_query_images, self.H * self.W, C).transpose(0, 1)  # (H * W, B, C)
+        query_sq = grid_query.pow(2).sum(dim=2, keepdim=True)
+        hs, ws = torch.meshgrid(torch.arange(self.H, device=query.device), torch.arange(self.W, device=query.device), indexing="ij")
+        hs, ws = hs.flatten(), ws.flatten()
+        knn_dist = query.new_full((self.H * self.W, n_query_images, k), float("inf"))
+        knn_idx = self.order.new_full((self.H * self.W, n_query_images, k), -1)
+        # positions per gathered tile
+        step = max(1, self.tile_size // max(1, self.max_count))
+        window = range(-self.radius, self.radius + 1) if self.max_count else []
+        for dh, dw in [(dh, dw) for dh in window for dw in window]:
+            valid = ((hs + dh >= 0) & (hs + dh < self.H) & (ws + dw >= 0) & (ws + dw < self.W)).nonzero().squeeze(1)
+            for start in range(0, len(valid), step):
+                dst = valid[start:start + step]
+                slots = self.slots((hs[dst] + dh) * self.W + ws[dst] + dw)
+                lib = self.lib.index_select(0, slots.clamp(min=0).flatten()).view(*slots.shape, C)
+                lib_sq = self.lib_sq[slots.clamp(min=0)].masked_fill(slots < 0, float("inf"))
+                dist = query_sq[dst] + lib_sq.unsqueeze(1) - 2 * torch.bmm(grid_query[dst], lib.transpose(1, 2))
+                dist, idx = torch.topk(dist, k=min(k, dist.shape[2]), dim=2, largest=False)
+                idx = torch.gather(slots.unsqueeze(1).expand(-1, n_query_images, -1), 2, idx)
+                merged = merge_topk(knn_dist[dst].flatten(0, 1), knn_idx[dst].flatten(0, 1), dist.flatten(0, 1), idx.flatten(0, 1), k)
+                knn_dist[dst], knn_idx[dst] = merged[0].view(len(dst), n_query_images, k), merged[1].view(len(dst), n_query_images, k)
+        knn_dist = knn_dist.clamp_(min=0).sqrt_().transpose(0, 1).reshape(-1, k)
+        knn_idx = knn_idx.transpose(0, 1).reshape(-1, k)
+        # windows with fewer than k library rows leave padded (-1, inf) results and always fall back
+        far = ((knn_dist[:, 0] > self.fallback) | (knn_idx < 0).any(dim=1)).nonzero().squeeze(1)
+        if len(far):
+            knn_dist[far], knn_idx[far] = self.index.search(query[far], k=k)
+        return knn_dist, knn_idx
+
+
+class QuantizedIndex():
+    '''
+    Search over the target (last) timestep slice of a QuantizedBank. Candidates come from distances on the
+    float16/int8 codes, computed tile by tile, and the best rerank_k of them are re-ranked with exact float32
+    distances on rows read from the bank (its fp32 copy when it has one).
+    The per-channel int8 scale is folded into the queries, q . (scale * codes) = (scale * q) . codes, so a code tile
+    is only cast to the matmul dtype instead of being dequantized. On the CPU that dtype is float32 (half matmuls
+    only pay off on the GPU) and the cast of every tile remains, see benchmarks/quantized_bank.py.
+    '''
+    def __init__(self, bank, rerank_k=8, tile_size=0):
+        self.bank = bank
+        self.rerank_k = rerank_k
+        self.tile_size = tile_size if tile_size > 0 else 65536
+        self.dtype = torch.float16 if bank.device.type == "cuda" else torch.float32
+        self.scale = bank.scale[-1] if bank.scale is not None else None  # (1, C)
+        self.lib_sq = torch.cat([self.scaled(self.tile(start).float()).pow(2).sum(dim=1) for start in range(0, len(self), self.tile_size)])
+
+    def __len__(self):
+        return self.bank.shape[1]
+
+    def tile(self, start):
+        return self.bank.codes[-1, start:start + self.tile_size].to(self.dtype)
+
+    def scaled(self, x):
+        return x if self.scale is None else x * self.scale
+
+    def state_dict(self):
+        return {}
+
+    def search(self, query, k=1):
+        n_cand = min(max(k, self.rerank_k), len(self))
+        query_sq = query.pow(2).sum(dim=1, keepdim=True)
+        low_query = self.scaled(query).to(self.dtype)
+        cand_dist, cand_idx = None, None
+        for start in range(0, len(self), self.tile_size):
+            lib = self.tile(start)
+            # in place, one (Q, tile_size) buffer per tile
+            dist = (low_query @ lib.T).float().mul_(-2).add_(query_sq).add_(self.lib_sq[start:start + lib.shape[0]].unsqueeze(0))
+            tile_dist, tile_idx = torch.topk(dist, k=min(n_cand, dist.shape[1]), largest=False)
+            cand_dist, cand_idx = merge_topk(cand_dist, cand_idx, tile_dist, tile_idx + start, n_cand)
+        return rerank(self.bank, query, cand_idx, k)
+
+
+def rerank(bank, query, cand_idx, k):
+    '''Exact float32 re-rank of (Q, n_cand) candidate indices into the target slice of a compressed bank.'''
+    rows = bank[-1, cand_idx.flatten()].view(*cand_idx.shape, -1)
+    dist = torch.linalg.norm(rows - query.unsqueeze(1), dim=2)
+    knn_dist, order = torch.topk(dist, k=k, largest=False)
+    return knn_dist, torch.gather(cand_idx, 1, order)
+
+
+class PQIndex():
+    '''
+    Asymmetric distance computation over the target slice of a PQBank. Each query builds a (m, 256) table of
+    squared distances from its sub-vectors to the sub-centroids, the distance to a stored patch is then the sum
+    of m table lookups. The best rerank_k candidates are re-ranked in float32 like QuantizedIndex.
+    '''
+    def __init__(self, bank, rerank_k=8, tile_size=0):
+        self.bank = bank
+        self.rerank_k = rerank_k
+        self.tile_size = tile_size if tile_size > 0 else 4096
+        self.codebooks = bank.codebooks[-1]  # (m, 256, C / m)
+        self.codes = bank.codes[-1]  # (N, m)
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def state_dict(self):
+        return {}
+
+    def search(self, query, k=1):
+        m, _, d = self.codebooks.shape
+        n_cand = min(max(k, self.rerank_k), len(self))
+        sub = query.view(query.shape[0], m, d)
+        table = (sub.pow(2).sum(dim=2, keepdim=True) - 2 * torch.einsum('qmd,mkd->qmk', sub, self.codebooks)
+                 + self.codebooks.pow(2).sum(dim=2).unsqueeze(0))
+        cand_dist, cand_idx = None, None
+        for start in range(0, len(self), self.tile_size):
+            codes = self.codes[start:start + self.tile_size].long()
+            dist = table[:, 0, :].index_select(1, codes[:, 0])
+            for j in range(1, m):
+                dist += table[:, j, :].index_select(1, codes[:, j])
+            tile_dist, tile_idx = torch.topk(dist, k=min(n_cand, dist.shape[1]), largest=False)
+            cand_dist, cand_idx = merge_topk(cand_dist, cand_idx, tile_dist, tile_idx + start, n_cand)
+        return rerank(self.bank, query, cand_idx, k)
@@ -7,6 +7,14 @@ def reweight(img_size, nonzero_indices, weight = 0.0):
     reweight_arr = reweight_arr.reshape(3, img_size, img_size)
     return reweight_arr
 
+def nmap_foreground(nmap, threshold=0.05):
+    '''(B, 3, S, S) normal maps -> (B, 1, S, S) foreground pixels. trans_to_nmap writes black where the xyz point is invalid.'''
+    return nmap.amax(dim=1, keepdim=True) > threshold
+
+def foreground_patches(foreground, feature_map_dims):
+    '''(B, 1, S, S) foreground pixels -> (B, H, W) feature map patches that hold any foreground pixel.'''
+    return torch.nn.functional.adaptive_max_pool2d(foreground.float(), tuple(feature_map_dims))[:, 0] > 0
+
 def organized_pc_to_unorganized_pc(organized_pc):
     return organized_pc.reshape(organized_pc.shape[0] * organized_pc.shape[1], organized_pc.shape[2])
 
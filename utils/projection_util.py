@@ -0,0 +1,72 @@
+import torch
+
+
+class FeatureProjection():
+    '''
+    Linear map of (B, C, H, W) feature maps to out_dim channels, run on the compute device before features are
+    moved to the CPU or stored. "pca" centres on the mean and keeps the out_dim principal axes of the features
+    passed to update before fit (a bounded sample of the memory split), accumulated batch by batch like LocationGaussian.
+    "random" is a fixed seeded Gaussian projection scaled so that distances are preserved on average, it needs no
+    data and is fitted on the first batch it sees.
+    '''
+    def __init__(self, kind="pca", out_dim=128, device="cpu", mean=None, components=None):
+        if kind not in ("pca", "random"):
+            raise TypeError(f"Unknown feature projection: {kind}")
+        self.kind = kind
+        self.out_dim = out_dim
+        self.device = torch.device(device)
+        self.mean = mean  # (C,)
+        self.components = components  # (C, out_dim)
+        # running sums of the features shifted by the mean of the first batch, which keeps float32 sums accurate
+        self.n = 0
+        self.shift = None
+        self.sum_x = None
+        self.sum_xx = None
+
+    @property
+    def fitted(self):
+        return self.components is not None
+
+    def update(self, features):
+        # accumulate the (B, C, H, W) features into the PCA statistics
+        C = features.shape[1]
+        x = features.to(self.device, torch.float32).permute(0, 2, 3, 1).reshape(-1, C)
+        if self.shift is None:
+            self.shift = x.mean(dim=0)
+            self.sum_x = torch.zeros(C, device=self.device)
+            self.sum_xx = torch.zeros(C, C, device=self.device)
+        x = x - self.shift
+        self.n += x.shape[0]
+        self.sum_x += x.sum(dim=0)
+        self.sum_xx += x.T @ x
+
+    def fit(self, features=None):
+        # "pca" fits on the accumulated statistics, together with features when given
+        if features is not None and self.kind == "pca":
+            self.update(features)
+        C = features.shape[1] if features is not None else self.sum_x.shape[0]
+        out_dim = min(self.out_dim, C)
+        if self.kind == "random":
+            generator = torch.Generator().manual_seed(0)
+            self.mean = torch.zeros(C, device=self.device)
+            self.components = (torch.randn(C, out_dim, generator=generator) / out_dim ** 0.5).to(self.device)
+            return self
+        mean = self.sum_x / self.n
+        cov = (self.sum_xx - self.n * torch.outer(mean, mean)) / max(1, self.n - 1)
+        eigvals, eigvecs = torch.linalg.eigh(cov)
+        # eigh sorts ascending, keep the largest out_dim axes
+        self.components = eigvecs[:, -out_dim:].flip(1).contiguous()
+        self.mean = mean + self.shift
+        print(f"PCA: {C} -> {out_dim} channels over {self.n} patches, "
+              f"{eigvals[-out_dim:].sum() / eigvals.sum():.3f} of the variance kept")
+        self.n, self.shift, self.sum_x, self.sum_xx = 0, None, None, None
+        return self
+
+    def __call__(self, features):
+        if not self.fitted:
+            self.fit(features)
+        features = features - self.mean.view(1, -1, 1, 1)
+        return torch.einsum('bchw,cd->bdhw', features, self.components)
+
+    def state_dict(self):
+        return {"mean": self.mean, "components": self.components}
@@ -22,6 +22,10 @@ def log_args(args):
 
     log_file.write(f'Feature Layer: {args.feature_layers} \n')
     log_file.write(f'Top K: {args.topk} \n')
+    log_file.write(f'Coreset: {args.f_coreset} (size {args.coreset_size}) \n')
+    log_file.write(f'Index: {args.index_type} (prefilter {args.prefilter_images} images, local window {args.local_window}, clusters {args.route_clusters}/{args.n_clusters}) \n')
+    log_file.write(f'Projection: {args.projection} ({args.proj_dim} channels) \n')
+    log_file.write(f'Foreground mask: {args.fg_mask} \n')
     log_file.write(f'Noise Intensity: {args.noise_intensity} \n')
     log_file.write(f'Step Size {args.step_size} \n')
     # log_file.write(f'Multi Timesteps: {args.multi_timesteps} \n')
@@ -41,6 +45,39 @@ def nxn_cos_sim(A, B, dim=1):
     return torch.mm(a_norm, b_norm.transpose(0, 1))
 
 
+class GaussianBlur(torch.nn.Module):
+    '''
+    Separable Gaussian smoothing of (..., H, W) float maps on their own device, in full precision and without the
+    8-bit PIL round trip of KNNGaussianBlur. sigma matches the radius of ImageFilter.GaussianBlur, the kernel is
+    truncated at 4 sigma and borders are replicated like PIL does. Each pass is one matmul with a banded matrix,
+    which batches far better than a single channel convolution.
+    '''
+    def __init__(self, sigma : float = 4):
+        super().__init__()
+        self.sigma = sigma
+        self.radius = int(4 * sigma + 0.5)
+        x = torch.arange(-self.radius, self.radius + 1, dtype=torch.float32)
+        kernel = torch.exp(-x ** 2 / (2 * sigma ** 2))
+        self.kernel = kernel / kernel.sum()
+        self.matrices = {}
+
+    def blur_matrix(self, n, device, dtype):
+        # (n, n) matrix M with x @ M the 1-D blur of the last dim of x, replicated borders folded in
+        key = (n, device, dtype)
+        if key not in self.matrices:
+            out = torch.arange(n).view(-1, 1).expand(-1, len(self.kernel))
+            src = (out + torch.arange(-self.radius, self.radius + 1)).clamp(0, n - 1)
+            matrix = torch.zeros(n, n).index_put_((src.reshape(-1), out.reshape(-1)), self.kernel.repeat(n), accumulate=True)
+            self.matrices[key] = matrix.to(device, dtype)
+        return self.matrices[key]
+
+    def forward(self, maps):
+        H, W = maps.shape[-2:]
+        blur_h = self.blur_matrix(H, maps.device, maps.dtype)
+        blur_w = self.blur_matrix(W, maps.device, maps.dtype)
+        return blur_h.T @ maps @ blur_w
+
+
 class KNNGaussianBlur(torch.nn.Module):
     def __init__(self, radius : int = 4):
         super().__init__()